@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   bench_fuzzy.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Benchmark fuzzy category matching against plain `process.extractOne`.
+
+Run from the repository root with `python -m benchmarks.bench_fuzzy`.
+
+"""
+
+import argparse
+import random
+import timeit
+
+from fuzzywuzzy import fuzz, process
+
+from expensebot.messages import FuzzyMatcherMixin
+
+from benchmarks.corpus import add_typo, random_word
+
+
+def reference_match(category, categories):
+    """Original matcher implementation."""
+    matched_cat, score = process.extractOne(category.lower(), list(categories.keys()),
+                                            scorer=fuzz.partial_ratio)
+    return matched_cat if score >= 75 else None
+
+
+def main(args=None):
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description='Fuzzy matcher benchmark')
+    parser.add_argument('--categories', type=int, default=250, help='Number of categories')
+    parser.add_argument('--queries', type=int, default=2000, help='Number of queries')
+    parser.add_argument('--distinct', type=int, default=300, help='Number of distinct queries')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args(args=args)
+    rng = random.Random(args.seed)
+    names = {random_word(rng).capitalize() for _ in range(args.categories)}
+    categories = {name.lower(): name for name in names}
+    distinct = [add_typo(rng, rng.choice(list(categories))) for _ in range(args.distinct)]
+    queries = [rng.choice(distinct) for _ in range(args.queries)]
+    matcher = FuzzyMatcherMixin(categories)
+    # Check results are unchanged
+    mismatches = [query for query in distinct
+                  if matcher.match(None, query) != reference_match(query, categories)]
+    if mismatches:
+        raise SystemExit("Matcher results differ from reference for {}".format(mismatches[:10]))
+    matcher.set_categories(categories)
+    reference = timeit.timeit(lambda: [reference_match(query, categories) for query in queries],
+                              number=1)
+    cold = timeit.timeit(lambda: [matcher.match(None, query) for query in distinct], number=1)
+    matcher.set_categories(categories)
+    optimized = timeit.timeit(lambda: [matcher.match(None, query) for query in queries], number=1)
+    print("{} categories, {} queries ({} distinct)".format(len(categories), len(queries), len(distinct)))
+    print("extractOne:         {:8.2f} us/query".format(1e6 * reference / len(queries)))
+    print("matcher (no cache): {:8.2f} us/query".format(1e6 * cold / len(distinct)))
+    print("matcher:            {:8.2f} us/query".format(1e6 * optimized / len(queries)))
+    print("speedup (no cache): {:8.1f}x".format(
+        (reference / len(queries)) / (cold / len(distinct))))
+    print("speedup:            {:8.1f}x".format(reference / optimized))
+
+
+if __name__ == "__main__":
+    main()
+
+# EOF
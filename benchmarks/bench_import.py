@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   bench_import.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Guard the import cost of the CLI and the message parser.
+
+Imports each target in a fresh interpreter with `python -X importtime`,
+reports the median cumulative import time, and fails if it exceeds its
+budget or if any of the heavy dependencies that should be imported lazily
+is pulled in. Also times `expensebot --help` end to end.
+
+Run from the repository root with `python -m benchmarks.bench_import`.
+
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+
+IMPORTTIME_REGEX = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$")
+
+# Heavy dependencies, which must only be imported when used
+HEAVY = ("telegram", "gspread", "oauth2client", "google", "fuzzywuzzy", "datefinder",
+         "yaml", "importlib_resources", "asyncio", "sqlite3")
+
+# Target module -> budget of its cumulative import time, in ms
+TARGETS = {"expensebot.cli": 150,
+           "expensebot.messages": 100}
+# Budget of `expensebot --help`, in ms (includes interpreter startup)
+HELP_BUDGET = 400
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_profile(module):
+    """Import a module in a fresh interpreter.
+
+    Return:
+        tuple: Cumulative import time of the module in ms, and set of imported
+            top-level packages.
+
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                            cwd=ROOT, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    cumulative = None
+    packages = set()
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_REGEX.match(line)
+        if not match:
+            continue
+        _, total, indent, name = match.groups()
+        packages.add(name.split(".")[0])
+        if name == module and len(indent) == 1:
+            cumulative = int(total) / 1e3
+    return cumulative, packages
+
+
+def time_help():
+    """Wall time of `expensebot --help`, in ms."""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-m", "expensebot.cli", "--help"], cwd=ROOT,
+                   stdout=subprocess.DEVNULL, check=True)
+    return 1e3 * (time.perf_counter() - start)
+
+
+def main(args=None):
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description='Import time benchmark')
+    parser.add_argument('--repeat', type=int, default=5, help='Fresh interpreters per target')
+    parser.add_argument('--budget-scale', type=float, default=1.0,
+                        help='Scale the time budgets (eg, 5 for slow hosts like a Raspberry Pi)')
+    args = parser.parse_args(args=args)
+    failures = []
+    print("{:<24}{:>12}{:>12}  heavy imports".format("target", "median ms", "budget ms"))
+    for module, budget in TARGETS.items():
+        budget *= args.budget_scale
+        times = []
+        heavy = set()
+        for _ in range(args.repeat):
+            cumulative, packages = import_profile(module)
+            times.append(cumulative)
+            heavy |= packages & set(HEAVY)
+        median = statistics.median(times)
+        print("{:<24}{:>12.1f}{:>12.0f}  {}".format(module, median, budget,
+                                                    ", ".join(sorted(heavy)) or "-"))
+        if median > budget:
+            failures.append("{} takes {:.1f} ms to import (budget {:.0f} ms)".format(module, median, budget))
+        if heavy:
+            failures.append("{} imports {}".format(module, ", ".join(sorted(heavy))))
+    help_budget = HELP_BUDGET * args.budget_scale
+    help_time = statistics.median(time_help() for _ in range(args.repeat))
+    print("{:<24}{:>12.1f}{:>12.0f}".format("expensebot --help", help_time, help_budget))
+    if help_time > help_budget:
+        failures.append("expensebot --help takes {:.1f} ms (budget {:.0f} ms)".format(help_time, help_budget))
+    for failure in failures:
+        print("FAIL: " + failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# EOF
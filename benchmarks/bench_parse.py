@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   bench_parse.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Benchmark expense message parsing.
+
+Times `ExpenseParser.parse` and each of its stages (tokenizer, value regex,
+date extraction, category matching, plus the individual matchers) on a
+generated corpus, and reports throughput and memory allocations. The regex and
+datefinder based parsing it replaced is timed as "legacy parse". Runs fully
+offline.
+
+Run from the repository root with `python -m benchmarks.bench_parse`. Use
+`--save FILE` to store the results and `--compare FILE` to fail (exit code 1)
+if any stage got slower than the stored results by more than `--tolerance`.
+`--check-golden` checks that the parser gives the same results as the legacy
+one on the corpus.
+
+"""
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+import datefinder
+
+from expensebot.messages import (ExpenseParser, ExpenseTokenizer, FixedMatcherMixin, FuzzyMatcherMixin,
+                                 ParseError, RegexParser, RepetitionMatcherMixin,
+                                 find_dates, _find_dates_cached)
+
+from benchmarks.bench_fuzzy import reference_match
+from benchmarks.corpus import generate_categories, generate_corpus
+
+
+class ReferenceFuzzyMatcher(FuzzyMatcherMixin):
+    """Fuzzy matcher using plain `process.extractOne`."""
+
+    def match(self, _, category):
+        if not category or not self.categories:
+            return None
+        return reference_match(category, self.categories)
+
+
+def legacy_parser(categories):
+    """Parser using the value regex, datefinder and plain fuzzy matching."""
+    return RegexParser(categories, [RepetitionMatcherMixin, ReferenceFuzzyMatcher, FixedMatcherMixin])
+
+
+def clear_caches(parser):
+    """Reset the memoization caches so every run starts cold."""
+    _find_dates_cached.cache_clear()
+    parser.set_categories(list(parser.categories.values()))
+
+
+def stage_functions(parser, corpus):  # pylint: disable=too-many-locals
+    """Build the benchmarked stages.
+
+    Each stage is a (name, function) pair; functions process the whole corpus,
+    using the output of the earlier stages as input.
+
+    """
+    split = []
+    for line in corpus:
+        try:
+            split.append(parser.split_value(line))
+        except ParseError:
+            pass
+    dated = [parser.extract_date(concept, cat) for _, _, concept, cat in split]
+    fuzzy = FuzzyMatcherMixin(parser.categories)
+    fixed = FixedMatcherMixin(parser.categories)
+    tokenizer = ExpenseTokenizer()
+    legacy = legacy_parser(parser.categories.values())
+
+    def run_tokenizer():
+        for line in corpus:
+            tokenizer.tokenize(line)
+
+    def run_regex():
+        for line in corpus:
+            try:
+                parser.split_value(line)
+            except ParseError:
+                pass
+
+    def run_dates():
+        for _, _, concept, cat in split:
+            parser.extract_date(concept, cat)
+
+    def run_categories():
+        for _, concept, cat in dated:
+            parser.get_category(concept, cat)
+
+    def run_fuzzy():
+        fuzzy.set_categories(parser.categories)
+        for _, concept, cat in dated:
+            fuzzy.match(concept, cat)
+
+    def run_fixed():
+        for _, concept, cat in dated:
+            fixed.match(concept, cat)
+
+    def run_parse():
+        for line in corpus:
+            try:
+                parser.parse(line)
+            except ParseError:
+                pass
+
+    def run_legacy():
+        legacy.set_categories(list(parser.categories.values()))
+        for line in corpus:
+            try:
+                legacy.parse(line)
+            except ParseError:
+                pass
+
+    return [("tokenizer", run_tokenizer),
+            ("regex", run_regex),
+            ("datefinder", run_dates),
+            ("categories", run_categories),
+            ("fuzzy matcher", run_fuzzy),
+            ("fixed matcher", run_fixed),
+            ("parse", run_parse),
+            ("legacy parse", run_legacy)]
+
+
+def run_benchmark(parser, corpus, repeat):
+    """Time and measure allocations of every stage."""
+    results = {}
+    for name, func in stage_functions(parser, corpus):
+        timings = []
+        for _ in range(repeat):
+            clear_caches(parser)
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+        clear_caches(parser)
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        allocated = sum(stat.size for stat in snapshot.statistics('filename'))
+        best = min(timings)
+        results[name] = {'us_per_line': 1e6 * best / len(corpus),
+                         'lines_per_s': len(corpus) / best,
+                         'peak_kib': peak / 1024,
+                         'retained_kib': allocated / 1024}
+    return results
+
+
+def check_dates(corpus):
+    """Check that the date pre-filter gives the same results as plain datefinder."""
+    mismatches = [line for line in corpus
+                  if list(find_dates(line)) != list(datefinder.find_dates(line, source=True))]
+    return mismatches
+
+
+def check_golden(parser, corpus):
+    """Check that the parser gives the same results as the legacy one."""
+    legacy = legacy_parser(parser.categories.values())
+    mismatches = []
+    for line in corpus:
+        results = []
+        for line_parser in (parser, legacy):
+            try:
+                results.append(line_parser.parse(line))
+            except ParseError as error:
+                results.append(type(error))
+        if results[0] != results[1]:
+            mismatches.append((line, results[0], results[1]))
+    return mismatches
+
+
+def compare(results, baseline, tolerance):
+    """Find the stages that got slower than the baseline."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        reference = baseline[name]['us_per_line']
+        if result['us_per_line'] > reference * (1 + tolerance):
+            regressions.append((name, reference, result['us_per_line']))
+    return regressions
+
+
+def main(args=None):
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description='Expense parsing benchmark')
+    parser.add_argument('--lines', type=int, default=20000, help='Corpus size')
+    parser.add_argument('--categories', type=int, default=24, help='Number of categories')
+    parser.add_argument('--repeat', type=int, default=3, help='Timing repetitions (best is kept)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--check-dates', action='store_true',
+                        help='Check the date pre-filter against plain datefinder')
+    parser.add_argument('--check-golden', action='store_true',
+                        help='Check the parser results against the legacy parser')
+    parser.add_argument('--save', type=str, help='Store results as JSON')
+    parser.add_argument('--compare', type=str, help='Compare with results stored as JSON')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed slowdown with respect to --compare results')
+    args = parser.parse_args(args=args)
+    corpus = generate_corpus(args.lines, seed=args.seed)
+    expense_parser = ExpenseParser(generate_categories(args.categories, seed=args.seed))
+    if args.check_dates:
+        mismatches = check_dates(corpus)
+        if mismatches:
+            print("Date pre-filter differs from datefinder for {} lines, e.g. {}".format(
+                len(mismatches), mismatches[:5]))
+            return 1
+        print("Date pre-filter matches datefinder on {} lines".format(len(corpus)))
+    if args.check_golden:
+        mismatches = check_golden(expense_parser, corpus)
+        if mismatches:
+            print("Parser differs from the legacy one for {} lines, e.g.".format(len(mismatches)))
+            for line, result, reference in mismatches[:5]:
+                print("  {!r}: {} != {}".format(line, result, reference))
+            return 1
+        print("Parser matches the legacy one on {} lines".format(len(corpus)))
+    results = run_benchmark(expense_parser, corpus, args.repeat)
+    print("{} lines, {} categories".format(len(corpus), len(expense_parser.categories)))
+    print("{:<15} {:>12} {:>12} {:>12} {:>14}".format(
+        "stage", "us/line", "lines/s", "peak KiB", "retained KiB"))
+    for name, result in results.items():
+        print("{:<15} {us_per_line:>12.2f} {lines_per_s:>12.0f} {peak_kib:>12.1f} {retained_kib:>14.1f}"
+              .format(name, **result))
+    if args.save:
+        with open(args.save, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    if args.compare:
+        with open(args.compare) as input_file:
+            baseline = json.load(input_file)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, reference, current in regressions:
+            print("REGRESSION in {}: {:.2f} -> {:.2f} us/line".format(name, reference, current))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# EOF
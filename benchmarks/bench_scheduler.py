@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   bench_scheduler.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Benchmark the GSheets request scheduler against a rate limited fake.
+
+Concurrent writers add expenses to several month worksheets while the fake
+enforces a per-window quota and injects random 429 errors. The same load is
+run with the scheduler disabled (no quota, no retries) and enabled, and the
+throughput, API calls, rate limited calls and failed expenses are compared.
+
+Run from the repository root with `python -m benchmarks.bench_scheduler`.
+
+"""
+
+import argparse
+import datetime
+import logging
+import sys
+import tempfile
+import threading
+import time
+
+import expensebot.gsheet as gsheet
+from expensebot.stats import STATS
+
+from benchmarks.bench_sheets import CONFIG, OfflineBot, setup_backend
+from benchmarks.corpus import generate_corpus
+from benchmarks.fake_sheets import FakeBackend, FakeClient
+
+
+def month_dates(months):
+    """A date in each of the last `months` months."""
+    today = datetime.date.today()
+    dates = []
+    for offset in range(months):
+        year, month = divmod(today.year * 12 + today.month - 1 - offset, 12)
+        dates.append(datetime.datetime(year, month + 1, 1, 12))
+    return dates
+
+
+def run_scenario(name, args, sheets_config):
+    """Write the expenses with the given scheduler settings."""
+    backend = FakeBackend(latency=args.latency, window=args.window, seed=args.seed)
+    setup_backend(backend)
+    gsheet.clear_caches()
+    gsheet.register_client(CONFIG, FakeClient(backend))
+    config = dict(CONFIG, **{"data-dir": tempfile.mkdtemp(prefix="bench-scheduler-"),
+                             "category-memory": {"enabled": False},
+                             "sheets": sheets_config})
+    bot = OfflineBot(config)
+    dates = month_dates(args.months)
+    lines = generate_corpus(args.expenses, seed=args.seed, date_fraction=0)
+    expenses = [bot.parse_expense(line)._replace(date=dates[index % len(dates)])
+                for index, line in enumerate(lines)]
+    backend.quota = args.quota
+    backend.error_rate = args.error_rate
+    backend.reset_stats()
+    STATS.reset()
+    written = [0] * args.writers
+
+    def writer(num):
+        for expense in expenses[num::args.writers]:
+            written[num] += bot.write_expenses([expense])[0] is None
+
+    threads = [threading.Thread(target=writer, args=(num,)) for num in range(args.writers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    _, counters = STATS.snapshot()
+    print("== {} ({} expenses, {} writers, {} months)".format(
+        name, len(expenses), args.writers, args.months))
+    print("  written {} in {:.1f} s ({:.1f} expenses/s), failed {}".format(
+        sum(written), elapsed, sum(written) / elapsed, len(expenses) - sum(written)))
+    print("  API calls {} (rate limited {}), retries {}, coalesced writes {}".format(
+        backend.total_calls, sum(backend.errors.values()),
+        counters.get("sheets.retries", 0), counters.get("sheets.coalesced", 0)))
+    print("  calls by method: {}".format(dict(backend.calls.most_common())))
+
+
+def main(args=None):
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description='GSheets request scheduler benchmark')
+    parser.add_argument('--expenses', type=int, default=300, help='Number of expenses')
+    parser.add_argument('--writers', type=int, default=6, help='Concurrent writers')
+    parser.add_argument('--months', type=int, default=3, help='Month worksheets written to')
+    parser.add_argument('--latency', type=float, default=0.02, help='Simulated seconds per API call')
+    parser.add_argument('--quota', type=int, default=100, help='Calls allowed per quota window')
+    parser.add_argument('--window', type=float, default=10.0, help='Quota window in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.02, help='Probability of a random 429')
+    parser.add_argument('--sheets-quota', type=int, default=None,
+                        help='Scheduler quota per minute (default: 90%% of the fake one)')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args(args=args)
+    # Failed writes are expected without the scheduler
+    logging.basicConfig(level=logging.CRITICAL)
+    sheets_quota = args.sheets_quota or int(0.9 * args.quota * 60 / args.window)
+    run_scenario("direct (no quota, no retries)", args,
+                 {"quota-per-minute": None, "max-retries": 0})
+    run_scenario("scheduler ({}/min)".format(sheets_quota), args,
+                 {"quota-per-minute": sheets_quota, "burst": max(1, args.quota // 10),
+                  "max-retries": 8, "max-backoff": args.window})
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# EOF
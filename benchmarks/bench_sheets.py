@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   bench_sheets.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Benchmark GSheets usage of the bot against the offline fake.
+
+Measures API calls and end-to-end latency per expense for
+`ExpenseBot.add_expense` and `ExpenseBot.add_investment`, with simulated
+latency and rate limiting.
+
+Run from the repository root with `python -m benchmarks.bench_sheets`.
+
+"""
+
+import argparse
+import datetime
+import logging
+import statistics
+import sys
+import tempfile
+import time
+
+import expensebot.gsheet as gsheet
+import expensebot.journal as journal
+from expensebot.bot import ExpenseBot
+
+from benchmarks.corpus import CATEGORIES, generate_corpus
+from benchmarks.fake_sheets import FakeBackend, FakeClient
+
+
+CONFIG = {"credentials": {"telegram": {"token": "", "authorized-ids": []},
+                          "gspread": {"credential": '{"type": "fake"}'}},
+          "expenses-sheet": "expenses",
+          "investment-sheet": "investments",
+          "nw-sheet": "nw"}
+
+
+class OfflineBot(ExpenseBot):
+    """Expense bot without the Telegram side."""
+
+    def create_bot(self, bot_config=None):
+        return None
+
+
+def setup_backend(backend, categories=CATEGORIES):
+    """Create the spreadsheets the bot expects, with EURCHF rates up to yesterday."""
+    expenses_sheet = backend.create_spreadsheet(CONFIG["expenses-sheet"])
+    today = datetime.date.today()
+    first_day = datetime.date(today.year, 1, 1)
+    rates = expenses_sheet.create_worksheet("{} EURCHF".format(today.year))
+    rates.set_values("A1", [["Date", "Rate"]] + [
+        [(first_day - datetime.date(1899, 12, 30)).days + day, 0.95 + 0.001 * (day % 20)]
+        for day in range((today - first_day).days)])
+    backend.create_spreadsheet(CONFIG["investment-sheet"])
+    nw_sheet = backend.create_spreadsheet(CONFIG["nw-sheet"])
+    worksheet = nw_sheet.create_worksheet("{} Gastos".format(datetime.datetime.today().year))
+    worksheet.set_values("A1", [["Gastos"]] + [[cat] for cat in categories] + [["Total gastos"]])
+
+
+def run_scenario(name, backend, func, inputs):
+    """Run `func` on every input, measuring calls and latency of each."""
+    latencies = []
+    calls = []
+    failures = 0
+    backend.reset_stats()
+    for item in inputs:
+        before = backend.total_calls
+        start = time.perf_counter()
+        try:
+            func(item)
+        except Exception:  # pylint: disable=broad-except
+            failures += 1
+        latencies.append(time.perf_counter() - start)
+        calls.append(backend.total_calls - before)
+    steady = calls[1:] or calls
+    print("== {} ({} items)".format(name, len(inputs)))
+    print("  API calls: first {}, then {:.2f}/item (total {})".format(
+        calls[0], statistics.mean(steady), backend.total_calls))
+    print("  calls by method: {}".format(dict(backend.calls.most_common())))
+    print("  latency: first {:.1f} ms, median {:.1f} ms, mean {:.1f} ms".format(
+        1e3 * latencies[0], 1e3 * statistics.median(latencies), 1e3 * statistics.mean(latencies)))
+    print("  failures: {} (rate limited calls: {})".format(failures, sum(backend.errors.values())))
+    return {"calls_per_item": statistics.mean(steady),
+            "latency_ms": 1e3 * statistics.mean(latencies),
+            "failures": failures}
+
+
+def check_duplicates(backend):
+    """Check that an expense whose write failed is not a duplicate when sent again.
+
+    Writes fail with a 429 (written synchronously) or because the spreadsheet
+    doesn't exist (written behind, given up on after `journal.MAX_ATTEMPTS`
+    attempts). Sending the expense again must add it, and sending it once
+    more must be ignored as a duplicate.
+
+    Return:
+        int: Number of failed checks.
+
+    """
+    failures = 0
+
+    def check(name, result, expected):
+        nonlocal failures
+        if isinstance(result, str):
+            outcome = result
+        elif isinstance(result, ValueError) and 'duplicate' in str(result):
+            outcome = 'duplicate'
+        else:
+            outcome = 'failed' if isinstance(result, Exception) else 'added'
+        print('  {}: {} (expected {})'.format(name, outcome, expected))
+        failures += outcome != expected
+
+    sheets_config = {"quota-per-minute": None, "max-retries": 0}
+    print('== Resend after a failed write')
+    bot = OfflineBot(dict(CONFIG, **{"data-dir": tempfile.mkdtemp(prefix="bench-sheets-"),
+                                     "sheets": sheets_config}))
+    backend.quota = 0
+    check('rate limited', bot.add_expenses(['Check sync 12.5'])[0], 'failed')
+    backend.quota = None
+    check('sent again', bot.add_expenses(['Check sync 12.5'])[0], 'added')
+    check('sent once more', bot.add_expenses(['Check sync 12.5'])[0], 'duplicate')
+    print('== Resend after a failed write-behind')
+    bot = OfflineBot(dict(CONFIG, **{"data-dir": tempfile.mkdtemp(prefix="bench-sheets-"),
+                                     "sheets": sheets_config,
+                                     "write-behind": {"enabled": True}}))
+    retry_backoff, journal.RETRY_BACKOFF = journal.RETRY_BACKOFF, 0
+    try:
+        check('queued', bot.add_expenses(['Check journal 8'], 'missing')[0], 'added')
+        flusher = bot._flusher  # pylint: disable=protected-access
+        for _ in range(journal.MAX_ATTEMPTS):
+            flusher.flush()
+        check('written', 'failed' if flusher.journal.failed() else 'pending', 'failed')
+        check('sent again', bot.add_expenses(['Check journal 8'], 'missing')[0], 'added')
+        check('sent once more', bot.add_expenses(['Check journal 8'], 'missing')[0], 'duplicate')
+    finally:
+        journal.RETRY_BACKOFF = retry_backoff
+    return failures
+
+
+def main(args=None):
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description='GSheets usage benchmark')
+    parser.add_argument('--expenses', type=int, default=200, help='Number of expenses')
+    parser.add_argument('--latency', type=float, default=0.02, help='Simulated seconds per API call')
+    parser.add_argument('--quota', type=int, default=None, help='Calls allowed per quota window')
+    parser.add_argument('--window', type=float, default=60.0, help='Quota window in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Probability of a random 429')
+    parser.add_argument('--sheets-quota', type=int, default=None,
+                        help='Request scheduler quota per minute (default: no limit)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--check-duplicates', action='store_true',
+                        help='Only check that expenses whose write failed can be sent again')
+    args = parser.parse_args(args=args)
+    logging.basicConfig(level=logging.ERROR)
+    backend = FakeBackend(latency=args.latency, window=args.window, seed=args.seed)
+    setup_backend(backend)
+    gsheet.clear_caches()
+    gsheet.register_client(CONFIG, FakeClient(backend))
+    if args.check_duplicates:
+        return 1 if check_duplicates(backend) else 0
+    backend.reset_stats()
+    config = dict(CONFIG, **{"data-dir": tempfile.mkdtemp(prefix="bench-sheets-"),
+                             "sheets": {"quota-per-minute": args.sheets_quota}})
+    start = time.perf_counter()
+    bot = OfflineBot(config)
+    print("Bot startup: {:.1f} ms, {} API calls".format(1e3 * (time.perf_counter() - start),
+                                                        backend.total_calls))
+    backend.reset_stats()
+    start = time.perf_counter()
+    bot.refresh_categories()
+    print("Category refresh: {:.1f} ms, {} API calls".format(1e3 * (time.perf_counter() - start),
+                                                             backend.total_calls))
+    # Only inject failures once the bot is up
+    backend.quota = args.quota
+    backend.error_rate = args.error_rate
+    lines = generate_corpus(args.expenses, seed=args.seed, date_fraction=0)
+    run_scenario("add_expense", backend, bot.add_expense, lines)
+    investments = ["Fund {} {} {}".format(index % 5, 100 + index, 1.5 + index % 7)
+                   for index in range(max(1, args.expenses // 10))]
+    run_scenario("add_investment", backend, bot.add_investment, investments)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# EOF
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   corpus.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Deterministic generator of realistic expense messages for benchmarks."""
+
+import random
+import string
+
+
+CATEGORIES = ["Compra", "Vivienda", "Guardería", "Impuestos", "Transporte", "Salud",
+              "Ropa", "Ocio", "Restaurantes", "Viajes", "Regalos", "Seguros",
+              "Educación", "Deporte", "Mascotas", "Hogar", "Electrónica", "Libros",
+              "Suscripciones", "Coche", "Farmacia", "Peluquería", "Donaciones", "Bancos"]
+
+SHOPS = ["Migros", "Coop", "Denner", "Aldi", "Lidl", "Zara", "H&M", "Massimo Dutti",
+         "Ikea", "Manor", "Globus", "Starbucks", "SBB", "Helsana", "Galaxus", "Interdiscount",
+         "Digitec", "Fust", "Jumbo", "Decathlon"]
+
+WORDS = ["cena", "comida", "desayuno", "cafe", "helado", "tren", "gasolina", "piso",
+         "lavadora", "limpieza", "regalo", "libro", "entradas", "cine", "parking",
+         "peluquero", "farmacia", "taxi", "hotel", "vuelo", "pizza", "sushi", "mercado",
+         "fruta", "zapatos", "abrigo", "juguetes", "seguro", "dentista", "gimnasio"]
+
+PLACES = ["Zurich", "Basel", "Bern", "Geneva", "Lausanne", "Barcelona", "Madrid", "online"]
+
+DATE_FORMATS = ["%d/%m/%Y", "%d/%m", "%d %B", "%B %d", "%d.%m.%Y"]
+
+PUNCTUATION = [",", ";", ":", "."]
+
+
+def random_word(rng, min_len=4, max_len=12):
+    """Generate a random lowercase word."""
+    return "".join(rng.choice(string.ascii_lowercase)
+                   for _ in range(rng.randint(min_len, max_len)))
+
+
+def add_typo(rng, word):
+    """Swap, drop or replace one letter of a word."""
+    if len(word) < 3:
+        return word
+    pos = rng.randrange(len(word) - 1)
+    kind = rng.choice(("swap", "drop", "replace"))
+    if kind == "swap":
+        return word[:pos] + word[pos + 1] + word[pos] + word[pos + 2:]
+    if kind == "drop":
+        return word[:pos] + word[pos + 1:]
+    return word[:pos] + rng.choice(string.ascii_lowercase) + word[pos + 1:]
+
+
+def random_concept(rng):
+    """Generate an expense concept."""
+    kind = rng.random()
+    if kind < 0.4:
+        concept = rng.choice(SHOPS)
+        if rng.random() < 0.3:
+            concept += " " + rng.choice(PLACES)
+    elif kind < 0.8:
+        concept = rng.choice(WORDS)
+    else:
+        concept = "{} {}".format(rng.choice(WORDS), rng.choice(WORDS))
+    return concept
+
+
+def random_amount(rng):
+    """Generate an amount, with optional decimals and currency."""
+    value = "{:.2f}".format(rng.lognormvariate(3, 1))
+    if rng.random() < 0.5:
+        value = value.split(".")[0]
+    elif rng.random() < 0.3:
+        value = value.replace(".", ",")
+    currency = rng.choice(["", "", " CHF", " EUR", "CHF", " chf", " eur"])
+    return value + currency
+
+
+def random_date(rng):
+    """Generate a date text in one of the common formats."""
+    month = rng.randint(1, 12)
+    day = rng.randint(1, 28)
+    fmt = rng.choice(DATE_FORMATS)
+    months = ["January", "February", "March", "April", "May", "June", "July",
+              "August", "September", "October", "November", "December"]
+    return (fmt.replace("%d", str(day))
+            .replace("%m", "{:02d}".format(month))
+            .replace("%Y", str(rng.choice([2023, 2024, 2025])))
+            .replace("%B", months[month - 1]))
+
+
+def random_category(rng, categories):
+    """Generate a category text, sometimes with typos, abbreviated or missing."""
+    kind = rng.random()
+    if kind < 0.35:
+        return ""
+    category = rng.choice(categories).lower()
+    if kind < 0.6:
+        return category
+    if kind < 0.9:
+        return add_typo(rng, category)
+    return category[:max(3, len(category) // 2)]
+
+
+def generate_line(rng, categories=CATEGORIES, date_fraction=0.15, punctuation_fraction=0.1):
+    """Generate one expense line, sometimes with punctuation after the amount or at the end."""
+    parts = [random_concept(rng), random_amount(rng)]
+    category = random_category(rng, categories)
+    if category:
+        parts.append(category)
+    if rng.random() < date_fraction:
+        # Dates go after the amount, since the parser takes the first number as value
+        parts.insert(rng.choice([2, len(parts)]), random_date(rng))
+    if rng.random() < punctuation_fraction:
+        parts[rng.choice([1, len(parts) - 1])] += rng.choice(PUNCTUATION)
+    return " ".join(parts)
+
+
+def generate_corpus(size, seed=42, categories=CATEGORIES, date_fraction=0.15,
+                    punctuation_fraction=0.1):
+    """Generate a list of expense lines."""
+    rng = random.Random(seed)
+    return [generate_line(rng, categories, date_fraction, punctuation_fraction)
+            for _ in range(size)]
+
+
+def generate_categories(size, seed=42):
+    """Generate a category list, starting with the realistic ones."""
+    rng = random.Random(seed)
+    categories = list(CATEGORIES)
+    while len(categories) < size:
+        categories.append(random_word(rng).capitalize())
+    return categories[:size]
+
+
+# EOF
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   fake_sheets.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   17.10.2026
+# =============================================================================
+"""In-memory stand-in for the subset of gspread used by the bot.
+
+Every API call is counted, can be delayed by a simulated latency and can fail
+with a 429 error, either randomly or when a per-window quota is exceeded.
+`=COUNT(...)` formulas are evaluated so the bot can find its next free row.
+
+"""
+
+import collections
+import datetime
+import random
+import re
+import threading
+import time
+
+import gspread
+from gspread.utils import a1_to_rowcol
+
+
+RANGE_REGEX = re.compile(r"^(?:'((?:[^']|'')*)'|([^!]+))!(.+)$")
+COUNT_REGEX = re.compile(r"^=COUNT\(([A-Z]+)(\d+):([A-Z]+)(\d*)\)$", re.IGNORECASE)
+OPEN_CELL_REGEX = re.compile(r"^([A-Z]+)(\d*)$")
+DATE_REGEX = re.compile(r"^\d{1,2}/\d{1,2}/\d{4}( \d{1,2}:\d{2}(:\d{2})?)?$")
+
+
+class FakeResponse:
+    """Minimal HTTP response, as expected by `gspread.exceptions.APIError`."""
+
+    def __init__(self, status_code, message):
+        self.status_code = status_code
+        self.text = message
+
+    def json(self):
+        """Error body in the GSheets API format."""
+        return {"error": {"code": self.status_code, "message": self.text}}
+
+
+class FakeBackend:
+    """Shared state of the fake: call accounting, latency and rate limiting.
+
+    Arguments:
+        latency (float): Simulated seconds per API call.
+        quota (int): Maximum number of calls per `window` seconds (None for no limit).
+        window (float): Quota window in seconds.
+        error_rate (float): Probability of a random 429 error per call.
+        seed (int): Seed of the random errors.
+
+    """
+
+    def __init__(self, latency=0.0, quota=None, window=60.0, error_rate=0.0, seed=42):
+        self.latency = latency
+        self.quota = quota
+        self.window = window
+        self.error_rate = error_rate
+        self.calls = collections.Counter()
+        self.errors = collections.Counter()
+        self._recent = collections.deque()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.spreadsheets = {}
+
+    def call(self, name):
+        """Account for an API call, failing it if rate limited."""
+        with self._lock:
+            now = time.monotonic()
+            self.calls[name] += 1
+            while self._recent and self._recent[0] < now - self.window:
+                self._recent.popleft()
+            limited = self.quota is not None and len(self._recent) >= self.quota
+            if not limited:
+                limited = self._rng.random() < self.error_rate
+            if not limited:
+                self._recent.append(now)
+        if self.latency:
+            time.sleep(self.latency)
+        if limited:
+            with self._lock:
+                self.errors[name] += 1
+            raise gspread.exceptions.APIError(FakeResponse(429, "Quota exceeded (fake)"))
+
+    @property
+    def total_calls(self):
+        """Number of API calls made, including failed ones."""
+        return sum(self.calls.values())
+
+    def reset_stats(self):
+        """Reset the call and error counters."""
+        with self._lock:
+            self.calls.clear()
+            self.errors.clear()
+            self._recent.clear()
+
+    def create_spreadsheet(self, key, title=None):
+        """Create an empty spreadsheet."""
+        spreadsheet = FakeSpreadsheet(self, key, title or key)
+        self.spreadsheets[key] = spreadsheet
+        return spreadsheet
+
+
+class FakeAuth:
+    """Credentials that never expire."""
+
+    token = "fake-token"
+    expiry = datetime.datetime.max
+
+
+class FakeClient:
+    """Fake `gspread.Client`."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.auth = FakeAuth()
+        self.session = None
+
+    def open_by_key(self, key):
+        """Open a spreadsheet (one metadata call)."""
+        self.backend.call("open_by_key")
+        try:
+            spreadsheet = self.backend.spreadsheets[key]
+        except KeyError:
+            raise gspread.exceptions.SpreadsheetNotFound(key)
+        spreadsheet.client = self
+        return spreadsheet
+
+
+class FakeSpreadsheet:
+    """Fake `gspread.Spreadsheet`."""
+
+    def __init__(self, backend, key, title):
+        self.backend = backend
+        self.client = None
+        self.id = key
+        self.title = title
+        self._worksheets = collections.OrderedDict()
+
+    def create_worksheet(self, title, rows=1000, cols=26):
+        """Add a worksheet without accounting for an API call (for setup)."""
+        worksheet = FakeWorksheet(self, len(self._worksheets), title, rows, cols)
+        self._worksheets[title] = worksheet
+        return worksheet
+
+    def worksheets(self):
+        """List the worksheets."""
+        self.backend.call("worksheets")
+        return list(self._worksheets.values())
+
+    def worksheet(self, title):
+        """Get a worksheet by title."""
+        self.backend.call("worksheet")
+        try:
+            return self._worksheets[title]
+        except KeyError:
+            raise gspread.exceptions.WorksheetNotFound(title)
+
+    def add_worksheet(self, title, rows, cols):
+        """Add a worksheet."""
+        self.backend.call("add_worksheet")
+        if title in self._worksheets:
+            raise gspread.exceptions.APIError(
+                FakeResponse(400, "A sheet with the name {} already exists".format(title)))
+        return self.create_worksheet(title, int(rows), int(cols))
+
+    def _resolve_range(self, range_name):
+        match = RANGE_REGEX.match(range_name)
+        if not match:
+            raise ValueError("Range without sheet name -> {}".format(range_name))
+        quoted, plain, cells = match.groups()
+        title = quoted.replace("''", "'") if quoted is not None else plain
+        return self._worksheets[title], cells
+
+    def values_update(self, range_name, params=None, body=None):
+        """Write a block of values."""
+        self.backend.call("values_update")
+        worksheet, cells = self._resolve_range(range_name)
+        worksheet.set_values(cells, body["values"])
+        return {"updatedRange": range_name}
+
+    def values_batch_update(self, params=None, body=None):
+        """Write several blocks of values."""
+        self.backend.call("values_batch_update")
+        for data in body["data"]:
+            worksheet, cells = self._resolve_range(data["range"])
+            worksheet.set_values(cells, data["values"])
+        return {"totalUpdatedRows": sum(len(data["values"]) for data in body["data"])}
+
+
+class FakeCell:
+    """Fake `gspread.Cell`."""
+
+    def __init__(self, row, col, value):
+        self.row = row
+        self.col = col
+        self.value = value
+
+
+class FakeWorksheet:
+    """Fake `gspread.Worksheet`."""
+
+    def __init__(self, spreadsheet, sheet_id, title, rows, cols):
+        self.spreadsheet = spreadsheet
+        self.id = sheet_id
+        self.title = title
+        self.row_count = rows
+        self.col_count = cols
+        self.frozen_rows = 0
+        self.cells = {}
+
+    @property
+    def client(self):
+        """Client of the spreadsheet."""
+        return self.spreadsheet.client
+
+    @property
+    def backend(self):
+        """Backend accounting the calls."""
+        return self.spreadsheet.backend
+
+    # Local (not accounted) helpers
+    def set_values(self, first_cell, values):
+        """Write a block of values starting at (or covering) the given range."""
+        row, col = a1_to_rowcol(first_cell.split(":")[0])
+        for row_offset, row_values in enumerate(values):
+            for col_offset, value in enumerate(row_values):
+                if value is None:
+                    continue
+                self.cells[(row + row_offset, col + col_offset)] = value
+
+    def value(self, row, col):
+        """Evaluated value of a cell."""
+        raw = self.cells.get((row, col), "")
+        if isinstance(raw, str):
+            match = COUNT_REGEX.match(raw)
+            if match:
+                return str(self._count(*match.groups()))
+        return raw
+
+    def _count(self, first_col, first_row, last_col, last_row):
+        first_col = a1_to_rowcol(first_col + "1")[1]
+        last_col = a1_to_rowcol(last_col + "1")[1]
+        first_row = int(first_row)
+        last_row = int(last_row) if last_row else None
+        return sum(1 for (row, col), value in self.cells.items()
+                   if first_col <= col <= last_col and row >= first_row
+                   and (last_row is None or row <= last_row) and _is_number(value))
+
+    # API calls
+    def acell(self, label, value_render_option="FORMATTED_VALUE"):
+        """Get a cell by its A1 label."""
+        self.backend.call("acell")
+        row, col = a1_to_rowcol(label)
+        if value_render_option == "FORMULA":
+            return FakeCell(row, col, self.cells.get((row, col), ""))
+        return FakeCell(row, col, self.value(row, col))
+
+    def update_acell(self, label, value):
+        """Set a cell by its A1 label."""
+        self.backend.call("update_acell")
+        row, col = a1_to_rowcol(label)
+        self.cells[(row, col)] = value
+
+    def update_cell(self, row, col, value):
+        """Set a cell by row and column."""
+        self.backend.call("update_cell")
+        self.cells[(row, col)] = value
+
+    def update(self, range_name, values=None, **kwargs):
+        """Write a block of values (through the spreadsheet values API)."""
+        return self.spreadsheet.values_update("'{}'!{}".format(self.title.replace("'", "''"), range_name),
+                                              params=kwargs, body={"values": values})
+
+    def get(self, range_name, **kwargs):
+        """Get the raw values of an open-ended range (eg, 'A:B' or 'A2:F')."""
+        self.backend.call("get")
+        (first_col, first_row), (last_col, _) = (OPEN_CELL_REGEX.match(cell).groups()
+                                                  for cell in range_name.split(":"))
+        first_row = int(first_row or 1)
+        first_col = a1_to_rowcol(first_col + "1")[1]
+        last_col = a1_to_rowcol(last_col + "1")[1]
+        rows = [row for (row, col) in self.cells if first_col <= col <= last_col and row >= first_row]
+        if not rows:
+            return []
+        return [[self.cells.get((row, col), "") for col in range(first_col, last_col + 1)]
+                for row in range(first_row, max(rows) + 1)]
+
+    def col_values(self, col):
+        """Get the values of a column, up to the last non-empty cell."""
+        self.backend.call("col_values")
+        rows = [row for (row, cell_col) in self.cells if cell_col == col]
+        if not rows:
+            return []
+        return [self.value(row, col) for row in range(1, max(rows) + 1)]
+
+    def delete_rows(self, start_index, end_index=None):
+        """Delete rows, moving the rows below them up."""
+        self.backend.call("delete_rows")
+        end_index = end_index or start_index
+        deleted = end_index - start_index + 1
+        self.cells = {(row - deleted if row > end_index else row, col): value
+                      for (row, col), value in self.cells.items()
+                      if not start_index <= row <= end_index}
+
+    def freeze(self, rows=None, cols=None):
+        """Freeze rows and columns."""
+        self.backend.call("freeze")
+        if rows is not None:
+            self.frozen_rows = rows
+
+    def rows(self):
+        """Evaluated values of all rows, as a list of lists (not accounted)."""
+        if not self.cells:
+            return []
+        max_row = max(row for row, _ in self.cells)
+        max_col = max(col for _, col in self.cells)
+        return [[self.value(row, col) for col in range(1, max_col + 1)]
+                for row in range(1, max_row + 1)]
+
+
+def _is_number(value):
+    """Check if a user-entered value would be numeric in GSheets."""
+    if isinstance(value, (int, float)):
+        return True
+    if not isinstance(value, str) or not value:
+        return False
+    if value.startswith("="):
+        # Formulas written by the bot evaluate to numbers
+        return True
+    if DATE_REGEX.match(value):
+        return True
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+
+# EOF
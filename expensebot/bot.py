@@ -7,38 +7,365 @@
 # =============================================================================
 """First take at bot."""
 
-from functools import wraps
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
 
 import logging
+import os
+import re
+import threading
+import time
+from urllib.parse import urlparse
 
 import datetime
 
-import telegram
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
-
-from expensebot.messages import ExpenseParser, ParseError
+from expensebot.config import data_path, user_config
+from expensebot.messages import ParseError, find_dates, preload
+from expensebot.rates import SERIAL_EPOCH, filter_formula, rate_sheet_name
+from expensebot.stats import STATS, MetricsServer
+from expensebot.summary import parse_amount, parse_month
+from expensebot.tenants import (
+    CURRENCY_COLS,
+    MAX_TENANTS,
+    Tenant,
+    TenantCache,
+    UserPreferences,
+)
 
 import expensebot.gsheet as gsheet
 
+# telegram, the journal, the ledger, the asyncio runtime and the webhook server
+# are only imported when used, so that offline uses (eg, imports) start faster
+
+
+MONTH_WORKSHEET_REGEX = re.compile(r"^\d{2}/\d{4}$")
+
+Expense = namedtuple("Expense", ["concept", "value", "currency", "category", "date"])
+# Default and maximum number of entries listed by /last
+LAST_COUNT = 5
+LAST_MAX = 50
+# Reads of a month worksheet for /summary, if expenses are added while reading
+RECONCILE_ATTEMPTS = 3
+
+
+def tenant_key(tenant):
+    """Key of a tenant in the journal and the ledger."""
+    return None if tenant.key is None else str(tenant.key)
+
+
+def describe_entry(entry):
+    """Describe a ledger entry for the user."""
+    fields = entry.fields
+    if entry.kind == "investment":
+        text = "investment of {} ({} units) to fund {}".format(
+            fields["cost"], fields["units"], fields["fund"]
+        )
+    else:
+        text = "expense of {} {} in '{}' in category '{}'".format(
+            fields["value"], fields["currency"], fields["concept"], fields["category"]
+        )
+    return "{} on {} ({}, row {})".format(
+        text, fields["date"].strftime("%d/%m/%Y"), entry.worksheet, entry.row
+    )
+
+
+def row_matches(entry, values):
+    """Check that a row still holds the date, concept and value of a ledger entry.
+
+    Arguments:
+        entry (LedgerEntry): Entry the row was written for.
+        values (list): Unformatted values of the row (columns A to F).
+
+    """
+    fields = entry.fields
+    if entry.kind == "investment":
+        date_col, name_col, value_col = 0, 1, 2
+        name, amount = fields["fund"], parse_amount(fields["cost"])
+    else:
+        currency, amount = fields["amount"]
+        date_col, name_col, value_col = 1, 0, CURRENCY_COLS[currency] - 1
+        name = fields["concept"]
+    if len(values) <= max(date_col, name_col, value_col):
+        return False
+    try:
+        if abs(parse_amount(values[value_col]) - amount) >= 0.005:
+            return False
+    except ValueError:
+        return False
+    date = values[date_col]
+    if isinstance(date, (int, float)):
+        # Serial number, if Sheets understood the date
+        date_matches = (
+            SERIAL_EPOCH + datetime.timedelta(days=int(date)) == fields["date"].date()
+        )
+    else:
+        date_matches = str(date).startswith(fields["date"].strftime("%d/%m/%Y"))
+    return date_matches and str(values[name_col]).strip() == name.strip()
+
+
+def init_expense_worksheet(sheet, index=None):
+    """Write the header of a new month expense worksheet, in a single update.
+
+    The worksheet is invalidated in `index` (see `gsheet.update_rows`) if the
+    header cannot be written.
+
+    """
+    gsheet.update_rows(
+        sheet,
+        1,
+        [["Concepto", "Fecha", "CHF", "EUR", "Valor", "Categoria", "=COUNT(C2:D)"]],
+        index=index,
+    )
+    gsheet.api_call("freeze", sheet.freeze, rows=1)
 
-CURRENCY_COLS = {"CHF": 3, "EUR": 4}
+
+def init_invest_worksheet(sheet, index=None):
+    """Write the header of a new yearly trades worksheet, in a single update."""
+    gsheet.update_rows(
+        sheet,
+        1,
+        [["Concepto", "Fecha", "Cost", "Number of units", "=COUNT(A2:A)"]],
+        index=index,
+    )
 
 
 class ExpenseBot:
-    """Telegram bot for expense tracking."""
+    """Telegram bot for expense tracking.
+
+    Users listed in the `users` section of the configuration have their own
+    spreadsheets and settings (see `Tenant`), the rest of the authorized users
+    share the global ones.
+
+    """
+
+    def __init__(self, bot_config, offline=False):
+        """Initialize the updater.
 
-    def __init__(self, bot_config):
-        """Initialize the updater."""
+        Arguments:
+            bot_config (dict): Configuration.
+            offline (bool): Don't set up the Telegram side (eg, to import expenses).
+
+        """
         self._config = bot_config
-        self._updater = self.create_bot()
-        self._authorized_ids = bot_config["credentials"]["telegram"]["authorized-ids"]
-        categories = self.get_expense_categories()
-        self._parser = ExpenseParser(categories)
-        self._ref_currency = bot_config.get("currency", {}).get("reference", "CHF")
-        self._default_currency = bot_config.get("currency", {}).get("default", "CHF")
+        gsheet.configure_scheduler(bot_config)
+        self._updater = None if offline else self.create_bot()
+        self._users = {int(user_id) for user_id in bot_config.get("users") or {}}
+        self._authorized_ids = (
+            set(bot_config["credentials"]["telegram"]["authorized-ids"]) | self._users
+        )
+        self._tenant = self.create_tenant()
+        self._tenants = TenantCache(
+            self.create_tenant,
+            max_size=bot_config.get("max-tenants", MAX_TENANTS),
+            on_evict=self.evict_tenant,
+        )
+        self._preferences = TenantCache(
+            self.create_preferences,
+            max_size=bot_config.get("max-tenants", MAX_TENANTS),
+        )
+        self._ledger = self.create_ledger()
+        self._undo_lock = threading.Lock()
+        self._flusher = self.create_flusher()
+        self._write_pool = ThreadPoolExecutor(
+            max_workers=bot_config.get("write-workers", 4),
+            thread_name_prefix="sheet-writer",
+        )
+        self._background = ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="background"
+        )
+        self._runtime = self.create_runtime()
+        self._prewarmer = self.create_prewarmer()
+
+    def create_tenant(self, user_id=None):
+        """Create the settings and caches of a user, or the global ones if no user is given."""
+        config = self._config if user_id is None else user_config(self._config, user_id)
+        return Tenant(
+            user_id,
+            config,
+            lambda tenant, year: self.get_expense_categories(year=year, tenant=tenant),
+        )
+
+    def tenant(self, user_id=None):
+        """Get the settings and caches of a user.
+
+        Users without their own configuration get the global ones. The
+        categories of a user are refreshed in the background when stale.
+
+        """
+        if user_id is None or user_id not in self._users:
+            return self._tenant
+        tenant = self._tenants.get(user_id)
+        if tenant.categories.is_stale():
+            tenant.categories.schedule_refresh(self._background)
+        return tenant
+
+    def create_preferences(self, user_id):
+        """Load the settings a user changed through the bot."""
+        return UserPreferences(
+            os.path.join(
+                user_config(self._config, user_id)["data-dir"], "preferences.json"
+            )
+        )
+
+    def preferences(self, user_id):
+        """Get the settings a user changed through the bot."""
+        return self._preferences.get(user_id)
+
+    def default_currency(self, user_id=None, tenant=None):
+        """Currency of the expenses of a user given without one.
+
+        It's the one chosen by the user with /setCurrency, or the one in the
+        configuration of the user.
+
+        """
+        tenant = tenant or self.tenant(user_id)
+        if user_id is None:
+            return tenant.default_currency
+        currency = self.preferences(user_id).get("default-currency")
+        if not currency or currency.upper() not in tenant.currencies:
+            return tenant.default_currency
+        return currency
+
+    def set_default_currency(self, user_id, currency):
+        """Change the default currency of a user, and only of that user.
+
+        Raise:
+            ValueError: If the currency is not supported.
+
+        """
+        if currency.upper() not in self.tenant(user_id).currencies:
+            raise ValueError("Unknown currency {}".format(currency))
+        self.preferences(user_id).set("default-currency", currency.upper())
+
+    def evict_tenant(self, tenant):
+        """Forget the cached spreadsheets of a user dropped from memory, unless still in use."""
+        in_use = self._tenant.spreadsheet_ids().union(
+            *(other.spreadsheet_ids() for other in self._tenants.tenants())
+        )
+        for spreadsheet_id in tenant.spreadsheet_ids() - in_use:
+            gsheet.forget_spreadsheet(spreadsheet_id)
+
+    def create_runtime(self):
+        """Create the asyncio handler runtime, if enabled in the config."""
+        runtime_config = self._config.get("async-runtime", {})
+        if not runtime_config.get("enabled", False):
+            return None
+        from expensebot.runtime import (  # pylint: disable=import-outside-toplevel
+            AsyncRuntime,
+            MAX_CONCURRENCY,
+        )
+
+        return AsyncRuntime(
+            max_concurrency=runtime_config.get("max-concurrency", MAX_CONCURRENCY),
+            workers=runtime_config.get("workers"),
+        )
+
+    def create_flusher(self):
+        """Create the write-behind journal flusher, if enabled in the config."""
+        write_behind = self._config.get("write-behind", {})
+        if not write_behind.get("enabled", False):
+            return None
+        from expensebot.journal import (  # pylint: disable=import-outside-toplevel
+            ExpenseJournal,
+            JournalFlusher,
+        )
+
+        journal_path = write_behind.get("journal")
+        if journal_path:
+            journal_path = os.path.expanduser(journal_path)
+        else:
+            journal_path = data_path(self._config, "journal.sqlite")
+        journal = ExpenseJournal(journal_path)
+        logging.info(
+            "Using write-behind journal %s (%s pending)", journal_path, len(journal)
+        )
+        return JournalFlusher(
+            journal,
+            lambda spreadsheet_id, expenses, tenant, user_id: self.write_expenses(
+                expenses,
+                spreadsheet_id,
+                tenant=self.tenant(int(tenant) if tenant else None),
+                user_id=user_id,
+            ),
+            batch_size=write_behind.get("batch-size", 50),
+            interval=write_behind.get("flush-interval", 5),
+            workers=write_behind.get("workers", 4),
+            on_failure=self.journal_failed,
+        )
+
+    def journal_failed(self, entries):
+        """Handle the queued expenses given up on by the journal flusher.
+
+        They are no longer duplicates, since the users are told to send them again.
+
+        """
+        if self._ledger is not None:
+            for _, _, tenant, _, expense, _ in entries:
+                self._ledger.release(tenant, [expense])
+        self.notify_failed(entries)
+
+    def notify_failed(self, entries):
+        """Tell the users about the queued expenses that could not be written."""
+        for _, _, _, chat_id, expense, error in entries:
+            concept, value, currency, _, date = expense
+            text = (
+                "Writing expense of {} {} in '{}' on {} failed -> {}\n"
+                "It was not added, please correct it and send it again".format(
+                    value, currency, concept, date.strftime("%d/%m/%Y"), error
+                )
+            )
+            if not self._updater or not chat_id:
+                logging.warning("Cannot tell about failed expense -> %s", text)
+                continue
+            try:
+                self._updater.bot.send_message(chat_id=chat_id, text=text)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Error telling about failed expense -> %s", text)
+
+    def create_prewarmer(self):
+        """Create the background preparation of coming months, if enabled in the config."""
+        prewarm_config = self._config.get("prewarm", {})
+        if not prewarm_config.get("enabled", True):
+            return None
+        from expensebot.prewarm import (  # pylint: disable=import-outside-toplevel
+            LEAD_DAYS,
+            PREWARM_INTERVAL,
+            Prewarmer,
+        )
+
+        return Prewarmer(
+            self.prewarm,
+            lead_days=prewarm_config.get("lead-days", LEAD_DAYS),
+            interval=prewarm_config.get("interval", PREWARM_INTERVAL),
+        )
+
+    def create_ledger(self):
+        """Create the ledger of written rows, if enabled in the config."""
+        ledger_config = self._config.get("ledger", {})
+        if not ledger_config.get("enabled", True):
+            return None
+        from expensebot.ledger import (  # pylint: disable=import-outside-toplevel
+            DUPLICATE_WINDOW,
+            ExpenseLedger,
+        )
+
+        ledger_path = ledger_config.get("path")
+        if ledger_path:
+            ledger_path = os.path.expanduser(ledger_path)
+        else:
+            ledger_path = data_path(self._config, "ledger.sqlite")
+        ledger = ExpenseLedger(
+            ledger_path, window=ledger_config.get("duplicate-window", DUPLICATE_WINDOW)
+        )
+        logging.info("Using ledger %s (%s rows)", ledger_path, len(ledger))
+        return ledger
 
     def create_bot(self, bot_config=None):
         """Create and configure the bot."""
+        # pylint: disable=import-outside-toplevel
+        import telegram
+        from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
 
         def restricted(func):
             @wraps(func)
@@ -54,56 +381,115 @@ class ExpenseBot:
 
             return wrapped
 
+        def offloaded(func):
+            """Run the handler on the async runtime, if enabled, timing it."""
+
+            @wraps(func)
+            def timed(update, context, *args, **kwargs):
+                with STATS.timer("handler." + func.__name__):
+                    return func(update, context, *args, **kwargs)
+
+            @wraps(func)
+            def wrapped(update, context, *args, **kwargs):
+                if not self._runtime:
+                    return timed(update, context, *args, **kwargs)
+                self._runtime.submit(
+                    update.effective_chat.id, timed, update, context, *args, **kwargs
+                )
+                return None
+
+            return wrapped
+
         @restricted
+        @offloaded
         def cb_ping(update, context):
             """Get started."""
             logging.debug("Got ping command")
             context.bot.send_message(chat_id=update.message.chat_id, text="Pong!")
 
         @restricted
+        @offloaded
         def cb_set_currency(update, context):
             """Set default currency."""
             currency = context.args[0]
             logging.debug("Setting default currency to %s", currency)
-            if currency in CURRENCY_COLS:
-                self._default_currency = currency
-                context.bot.send_message(
-                    chat_id=update.message.chat_id,
-                    text="Set default input currency to {}".format(currency),
-                )
-            else:
-                context.bot.send_message(
-                    chat_id=update.message.chat_id,
-                    text="Unknown currency {}".format(currency),
-                )
+            try:
+                self.set_default_currency(update.effective_user.id, currency)
+                out = "Set default input currency to {}".format(currency.upper())
+            except ValueError as error:
+                out = str(error)
+            context.bot.send_message(chat_id=update.message.chat_id, text=out)
 
         @restricted
+        @offloaded
         def cb_get_currency(update, context):
             """Get default currency."""
             logging.debug("Getting default currency")
             context.bot.send_message(
                 chat_id=update.message.chat_id,
-                text="Default input currency is {}".format(self._default_currency),
+                text="Default input currency is {}".format(
+                    self.default_currency(update.effective_user.id)
+                ),
             )
 
         @restricted
+        @offloaded
         def cb_categories(update, context):
-            """Get expense categories."""
+            """Get expense categories.
+
+            Answered from the cache, which is then refreshed in the background.
+
+            """
             logging.debug("Getting categories")
-            categories = self.get_expense_categories()
-            self._parser.set_categories(categories)
+            tenant = self.tenant(update.effective_user.id)
+            categories = tenant.categories.get()
+            tenant.categories.request_refresh()
+            if tenant is not self._tenant:
+                tenant.categories.schedule_refresh(self._background)
             context.bot.send_message(
-                chat_id=update.message.chat_id, text="\n".join(categories)
+                chat_id=update.message.chat_id,
+                text="\n".join(categories) or "Categories are being fetched, try again later",
             )
 
         @restricted
+        @offloaded
+        def cb_summary(update, context):
+            """Get the expense totals of a month."""
+            logging.debug("Getting summary of '%s'", " ".join(context.args))
+            try:
+                out = self.get_summary(
+                    " ".join(context.args), tenant=self.tenant(update.effective_user.id)
+                )
+            except ValueError as error:
+                out = "Getting summary failed -> {}".format(error)
+            except Exception as error:  # pylint: disable=broad-except
+                logging.exception("Error getting summary")
+                out = "Getting summary failed -> {}".format(error)
+            context.bot.send_message(chat_id=update.message.chat_id, text=out)
+
+        @restricted
+        @offloaded
+        def cb_stats(update, context):
+            """Get timing and API usage stats."""
+            logging.debug("Getting stats")
+            context.bot.send_message(
+                chat_id=update.message.chat_id,
+                text="```\n{}\n```".format(STATS.report()),
+                parse_mode=telegram.ParseMode.MARKDOWN,
+            )
+
+        @restricted
+        @offloaded
         def cb_test(update, context):
             """Test expense parsing."""
             expense_text = " ".join(context.args)
             logging.debug("Testing message '%s'", expense_text)
+            user_id = update.effective_user.id
             try:
                 concept, value, currency, category, date = self.parse_expense(
-                    expense_text
+                    expense_text,
+                    tenant=self.tenant(user_id),
+                    default_currency=self.default_currency(user_id),
                 )
                 value = "{} {}".format(value, currency)
                 out = (
@@ -120,12 +506,47 @@ class ExpenseBot:
             )
 
         @restricted
+        @offloaded
+        def cb_undo(update, context):
+            """Delete the last expense or investment added."""
+            logging.debug("Undoing last row")
+            user_id = update.effective_user.id
+            try:
+                entry = self.undo(tenant=self.tenant(user_id), user_id=user_id)
+                out = "Removed {}".format(describe_entry(entry))
+            except ValueError as error:
+                out = "Undo failed -> {}".format(error)
+            context.bot.send_message(chat_id=update.message.chat_id, text=out)
+
+        @restricted
+        @offloaded
+        def cb_last(update, context):
+            """List the last expenses and investments added."""
+            logging.debug("Listing last rows '%s'", " ".join(context.args))
+            try:
+                count = int(context.args[0]) if context.args else LAST_COUNT
+                if not 0 < count <= LAST_MAX:
+                    raise ValueError(
+                        "Number of entries must be between 1 and {}".format(LAST_MAX)
+                    )
+                entries = self.last_entries(count, user_id=update.effective_user.id)
+                out = "\n".join(describe_entry(entry) for entry in entries)
+                out = out or "Nothing added yet"
+            except ValueError as error:
+                out = "Listing last entries failed -> {}".format(error)
+            context.bot.send_message(chat_id=update.message.chat_id, text=out)
+
+        @restricted
+        @offloaded
         def cb_invest(update, context):
             """Add investment."""
             invest_text = " ".join(context.args)
             logging.debug("Got investment message -> %s", invest_text)
+            user_id = update.effective_user.id
             try:
-                fund_name, cost, total_units, date = self.add_investment(invest_text)
+                fund_name, cost, total_units, date = self.add_investment(
+                    invest_text, tenant=self.tenant(user_id), user_id=user_id
+                )
                 out = "Added investment of {} ({} units) to fund {} on {}".format(
                     cost, total_units, fund_name, date.strftime("%d/%m/%Y")
                 )
@@ -138,23 +559,41 @@ class ExpenseBot:
             )
 
         @restricted
+        @offloaded
         def cb_messages(update, context):
             """Answer text messages."""
             logging.debug("Got message")
-            out = ""
-            for expense_text in update.message.text.split("\n"):
+            expense_texts = update.message.text.split("\n")
+            for expense_text in expense_texts:
                 logging.info("Got expense -> %s", expense_text)
-                try:
-                    concept, value, category, date = self.add_expense(expense_text)
-                    if out:
-                        out += "\n"
-                    out += "Added expense of {} in '{}' in category '{}' on {}".format(
-                        value, concept, category, date.strftime("%d/%m/%Y")
+            lines = []
+            user_id = update.effective_user.id
+            tenant = self.tenant(user_id)
+            for result in self.add_expenses(
+                expense_texts,
+                tenant=tenant,
+                chat_id=update.message.chat_id,
+                default_currency=self.default_currency(user_id, tenant),
+                user_id=user_id,
+            ):
+                if isinstance(result, Exception):
+                    lines.append("Adding expense failed -> {}".format(result))
+                    continue
+                concept, value, category, date = result
+                lines.append(
+                    "{} expense of {} in '{}' in category '{}' on {}".format(
+                        "Queued" if self._flusher else "Added",
+                        value,
+                        concept,
+                        category,
+                        date.strftime("%d/%m/%Y"),
                     )
-                    if category == "Undefined":
-                        out += "\n*Category is undefined, you will need to correct this manually*"
-                except ValueError as error:
-                    out += "Adding expense failed -> {}".format(error)
+                )
+                if category == "Undefined":
+                    lines.append(
+                        "*Category is undefined, you will need to correct this manually*"
+                    )
+            out = "\n".join(lines)
             context.bot.send_message(
                 chat_id=update.message.chat_id,
                 text=out,
@@ -167,11 +606,17 @@ class ExpenseBot:
         # Add start command handler
         updater.dispatcher.add_handler(CommandHandler("ping", cb_ping))
         updater.dispatcher.add_handler(CommandHandler("categories", cb_categories))
+        updater.dispatcher.add_handler(CommandHandler("stats", cb_stats))
+        updater.dispatcher.add_handler(
+            CommandHandler("summary", cb_summary, pass_args=True)
+        )
         updater.dispatcher.add_handler(
             CommandHandler("setCurrency", cb_set_currency, pass_args=True)
         )
         updater.dispatcher.add_handler(CommandHandler("getCurrency", cb_get_currency))
         updater.dispatcher.add_handler(CommandHandler("test", cb_test, pass_args=True))
+        updater.dispatcher.add_handler(CommandHandler("undo", cb_undo))
+        updater.dispatcher.add_handler(CommandHandler("last", cb_last, pass_args=True))
         updater.dispatcher.add_handler(
             CommandHandler("invest", cb_invest, pass_args=True)
         )
@@ -179,14 +624,17 @@ class ExpenseBot:
         updater.dispatcher.add_handler(MessageHandler(Filters.text, cb_messages))
         return updater
 
-    def get_expense_categories(self, spreadsheet_id=None):
-        """Load expense categories from GSheets."""
+    def get_expense_categories(self, spreadsheet_id=None, year=None, tenant=None):
+        """Load expense categories of a year (the current one by default) from GSheets."""
+        tenant = tenant or self._tenant
         if not spreadsheet_id:
-            spreadsheet_id = self._config["nw-sheet"]
-        spreadsheet = gsheet.authorize(self._config).open_by_key(spreadsheet_id)
-        sheet = spreadsheet.worksheet(f"{datetime.datetime.today().year} Gastos")
+            spreadsheet_id = tenant.config["nw-sheet"]
+        if not year:
+            year = datetime.datetime.today().year
+        spreadsheet = gsheet.open_spreadsheet(tenant.config, spreadsheet_id)
+        sheet = gsheet.api_call("worksheet", spreadsheet.worksheet, f"{year} Gastos")
         cats = []
-        for row_num, val in enumerate(sheet.col_values(1)):
+        for row_num, val in enumerate(gsheet.api_call("col_values", sheet.col_values, 1)):
             if val == "Total gastos":
                 break
             if not val or row_num == 0:
@@ -194,76 +642,531 @@ class ExpenseBot:
             cats.append(val)
         return cats
 
-    def parse_expense(self, expense_text):
-        """Parse and interpret expense text."""
+    def refresh_categories(self, tenant=None):
+        """Fetch the expense categories now instead of waiting for the background refresh."""
+        return (tenant or self._tenant).categories.refresh()
+
+    def prewarm(self, date):
+        """Prepare the worksheets and categories of a date for the users in memory."""
+        for tenant in [self._tenant] + self._tenants.tenants():
+            try:
+                self.prewarm_tenant(date, tenant)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception(
+                    "Error preparing %s for user %s", date.strftime("%m/%Y"), tenant.key
+                )
+
+    def prewarm_tenant(self, date, tenant=None):
+        """Create the worksheets a date needs and fetch the categories of its year.
+
+        Worksheets that already exist are found in the worksheet index, so
+        preparing a date again doesn't make any GSheets calls.
+
+        """
+        tenant = tenant or self._tenant
+        with STATS.timer("bot.prewarm"):
+            spreadsheet = gsheet.open_spreadsheet(
+                tenant.config, tenant.config["expenses-sheet"]
+            )
+            gsheet.get_worksheet(
+                spreadsheet,
+                date.strftime("%m/%Y"),
+                True,
+                partial(init_expense_worksheet, index=tenant.worksheets),
+                index=tenant.worksheets,
+            )
+            if date.year == datetime.date.today().year:
+                tenant.categories.check_year()
+                return
+            # A new year is coming
+            tenant.categories.prefetch(date.year)
+            if tenant.config.get("investment-sheet"):
+                spreadsheet = gsheet.open_spreadsheet(
+                    tenant.config, tenant.config["investment-sheet"]
+                )
+                gsheet.get_worksheet(
+                    spreadsheet,
+                    "{} Trades".format(date.year),
+                    True,
+                    partial(init_invest_worksheet, index=tenant.worksheets),
+                    index=tenant.worksheets,
+                )
+
+    def build_expense(
+        self, concept, value, currency=None, category_text=None, date=None, tenant=None
+    ):
+        """Build an expense from already split fields (eg, columns of an export).
+
+        The category is matched from the concept and category text like in
+        parsed messages.
+
+        """
+        tenant = tenant or self._tenant
+        if currency and currency.upper() not in tenant.currencies:
+            raise ValueError("Unknown currency {}".format(currency))
+        category = tenant.parser.get_category(concept, category_text or "")
+        return self._complete_expense(
+            tenant.default_currency, concept, value, currency, category, date
+        )
+
+    def parse_expense(self, expense_text, tenant=None, default_currency=None):
+        """Parse and interpret expense text.
+
+        Expenses without currency get `default_currency`, or the default one
+        of the tenant if not given.
+
+        """
+        tenant = tenant or self._tenant
         try:
-            concept, value, currency, category, date = self._parser.parse(expense_text)
+            concept, value, currency, category, date = tenant.parser.parse(expense_text)
         except ParseError as error:
             raise ValueError("I don't understand the expense text -> {}".format(error))
+        return self._complete_expense(
+            default_currency or tenant.default_currency,
+            concept,
+            value,
+            currency,
+            category,
+            date,
+        )
+
+    @staticmethod
+    def _complete_expense(default_currency, concept, value, currency, category, date):
+        """Fill in the default currency, date and category."""
         if not currency:
-            currency = self._default_currency
+            currency = default_currency
         if not date:
             date = datetime.datetime.today()
         if not category:
             logging.warning("Couldn't determine expense category, setting to Undefined")
             category = "Undefined"
-        return concept, value, currency, category, date
-
-    def add_expense(self, expense_text, spreadsheet_id=None):
-        """Add expense to corresponding sheet."""
-
-        def init_expense_worksheet(sheet):
-            sheet.update_acell("A1", "Concepto")
-            sheet.update_acell("B1", "Fecha")
-            sheet.update_acell("C1", "CHF")
-            sheet.update_acell("D1", "EUR")
-            sheet.update_acell("E1", "Valor")
-            sheet.update_acell("F1", "Categoria")
-            sheet.update_acell("G1", "=COUNT(C2:D)")
-            sheet.freeze(rows=1)
-
-        concept, value, currency, category, date = self.parse_expense(expense_text)
+        return Expense(concept, value, currency, category, date)
+
+    def add_expense(self, expense_text, spreadsheet_id=None, tenant=None):
+        """Add expense to corresponding sheet.
+
+        If write-behind is enabled, the expense is stored in the local journal
+        and written to the sheet in the background.
+
+        """
+        result = self.add_expenses([expense_text], spreadsheet_id, tenant)[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def add_expenses(
+        self,
+        expense_texts,
+        spreadsheet_id=None,
+        tenant=None,
+        chat_id=None,
+        default_currency=None,
+        user_id=None,
+    ):
+        """Add several expenses at once.
+
+        All texts are parsed first (see `parse_expense` for `default_currency`),
+        and the valid expenses are then written with one call per month
+        worksheet (see `write_expenses`), or queued if write-behind is enabled.
+        Queued expenses are checked for what can be checked without writing
+        (their conversion rate); if they later fail to be written, `chat_id` is
+        told.
+
+        Return:
+            list: For each text, in order, either a (concept, value, category, date)
+                tuple or the exception that prevented adding it.
+
+        """
+        with STATS.timer("bot.add_expenses"):
+            output = self._add_expenses(
+                expense_texts,
+                spreadsheet_id,
+                tenant or self._tenant,
+                chat_id,
+                default_currency,
+                user_id,
+            )
+        for result in output:
+            STATS.incr(
+                "expenses.failed" if isinstance(result, Exception) else "expenses.added"
+            )
+        return output
+
+    def _add_expenses(
+        self, expense_texts, spreadsheet_id, tenant, chat_id, default_currency, user_id
+    ):
+        results = []
+        for expense_text in expense_texts:
+            try:
+                results.append(
+                    self.parse_expense(expense_text, tenant, default_currency)
+                )
+            except ValueError as error:
+                results.append(error)
+        if not spreadsheet_id:
+            spreadsheet_id = tenant.config["expenses-sheet"]
+        if self._flusher:
+            self._check_rates(results, spreadsheet_id, tenant)
+        self._suppress_duplicates(results, tenant)
+        expenses = [result for result in results if isinstance(result, Expense)]
+        if self._flusher:
+            for expense in expenses:
+                self._flusher.journal.append(
+                    spreadsheet_id, expense, tenant_key(tenant), chat_id, user_id
+                )
+            self._flusher.wake()
+            errors = iter([None] * len(expenses))
+        else:
+            errors = self.write_expenses(expenses, spreadsheet_id, tenant, user_id)
+            if self._ledger is not None:
+                self._ledger.release(
+                    tenant_key(tenant),
+                    [
+                        expense
+                        for expense, error in zip(expenses, errors)
+                        if error is not None
+                    ],
+                )
+            errors = iter(errors)
+        output = []
+        for result in results:
+            if isinstance(result, Expense):
+                error = next(errors)
+                if error:
+                    result = error
+                else:
+                    concept, value, currency, category, date = result
+                    result = concept, "{} {}".format(value, currency), category, date
+            output.append(result)
+        return output
+
+    def _check_rates(self, results, spreadsheet_id, tenant):
+        """Replace the expenses that cannot be converted to the reference currency by an error.
+
+        Only currencies without their own column need a known rate, so other
+        expenses are not checked. If the rates cannot be read, the expenses
+        are kept and checked again when written.
+
+        """
+        for position, result in enumerate(results):
+            if (
+                not isinstance(result, Expense)
+                or result.currency.upper() in CURRENCY_COLS
+            ):
+                continue
+            try:
+                spreadsheet = gsheet.open_spreadsheet(tenant.config, spreadsheet_id)
+                self.expense_rates(spreadsheet, result, tenant)
+            except ValueError as error:
+                results[position] = error
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Error checking the rate of %s", result)
+
+    def _suppress_duplicates(self, results, tenant):
+        """Replace the expenses repeating one added recently (eg, a re-sent message) by an error."""
+        positions = [
+            position
+            for position, result in enumerate(results)
+            if isinstance(result, Expense)
+        ]
+        if self._ledger is None or not self._ledger.window or not positions:
+            return
+        duplicates = self._ledger.accept(
+            tenant_key(tenant), [results[position] for position in positions]
+        )
+        for position, duplicate in zip(positions, duplicates):
+            if duplicate is not None:
+                STATS.incr("expenses.duplicate")
+                results[position] = ValueError(
+                    "Ignoring duplicate of the expense added at {}".format(
+                        time.strftime("%H:%M:%S", time.localtime(duplicate))
+                    )
+                )
+
+    def write_expenses(self, expenses, spreadsheet_id=None, tenant=None, user_id=None):
+        """Write parsed expenses, with one batched update per month worksheet.
+
+        Different month worksheets are written in parallel. The rows are
+        recorded in the ledger for the Telegram user `user_id`.
+
+        Return:
+            list: For each expense, the exception raised when writing it, or None
+                if it was written.
+
+        """
+        if not expenses:
+            return []
+        with STATS.timer("bot.write_expenses"):
+            return self._write_expenses(
+                expenses, spreadsheet_id, tenant or self._tenant, user_id
+            )
+
+    def _write_expenses(self, expenses, spreadsheet_id, tenant, user_id):
+        expenses = [Expense(*expense) for expense in expenses]
+        if not spreadsheet_id:
+            spreadsheet_id = tenant.config["expenses-sheet"]
+        try:
+            spreadsheet = gsheet.open_spreadsheet(tenant.config, spreadsheet_id)
+        except Exception as error:  # pylint: disable=broad-except
+            return [error] * len(expenses)
+        by_worksheet = {}
+        for index, expense in enumerate(expenses):
+            by_worksheet.setdefault(expense.date.strftime("%m/%Y"), []).append(index)
+        if len(by_worksheet) == 1:
+            outcomes = [
+                self._write_worksheet_expenses(
+                    tenant, spreadsheet, worksheet_name, expenses, indices, user_id
+                )
+                for worksheet_name, indices in by_worksheet.items()
+            ]
+        else:
+            outcomes = list(
+                self._write_pool.map(
+                    lambda item: self._write_worksheet_expenses(
+                        tenant, spreadsheet, item[0], expenses, item[1], user_id
+                    ),
+                    by_worksheet.items(),
+                )
+            )
+        errors = [None] * len(expenses)
+        for indices, worksheet_errors in zip(by_worksheet.values(), outcomes):
+            for index, error in zip(indices, worksheet_errors):
+                errors[index] = error
+        if tenant.memory is not None:
+            tenant.memory.learn(
+                (expense.concept, expense.category)
+                for expense, error in zip(expenses, errors)
+                if not error and expense.category != "Undefined"
+            )
+            tenant.memory.save()
+        tenant.summary.save()
+        return errors
+
+    def bootstrap_category_memory(self, spreadsheet_id=None, tenant=None):
+        """Fill the category memory from the existing month worksheets.
+
+        Each worksheet is read with a single call.
+
+        """
+        tenant = tenant or self._tenant
+        if not spreadsheet_id:
+            spreadsheet_id = tenant.config["expenses-sheet"]
+        spreadsheet = gsheet.open_spreadsheet(tenant.config, spreadsheet_id)
+        for worksheet in gsheet.api_call("worksheets", spreadsheet.worksheets):
+            if not MONTH_WORKSHEET_REGEX.match(worksheet.title):
+                continue
+            rows = gsheet.api_call("get", worksheet.get, "A2:F")
+            tenant.memory.learn(
+                (row[0], row[5])
+                for row in rows
+                if len(row) > 5 and row[5] and row[5] != "Undefined"
+            )
+            logging.debug("Learned %s expenses of %s", len(rows), worksheet.title)
+        tenant.memory.save()
+        logging.info("Bootstrapped category memory with %s concepts", len(tenant.memory))
+
+    def _write_worksheet_expenses(
+        self, tenant, spreadsheet, worksheet_name, expenses, indices, user_id=None
+    ):
+        """Write the given expenses to one month worksheet.
+
+        Return:
+            list: For each of the indices, the error writing the expense, or None.
+
+        """
+        errors = [None] * len(indices)
+        try:
+            # Rates are loaded before reserving rows, so no rows are held while reading
+            rates = {}
+            for position, index in enumerate(indices):
+                try:
+                    rates[index] = self.expense_rates(
+                        spreadsheet, expenses[index], tenant
+                    )
+                except ValueError as error:
+                    errors[position] = error
+            to_write = [index for index in indices if index in rates]
+            if not to_write:
+                return errors
+            worksheet = gsheet.get_worksheet(
+                spreadsheet,
+                worksheet_name,
+                True,
+                partial(init_expense_worksheet, index=tenant.worksheets),
+                index=tenant.worksheets,
+            )
+            if not worksheet:
+                logging.error("Error getting worksheet %s", worksheet_name)
+                raise ValueError("Error getting worksheet -> {}".format(worksheet_name))
+            with gsheet.reserve_rows(worksheet, len(to_write), "G1") as first_row:
+                gsheet.update_rows(
+                    worksheet,
+                    first_row,
+                    [
+                        self.expense_row(
+                            first_row + offset,
+                            *expenses[index],
+                            rates=rates[index],
+                            tenant=tenant
+                        )
+                        for offset, index in enumerate(to_write)
+                    ],
+                    index=tenant.worksheets,
+                )
+                amounts = [
+                    self.sheet_amount(expenses[index], rates[index], tenant)
+                    for index in to_write
+                ]
+                if self._ledger is not None:
+                    # Recorded before other writers can move the rows (see undo)
+                    self._ledger.record(
+                        tenant_key(tenant),
+                        user_id,
+                        spreadsheet.id,
+                        worksheet_name,
+                        [
+                            (
+                                first_row + offset,
+                                "expense",
+                                dict(expenses[index]._asdict(), amount=amount),
+                            )
+                            for offset, (index, amount) in enumerate(
+                                zip(to_write, amounts)
+                            )
+                        ],
+                    )
+            for index, amount in zip(to_write, amounts):
+                tenant.summary.add(worksheet_name, expenses[index].category, *amount)
+        except Exception as error:  # pylint: disable=broad-except
+            logging.exception("Error writing expenses to %s", worksheet_name)
+            return [errors[position] or error for position in range(len(indices))]
+        return errors
+
+    def expense_rates(self, spreadsheet, expense, tenant=None):
+        """Get the rate table needed to convert an expense to the reference currency.
+
+        Return:
+            RateTable: The table, or None for expenses in the reference currency.
+
+        Raise:
+            ValueError: If the expense cannot be converted.
+
+        """
+        tenant = tenant or self._tenant
+        currency = expense.currency.upper()
+        if currency == tenant.ref_currency:
+            return None
+        rates = tenant.rates.get(spreadsheet, expense.date, currency, tenant.ref_currency)
+        if currency not in CURRENCY_COLS and rates.rate(expense.date) is None:
+            raise ValueError(
+                "No {}{} rate for {}".format(
+                    currency, tenant.ref_currency, expense.date.strftime("%d/%m/%Y")
+                )
+            )
+        return rates
+
+    def sheet_amount(self, expense, rates=None, tenant=None):
+        """Currency column and amount an expense is written with.
+
+        Return:
+            tuple: Currency and amount.
+
+        """
+        currency = expense.currency.upper()
+        if currency in CURRENCY_COLS:
+            return currency, parse_amount(expense.value)
+        ref_currency = (tenant or self._tenant).ref_currency
+        return ref_currency, parse_amount(expense.value) * rates.rate(expense.date)
+
+    def reconcile_summary(self, month, spreadsheet_id=None, tenant=None):
+        """Rebuild the totals of a month from its worksheet, with a single read.
+
+        Return:
+            bool: Whether the totals were rebuilt, which they are not if an
+                expense of the month was added or removed during the read.
+
+        """
+        tenant = tenant or self._tenant
         if not spreadsheet_id:
-            spreadsheet_id = self._config["expenses-sheet"]
-        spreadsheet = gsheet.authorize(self._config).open_by_key(spreadsheet_id)
-        worksheet_name = date.strftime("%m/%Y")
+            spreadsheet_id = tenant.config["expenses-sheet"]
+        version = tenant.summary.version(month)
+        spreadsheet = gsheet.open_spreadsheet(tenant.config, spreadsheet_id)
         worksheet = gsheet.get_worksheet(
-            spreadsheet, worksheet_name, True, init_expense_worksheet
+            spreadsheet, month, False, index=tenant.worksheets
         )
-        if not worksheet:
-            logging.error("Error getting worksheet %s", worksheet_name)
-            raise ValueError("Error getting worksheet -> {}".format(worksheet_name))
-        row_to_update = int(worksheet.acell("G1").value) + 2
-        worksheet.update_cell(row_to_update, 1, concept)
-        worksheet.update_cell(row_to_update, 2, date.strftime("%d/%m/%Y %H:%M:%S"))
-        col_to_update = CURRENCY_COLS[currency.upper()]
-        worksheet.update_cell(row_to_update, col_to_update, value)
-        value_cell = gsheet.gspread.utils.rowcol_to_a1(row_to_update, col_to_update)
-        if currency.upper() != self._ref_currency.upper():
-            index = ("{}{}".format(currency, self._ref_currency)).upper()
-            value_cell += (
-                "*IFNA("
-                "FILTER('{2} {0}'!B:B, MONTH('{2} {0}'!A:A) = MONTH(B{1}), DAY('{2} {0}'!A:A) = DAY(B{1})), "
-                "FILTER('{2} {0}'!B:B, MONTH('{2} {0}'!A:A) = MONTH(B{1}), DAY('{2} {0}'!A:A) = MINUS(DAY(B{1}), 1))"
-                ")".format(index, row_to_update, date.year)
+        rows = []
+        if worksheet:
+            rows = gsheet.api_call(
+                "get", worksheet.get, "A2:F", value_render_option="UNFORMATTED_VALUE"
             )
-        worksheet.update_cell(row_to_update, 5, "=" + value_cell)
-        worksheet.update_cell(row_to_update, 6, category)
-        return concept, "{} {}".format(value, currency), category, date
+        if not tenant.summary.reconcile(month, rows, CURRENCY_COLS, version):
+            return False
+        tenant.summary.save()
+        return True
 
-    def add_investment(self, investment_text, spreadsheet_id=None):
-        """Add investment in the corresponding sheet."""
+    def get_summary(self, month_text="", tenant=None):
+        """Get the summary of a month.
+
+        Answered from the local totals. A month never read from its worksheet
+        (eg, with totals of only the expenses added since the bot started keeping
+        them) is read first; stale totals are reconciled in the background.
 
-        def init_invest_worksheet(sheet):
-            sheet.update_acell("A1", "Concepto")
-            sheet.update_acell("B1", "Fecha")
-            sheet.update_acell("C1", "Cost")
-            sheet.update_acell("D1", "Number of units")
-            sheet.update_acell("E1", "=COUNT(A2:A)")
+        """
+        tenant = tenant or self._tenant
+        month = parse_month(month_text)
+        if not tenant.summary.known(month):
+            # Read again if an expense was added during the read
+            for _ in range(RECONCILE_ATTEMPTS):
+                if self.reconcile_summary(month, tenant=tenant):
+                    break
+        elif tenant.summary.needs_reconcile(month):
+            tenant.summary.schedule_reconcile(
+                self._background,
+                month,
+                lambda month: self.reconcile_summary(month, tenant=tenant),
+            )
+        return tenant.summary.report(month)
+
+    def expense_row(
+        self, row, concept, value, currency, category, date, rates=None, tenant=None
+    ):
+        """Build the cell values (columns A to F) of an expense row.
 
-        import datefinder
+        Values in a currency with its own column are converted to the reference
+        currency with a formula pointing to the rate worksheet (see
+        `RateTable.formula`). Values in other currencies are converted with the
+        known rate and written to the reference currency column.
 
-        found_dates = list(datefinder.find_dates(investment_text, source=True))
+        """
+        ref_currency = (tenant or self._tenant).ref_currency
+        currency = currency.upper()
+        values = [concept, date.strftime("%d/%m/%Y %H:%M:%S"), "", "", "", category]
+        if currency in CURRENCY_COLS:
+            col_to_update = CURRENCY_COLS[currency]
+            values[col_to_update - 1] = value
+        else:
+            col_to_update = CURRENCY_COLS[ref_currency]
+            values[col_to_update - 1] = "={}*{}".format(
+                value.replace(",", "."), rates.rate(date)
+            )
+        value_cell = gsheet.gspread.utils.rowcol_to_a1(row, col_to_update)
+        if currency in CURRENCY_COLS and currency != ref_currency:
+            date_cell = "B{}".format(row)
+            if rates is not None:
+                value_cell += "*" + rates.formula(date, date_cell)
+            else:
+                value_cell += "*" + filter_formula(
+                    rate_sheet_name(date.year, currency, ref_currency), date_cell
+                )
+        values[4] = "=" + value_cell
+        return values
+
+    def add_investment(
+        self, investment_text, spreadsheet_id=None, tenant=None, user_id=None
+    ):
+        """Add investment in the corresponding sheet."""
+        tenant = tenant or self._tenant
+        found_dates = find_dates(investment_text)
         if len(found_dates) > 1:
             logging.error("Found too many dates in text, ignoring -> %s", found_dates)
             date = None
@@ -279,25 +1182,157 @@ class ExpenseBot:
         *fund_name, cost, total_units = investment_text.split()
         fund_name = " ".join(fund_name)
         if not spreadsheet_id:
-            spreadsheet_id = self._config["investment-sheet"]
-        spreadsheet = gsheet.authorize(self._config).open_by_key(spreadsheet_id)
+            spreadsheet_id = tenant.config["investment-sheet"]
+        spreadsheet = gsheet.open_spreadsheet(tenant.config, spreadsheet_id)
         worksheet_name = "{} Trades".format(date.year)
         worksheet = gsheet.get_worksheet(
-            spreadsheet, worksheet_name, True, init_invest_worksheet
+            spreadsheet,
+            worksheet_name,
+            True,
+            partial(init_invest_worksheet, index=tenant.worksheets),
+            index=tenant.worksheets,
         )
         if not worksheet:
             logging.error("Error getting worksheet %s", worksheet_name)
             raise ValueError("Error getting worksheet -> {}".format(worksheet_name))
-        row_to_update = int(worksheet.acell("E1").value) + 2
-        worksheet.update_cell(row_to_update, 1, date.strftime("%d/%m/%Y %H:%M:%S"))
-        worksheet.update_cell(row_to_update, 2, fund_name)
-        worksheet.update_cell(3, cost)
-        worksheet.update_cell(3, total_units)
+        with gsheet.reserve_rows(worksheet, 1, "E1") as row_to_update:
+            gsheet.update_rows(
+                worksheet,
+                row_to_update,
+                [[date.strftime("%d/%m/%Y %H:%M:%S"), fund_name, cost, total_units]],
+                index=tenant.worksheets,
+            )
+            if self._ledger is not None:
+                self._ledger.record(
+                    tenant_key(tenant),
+                    user_id,
+                    spreadsheet.id,
+                    worksheet_name,
+                    [
+                        (
+                            row_to_update,
+                            "investment",
+                            {
+                                "fund": fund_name,
+                                "cost": cost,
+                                "units": total_units,
+                                "date": date,
+                            },
+                        )
+                    ],
+                )
         return fund_name, cost, total_units, date
 
-    def start(self):
-        """Start running."""
-        self._updater.start_polling()
+    def last_entries(self, count=LAST_COUNT, user_id=None):
+        """Get the last expenses and investments sent by a Telegram user, newest first."""
+        if self._ledger is None:
+            raise ValueError("The ledger is disabled")
+        return self._ledger.last(user_id, count)
+
+    def undo(self, tenant=None, user_id=None):
+        """Delete the row of the last expense or investment sent by a Telegram user.
+
+        Users without their own configuration share the spreadsheets of the
+        global one, so only the rows sent by `user_id` are considered.
+
+        The row is found in the ledger and read once before deleting it, so
+        it's kept if its date, concept or value changed (eg, if it was edited
+        or moved by hand). Rows below it move one up.
+
+        Return:
+            LedgerEntry: The removed entry.
+
+        Raise:
+            ValueError: If there is nothing to undo, or the row changed.
+
+        """
+        tenant = tenant or self._tenant
+        if self._ledger is None:
+            raise ValueError("The ledger is disabled")
+        if self._flusher and len(self._flusher.journal):
+            raise ValueError("Expenses are still being written, try again later")
+        with self._undo_lock:
+            entries = self._ledger.last(user_id)
+            if not entries:
+                raise ValueError("Nothing to undo")
+            entry = entries[0]
+            spreadsheet = gsheet.open_spreadsheet(tenant.config, entry.spreadsheet_id)
+            worksheet = gsheet.get_worksheet(
+                spreadsheet, entry.worksheet, False, index=tenant.worksheets
+            )
+            if not worksheet:
+                raise ValueError("Cannot find worksheet -> {}".format(entry.worksheet))
+            with gsheet.delete_row(
+                worksheet,
+                entry.row,
+                index=tenant.worksheets,
+                check=lambda values: row_matches(entry, values),
+            ):
+                self._ledger.remove(entry)
+        if entry.kind == "expense":
+            tenant.summary.remove(
+                entry.worksheet, entry.fields["category"], *entry.fields["amount"]
+            )
+            tenant.summary.save()
+        logging.info("Undid %s", describe_entry(entry))
+        return entry
+
+    def create_webhook(self):
+        """Create the webhook server and register its URL with Telegram."""
+        webhook_config = self._config.get("webhook", {})
+        if "url" not in webhook_config:
+            raise ValueError("Webhook mode needs webhook.url in the configuration")
+        from expensebot.webhook import (  # pylint: disable=import-outside-toplevel
+            WebhookServer,
+            QUEUE_SIZE,
+        )
+
+        url = webhook_config["url"]
+        secret = webhook_config.get("secret")
+        server = WebhookServer(
+            self._updater.dispatcher,
+            listen=webhook_config.get("listen", "127.0.0.1"),
+            port=webhook_config.get("port", 8443),
+            url_path=urlparse(url).path or "/",
+            secret_token=secret,
+            queue_size=webhook_config.get("queue-size", QUEUE_SIZE),
+        )
+        if secret:
+            self._updater.bot.set_webhook(url=url, secret_token=secret)
+        else:
+            self._updater.bot.set_webhook(url=url)
+        return server
+
+    def start(self, webhook=False):
+        """Start running, either polling for updates or receiving them by webhook."""
+        threading.Thread(target=preload, name="preload", daemon=True).start()
+        self._tenant.categories.start()
+        metrics_config = self._config.get("metrics", {})
+        if "port" in metrics_config:
+            MetricsServer(
+                listen=metrics_config.get("listen", "127.0.0.1"),
+                port=metrics_config["port"],
+            ).start()
+        if (
+            self._tenant.memory is not None
+            and not len(self._tenant.memory)
+            and self._config.get("category-memory", {}).get("bootstrap", False)
+        ):
+            threading.Thread(
+                target=self.bootstrap_category_memory,
+                name="category-memory-bootstrap",
+                daemon=True,
+            ).start()
+        if self._flusher:
+            self._flusher.start()
+        if self._prewarmer:
+            self._prewarmer.start()
+        if self._runtime:
+            self._runtime.start()
+        if webhook:
+            self.create_webhook().start()
+        else:
+            self._updater.start_polling()
 
 
 # EOF
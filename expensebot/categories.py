@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   categories.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Local cache of expense categories."""
+
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+
+# Refresh categories older than this many seconds
+CATEGORIES_TTL = 24 * 3600
+# Check for stale categories (or a new year) this often, in seconds
+CHECK_INTERVAL = 3600
+
+
+class CategoryCache:
+    """Expense categories persisted to disk and refreshed in the background.
+
+    Categories are stored per year, since each year has its own category
+    sheet. They are loaded from disk at startup, so no network access is
+    needed, and refreshed by a background thread through `fetch_func(year)`
+    when they are older than the TTL or the year changes. Every new list of
+    the current year is passed to `on_update`, as well as the list of a new
+    year fetched ahead of time (see `prefetch`) once the year starts.
+
+    """
+
+    def __init__(self, path, fetch_func, on_update=None, ttl=CATEGORIES_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._fetch = fetch_func
+        self._on_update = on_update
+        self._lock = threading.Lock()
+        self._years = {}
+        self._wakeup = threading.Event()
+        self._scheduled = False
+        # Year of the categories last passed to on_update
+        self._year = datetime.date.today().year
+        self._thread = threading.Thread(
+            target=self._run, name="category-refresh", daemon=True
+        )
+        self.load()
+
+    def load(self):
+        """Load the cached categories from disk."""
+        try:
+            with open(self.path, "r", encoding="utf8") as input_file:
+                self._years = json.load(input_file)["years"]
+        except FileNotFoundError:
+            self._years = {}
+        except (ValueError, KeyError):
+            logging.warning("Ignoring corrupt category cache %s", self.path)
+            self._years = {}
+
+    def save(self):
+        """Store the categories on disk."""
+        with self._lock:
+            data = {"years": self._years}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf8") as output_file:
+            json.dump(data, output_file, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def get(self, year=None):
+        """Get the categories of a year (the current one by default).
+
+        If the year has not been fetched yet, the latest known year is used.
+
+        """
+        year = str(year or datetime.date.today().year)
+        with self._lock:
+            if year in self._years:
+                return list(self._years[year]["categories"])
+            previous = [known for known in self._years if known < year]
+            if previous:
+                return list(self._years[max(previous)]["categories"])
+        return []
+
+    def is_stale(self, year=None):
+        """Check if the categories of a year need to be fetched."""
+        year = str(year or datetime.date.today().year)
+        with self._lock:
+            entry = self._years.get(year)
+        return not entry or time.time() - entry["updated"] > self.ttl
+
+    def refresh(self, year=None):
+        """Fetch the categories of a year and store them.
+
+        Return:
+            list: The new categories, or None if fetching failed.
+
+        """
+        year = year or datetime.date.today().year
+        try:
+            categories = self._fetch(year)
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("Error fetching categories of %s", year)
+            return None
+        with self._lock:
+            self._years[str(year)] = {"updated": time.time(), "categories": categories}
+        self.save()
+        logging.info("Refreshed %s categories of %s", len(categories), year)
+        if str(year) == str(datetime.date.today().year):
+            with self._lock:
+                self._year = int(year)
+            if self._on_update:
+                self._on_update(categories)
+        return categories
+
+    def prefetch(self, year):
+        """Fetch the categories of a coming year, unless they are known and fresh."""
+        if self.is_stale(year):
+            return self.refresh(year)
+        return self.get(year)
+
+    def check_year(self):
+        """Pass the categories of the current year to `on_update` if the year changed.
+
+        Return:
+            bool: If the year changed.
+
+        """
+        year = datetime.date.today().year
+        with self._lock:
+            if self._year == year:
+                return False
+            self._year = year
+        logging.info("Switching to the categories of %s", year)
+        if self._on_update:
+            self._on_update(self.get(year))
+        return True
+
+    def start(self):
+        """Start the background refresh."""
+        self._thread.start()
+
+    def request_refresh(self):
+        """Refresh the current year in the background as soon as possible."""
+        with self._lock:
+            self._years.get(str(datetime.date.today().year), {})["updated"] = 0
+        self._wakeup.set()
+
+    def schedule_refresh(self, executor):
+        """Refresh the current year on an executor instead of the own thread.
+
+        Nothing is done if a refresh scheduled before hasn't finished yet.
+
+        """
+        with self._lock:
+            if self._scheduled:
+                return
+            self._scheduled = True
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                with self._lock:
+                    self._scheduled = False
+
+        executor.submit(run)
+
+    def _run(self):
+        while True:
+            self.check_year()
+            if self.is_stale():
+                self.refresh()
+            self._wakeup.wait(timeout=min(self.ttl, CHECK_INTERVAL))
+            self._wakeup.clear()
+
+
+# EOF
@@ -23,9 +23,15 @@ import argparse
 import os
 
 import logging
+import logging.handlers
 
 from expensebot.config import load_config
-from expensebot.bot import ExpenseBot
+
+# The bot pulls in telegram, gspread and the parsing libraries, so it's only
+# imported once the arguments are parsed (eg, not for --help)
+
+# Fields of the import command, see expensebot.importer.COLUMNS
+IMPORT_COLUMNS = ('concept', 'value', 'currency', 'category', 'date')
 
 
 LOGGING_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -49,8 +55,58 @@ def setup_logging(level, path, interactive):
         root_logger.addHandler(console)
 
 
+def add_import_parser(subparsers):
+    """Configure the arguments of the import command."""
+    parser = subparsers.add_parser('import', help='Import expenses from a CSV file (eg, a bank statement)')
+    parser.add_argument('file', help='CSV file to import')
+    parser.add_argument('--concept', help='Column (name or 0-based index) of the concept')
+    parser.add_argument('--value', help='Column of the value')
+    parser.add_argument('--currency', help='Column of the currency (default currency if not given)')
+    parser.add_argument('--category', help='Column of the category text')
+    parser.add_argument('--date', help='Column of the date (today if not given)')
+    parser.add_argument('--date-format', help='strptime format of the dates (guessed if not given)')
+    parser.add_argument('--delimiter', default=',', help='CSV delimiter')
+    parser.add_argument('--encoding', default='utf-8', help='File encoding')
+    parser.add_argument('--no-header', dest='header', action='store_false',
+                        help='The file has no header row')
+    parser.add_argument('--negate', action='store_true', help='Flip the sign of the values')
+    parser.add_argument('--batch-size', type=int, default=500, help='Expenses written per batch')
+    parser.add_argument('--spreadsheet', help='Spreadsheet id (expenses-sheet by default)')
+    parser.add_argument('--checkpoint', help='Progress file used to resume the import')
+    parser.add_argument('--restart', action='store_true', help='Ignore the progress of previous runs')
+    parser.add_argument('--dry-run', action='store_true', help='Only parse the file, do not write anything')
+
+
+def run_import(bot, config, args):
+    """Import a CSV file into the month worksheets."""
+    from expensebot.importer import (  # pylint: disable=import-outside-toplevel
+        CsvImporter, ImportCheckpoint, default_checkpoint_path)
+    bot.refresh_categories()
+    importer = CsvImporter(bot,
+                           columns={field: getattr(args, field) for field in IMPORT_COLUMNS},
+                           delimiter=args.delimiter,
+                           encoding=args.encoding,
+                           header=args.header,
+                           date_format=args.date_format,
+                           negate=args.negate,
+                           batch_size=args.batch_size,
+                           spreadsheet_id=args.spreadsheet)
+    checkpoint = None
+    if not args.dry_run:
+        checkpoint = ImportCheckpoint(args.checkpoint or default_checkpoint_path(config, args.file),
+                                      args.file)
+        if args.restart:
+            checkpoint.rows, checkpoint.done = 0, set()
+    result = importer.run(args.file, checkpoint, dry_run=args.dry_run)
+    logging.info("Imported %s expenses out of %s rows (%s failed)",
+                 result.written, result.rows, result.failed)
+    if checkpoint:
+        checkpoint.remove()
+    return result
+
+
 def main(args=None):
-    """Run the expense bot."""
+    """Run the expense bot, or one of its commands."""
     parser = argparse.ArgumentParser(description='Expense bot')
     parser.add_argument('-v', '--verbose', action='store_true', help='Activate debug prints')
     parser.add_argument('-c', '--config', action='store', type=str,
@@ -58,13 +114,21 @@ def main(args=None):
                         help='Configuration file to use')
     parser.add_argument('--interactive', '-i', action='store_true', default=False, help='Log in interactive mode')
     parser.add_argument('--log-path', action='store', type=str, default='/var/log/expensebot.log')
+    parser.add_argument('--webhook', action='store_true', default=False,
+                        help='Receive updates through a webhook instead of polling')
+    subparsers = parser.add_subparsers(dest='command', help='Command to run instead of the bot')
+    add_import_parser(subparsers)
     args = parser.parse_args(args=args)
     setup_logging('DEBUG' if args.verbose else 'INFO',
                   args.log_path,
                   args.interactive)
     config = load_config(args.config)
+    from expensebot.bot import ExpenseBot  # pylint: disable=import-outside-toplevel
+    if args.command == 'import':
+        run_import(ExpenseBot(config, offline=True), config, args)
+        return
     bot = ExpenseBot(config)
-    bot.start()
+    bot.start(webhook=args.webhook)
 
 
 if __name__ == "__main__":
@@ -7,17 +7,53 @@
 # =============================================================================
 """Config management."""
 
-import yaml
+import os
 
 
 CONFIG_FILE = "config.yaml"
+DATA_DIR = "~/.expensebot"
 
 
 def load_config(config_file=CONFIG_FILE):
     """Load configuration."""
+    import yaml  # pylint: disable=import-outside-toplevel
+
     with open(config_file, "r") as config_stream:
         config = yaml.safe_load(config_stream)
     return config
 
 
+def data_path(config, file_name):
+    """Get the path of a local data file, creating the data directory if needed.
+
+    The directory is taken from the `data-dir` configuration key.
+
+    """
+    data_dir = os.path.expanduser(config.get("data-dir", DATA_DIR))
+    os.makedirs(data_dir, exist_ok=True)
+    return os.path.join(data_dir, file_name)
+
+
+def user_config(config, user_id):
+    """Get the configuration of a user of a multi-tenant bot.
+
+    The settings in `users.<user_id>` override the global ones (sections like
+    `currency` are merged key by key), and the local data of the user is kept
+    in its own subdirectory of the data directory.
+
+    """
+    users = {int(key): value for key, value in (config.get("users") or {}).items()}
+    overrides = users.get(int(user_id)) or {}
+    merged = {key: value for key, value in config.items() if key != "users"}
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = dict(merged[key], **value)
+        else:
+            merged[key] = value
+    merged["data-dir"] = os.path.join(
+        os.path.expanduser(config.get("data-dir", DATA_DIR)), "users", str(user_id)
+    )
+    return merged
+
+
 # EOF
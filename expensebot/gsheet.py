@@ -7,23 +7,167 @@
 # =============================================================================
 """Testing credentials."""
 
+import contextlib
+import datetime
+import hashlib
 import json
+import logging
+import threading
+import time
 
 import gspread
+import requests
+from google.auth.transport.requests import Request
 from oauth2client.service_account import ServiceAccountCredentials
 
 from expensebot.config import load_config
+from expensebot.scheduler import (BURST, MAX_BACKOFF, MAX_RETRIES, QUOTA_PER_MINUTE,
+                                  RequestScheduler)
+from expensebot.stats import STATS
 
 
 scope = ['https://spreadsheets.google.com/feeds',
          'https://www.googleapis.com/auth/drive']
 
+# Refresh access tokens this many seconds before they expire
+TOKEN_REFRESH_MARGIN = 300
+# Keep opened spreadsheets for this many seconds
+SPREADSHEET_TTL = 3600
+# HTTP status codes of failed calls that are worth retrying
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+
+
+class ClientPool:
+    """Cache of authorized clients and opened spreadsheets.
+
+    One client is kept per service account credential, so its HTTP session
+    (and the connections it holds) is reused across calls, and its access token
+    is refreshed ahead of expiry. Spreadsheets are cached by key for a limited
+    time to avoid re-fetching their metadata on every operation.
+
+    """
+
+    def __init__(self, spreadsheet_ttl=SPREADSHEET_TTL, refresh_margin=TOKEN_REFRESH_MARGIN):
+        self._lock = threading.RLock()
+        self._clients = {}
+        self._spreadsheets = {}
+        self.spreadsheet_ttl = spreadsheet_ttl
+        self.refresh_margin = datetime.timedelta(seconds=refresh_margin)
+
+    def client(self, config):
+        """Get the authorized client for the credential in the configuration."""
+        credential = config['credentials']['gspread']['credential']
+        client_key = hashlib.sha256(credential.encode('utf8')).hexdigest()
+        with self._lock:
+            client = self._clients.get(client_key)
+            if client is None:
+                with STATS.timer('sheets.authorize'):
+                    json_credential = json.loads(credential)
+                    credentials = ServiceAccountCredentials.from_json_keyfile_dict(json_credential, scope)
+                    client = gspread.authorize(credentials)
+                self._clients[client_key] = client
+            self._refresh_token(client)
+        return client
+
+    def register(self, config, client):
+        """Use an already authorized client for the credential in the configuration."""
+        credential = config['credentials']['gspread']['credential']
+        with self._lock:
+            self._clients[hashlib.sha256(credential.encode('utf8')).hexdigest()] = client
+
+    def _refresh_token(self, client):
+        auth = client.auth
+        if auth.token and auth.expiry and auth.expiry - datetime.datetime.utcnow() > self.refresh_margin:
+            return
+        logging.debug("Refreshing GSheets access token")
+        with STATS.timer('sheets.refresh_token'):
+            # A plain request: through the client session, whose own refresh
+            # kicks in on invalid credentials, the token could be exchanged twice
+            auth.refresh(Request())
+
+    def open_by_key(self, config, key):
+        """Get a spreadsheet by key, reusing a recently opened one if possible."""
+        client = self.client(config)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._spreadsheets.get(key)
+            if cached and cached[1] > now:
+                STATS.incr('cache.spreadsheet.hit')
+                return cached[0]
+        STATS.incr('cache.spreadsheet.miss')
+        spreadsheet = api_call('open_by_key', client.open_by_key, key)
+        with self._lock:
+            self._spreadsheets[key] = (spreadsheet, now + self.spreadsheet_ttl)
+        return spreadsheet
+
+    def invalidate(self, key=None):
+        """Forget a cached spreadsheet, or all of them if no key is given."""
+        with self._lock:
+            if key is None:
+                self._spreadsheets.clear()
+            else:
+                self._spreadsheets.pop(key, None)
+
+
+_POOL = ClientPool()
+
+
+def is_retryable(error):
+    """Check if a failed GSheets call is worth retrying (rate limits, server or network errors)."""
+    if isinstance(error, gspread.exceptions.APIError):
+        return error.response.status_code in RETRYABLE_STATUS
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+def is_already_exists(error):
+    """Check if a failed GSheets call tried to create something that already exists."""
+    return error.response.status_code == 400 and 'already exists' in str(error)
+
+
+_SCHEDULER = RequestScheduler(is_retryable)
+
+
+def configure_scheduler(config):
+    """Set the GSheets quota and retry policy from the `sheets` section of the configuration."""
+    sheets_config = config.get('sheets', {})
+    _SCHEDULER.configure(quota_per_minute=sheets_config.get('quota-per-minute', QUOTA_PER_MINUTE),
+                         burst=sheets_config.get('burst', BURST),
+                         max_retries=sheets_config.get('max-retries', MAX_RETRIES),
+                         max_backoff=sheets_config.get('max-backoff', MAX_BACKOFF))
+
+
+def api_call(name, func, *args, **kwargs):
+    """Make a GSheets API call through the request scheduler.
+
+    The call waits for its turn within the quota, and is counted, timed and
+    retried if rate limited.
+
+    Arguments:
+        name (str): Name of the call in the stats.
+        func (callable): Function making the call.
+
+    """
+    return _SCHEDULER.call(name, func, *args, **kwargs)
+
+
+def api_call_once(name, func, *args, **kwargs):
+    """Make a GSheets API call that must not be repeated, without retries (see `api_call`)."""
+    return _SCHEDULER.call_once(name, func, *args, **kwargs)
+
 
 def authorize(config):
     """Authorize in GSheets."""
-    json_credential = json.loads(config['credentials']['gspread']['credential'])
-    credentials = ServiceAccountCredentials.from_json_keyfile_dict(json_credential, scope)
-    return gspread.authorize(credentials)
+    return _POOL.client(config)
+
+
+def open_spreadsheet(config, key):
+    """Open a spreadsheet by key using the shared client pool."""
+    return _POOL.open_by_key(config, key)
+
+
+def register_client(config, client):
+    """Use the given client for the credential in the configuration (eg, for offline use)."""
+    _POOL.register(config, client)
 
 
 def load_spreadsheet(config, sheet_name):
@@ -37,22 +181,238 @@ def load_spreadsheet(config, sheet_name):
 
     """
     sh_id = config[sheet_name]
-    return authorize(config).open_by_key(sh_id)
+    return open_spreadsheet(config, sh_id)
+
+
+class WorksheetIndex:
+    """In-memory title -> worksheet index, per spreadsheet.
+
+    The index of a spreadsheet is filled with a single metadata fetch the first
+    time it is used, and only fetched again when a lookup misses or an entry is
+    invalidated (for example, after a failed write).
+
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._index = {}
+
+    def get(self, spreadsheet, name):
+        """Look up a worksheet by title, fetching the spreadsheet metadata if needed."""
+        with self.lock:
+            titles = self._index.get(spreadsheet.id)
+            if titles is None or name not in titles:
+                STATS.incr('cache.worksheet.miss')
+                logging.debug("Fetching worksheet list of %s", spreadsheet.id)
+                titles = {worksheet.title: worksheet
+                          for worksheet in api_call('worksheets', spreadsheet.worksheets)}
+                self._index[spreadsheet.id] = titles
+            else:
+                STATS.incr('cache.worksheet.hit')
+            return titles.get(name)
+
+    def add(self, spreadsheet, worksheet):
+        """Register a newly created worksheet."""
+        with self.lock:
+            self._index.setdefault(spreadsheet.id, {})[worksheet.title] = worksheet
 
+    def invalidate(self, spreadsheet, name=None):
+        """Drop a worksheet from the index, or the full spreadsheet if no name is given."""
+        with self.lock:
+            if name is None:
+                self._index.pop(spreadsheet.id, None)
+            else:
+                self._index.get(spreadsheet.id, {}).pop(name, None)
 
-def get_worksheet(spreadsheet, name, create_if_non_existant=True, creation_func=None):
-    """Get a worksheet, create it if it not exists."""
-    for worksheet in spreadsheet.worksheets():
-        if worksheet.title == name:
+    def clear(self):
+        """Drop the index of all spreadsheets."""
+        with self.lock:
+            self._index.clear()
+
+
+_WORKSHEETS = WorksheetIndex()
+
+
+# Worksheets created in this process whose initialization failed (or may have
+# been created by a request whose response was lost)
+_UNINITIALIZED = set()
+
+
+def get_worksheet(spreadsheet, name, create_if_non_existant=True, creation_func=None, index=None):
+    """Get a worksheet, create it if it not exists.
+
+    If `creation_func` fails on a new worksheet, it is run again the next time
+    the worksheet is requested. The creation is not retried; if it failed but
+    the worksheet exists anyway (eg, the response timed out), the worksheet is
+    initialized when found. The worksheet is looked up in the given
+    `WorksheetIndex` (eg, the one of a user), or in the shared one.
+
+    """
+    index = index or _WORKSHEETS
+    key = (spreadsheet.id, name)
+    with index.lock:
+        worksheet = index.get(spreadsheet, name)
+        if worksheet:
+            if creation_func and key in _UNINITIALIZED:
+                creation_func(worksheet)
+                _UNINITIALIZED.discard(key)
+            return worksheet
+        if create_if_non_existant:
+            with STATS.timer('sheets.create_worksheet'):
+                if creation_func:
+                    _UNINITIALIZED.add(key)
+                try:
+                    worksheet = api_call_once('add_worksheet', spreadsheet.add_worksheet,
+                                              title=name, rows="300", cols="10")
+                except gspread.exceptions.APIError as error:
+                    if not is_already_exists(error):
+                        raise
+                    logging.warning("Worksheet %s already exists, initializing it", name)
+                    index.invalidate(spreadsheet)
+                    worksheet = index.get(spreadsheet, name)
+                    if not worksheet:
+                        raise
+                if creation_func:
+                    creation_func(worksheet)
+                    _UNINITIALIZED.discard(key)
+            index.add(spreadsheet, worksheet)
             return worksheet
-    if create_if_non_existant:
-        worksheet = spreadsheet.add_worksheet(title=name, rows="300", cols="10")
-        if creation_func:
-            creation_func(worksheet)
-        return worksheet
     return None
 
 
+def invalidate_worksheet(worksheet, index=None):
+    """Forget a worksheet so that the next lookup fetches it again."""
+    (index or _WORKSHEETS).invalidate(worksheet.spreadsheet, worksheet.title)
+
+
+class RowCursor:
+    """Next free row of a worksheet."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_row = None
+
+
+_CURSORS = {}
+_CURSORS_LOCK = threading.Lock()
+
+
+@contextlib.contextmanager
+def reserve_rows(worksheet, count, count_cell):
+    """Reserve the next free rows of a worksheet.
+
+    The next free row is seeded once from `count_cell`, which must hold the
+    number of used rows below the header, and then tracked in process. Writers
+    of the same worksheet are serialized while the context is active. The
+    cursor only advances if the block succeeds; otherwise it is seeded again
+    from the sheet on next use.
+
+    Arguments:
+        worksheet (Worksheet): Worksheet to write to.
+        count (int): Number of rows to reserve.
+        count_cell (str): A1 notation of the cell holding the row count.
+
+    Yield:
+        int: First reserved row.
+
+    """
+    with _CURSORS_LOCK:
+        cursor = _CURSORS.setdefault((worksheet.spreadsheet.id, worksheet.id), RowCursor())
+    with cursor.lock:
+        if cursor.next_row is None:
+            cursor.next_row = int(api_call('acell', worksheet.acell, count_cell).value) + 2
+        try:
+            yield cursor.next_row
+        except Exception:
+            cursor.next_row = None
+            raise
+        cursor.next_row += count
+
+
+@contextlib.contextmanager
+def delete_row(worksheet, row, index=None, check=None):
+    """Delete a row of a worksheet, moving the rows below it one up.
+
+    Writers of the worksheet are held back until the context exits, so row
+    numbers kept elsewhere (eg, in the ledger) can be updated in the block.
+    The deletion is not retried, since repeating it after a lost response
+    would delete the next row.
+
+    Arguments:
+        worksheet (Worksheet): Worksheet to delete the row from.
+        row (int): Row number (1-based).
+        index (WorksheetIndex): Index the worksheet was found in, invalidated
+            if the deletion fails.
+        check (callable): Called with the unformatted values of the row
+            (columns A to F) before deleting it, the row is kept if it returns
+            False.
+
+    Raise:
+        ValueError: If the row doesn't pass the check.
+
+    """
+    with _CURSORS_LOCK:
+        cursor = _CURSORS.setdefault((worksheet.spreadsheet.id, worksheet.id), RowCursor())
+    with cursor.lock:
+        try:
+            if check is not None:
+                values = api_call('get', worksheet.get, 'A{0}:F{0}'.format(row),
+                                  value_render_option='UNFORMATTED_VALUE')
+                if not check(values[0] if values else []):
+                    raise ValueError("Row {} of {} was changed in the sheet".format(
+                        row, worksheet.title))
+            api_call_once('delete_rows', worksheet.delete_rows, row)
+        except gspread.exceptions.GSpreadException:
+            invalidate_worksheet(worksheet, index)
+            raise
+        try:
+            yield
+        except Exception:
+            cursor.next_row = None
+            raise
+        if cursor.next_row is not None:
+            cursor.next_row -= 1
+
+
+def update_rows(worksheet, first_row, rows, index=None):
+    """Write a block of rows in a single API call.
+
+    Values are entered as if typed by the user, so formulas and dates are
+    interpreted by Sheets. Concurrent writes to the same spreadsheet are sent
+    together in a batch update by the request scheduler.
+
+    Arguments:
+        worksheet (Worksheet): Worksheet to write to.
+        first_row (int): Row number (1-based) of the first row in `rows`.
+        rows (list): List of rows, each a list of cell values starting at column A.
+        index (WorksheetIndex): Index the worksheet was found in, invalidated
+            if the write fails.
+
+    """
+    last_row = first_row + len(rows) - 1
+    last_col = max(len(row) for row in rows)
+    range_name = '{}:{}'.format(gspread.utils.rowcol_to_a1(first_row, 1),
+                                gspread.utils.rowcol_to_a1(last_row, last_col))
+    range_name = gspread.utils.absolute_range_name(worksheet.title, range_name)
+    try:
+        return _SCHEDULER.update(worksheet.spreadsheet, range_name, rows)
+    except gspread.exceptions.GSpreadException:
+        invalidate_worksheet(worksheet, index)
+        raise
+
+
+def forget_spreadsheet(key):
+    """Forget a cached spreadsheet (eg, when its user goes idle)."""
+    _POOL.invalidate(key)
+
+
+def clear_caches():
+    """Forget all cached spreadsheets, worksheets and row cursors."""
+    _POOL.invalidate()
+    _WORKSHEETS.clear()
+    with _CURSORS_LOCK:
+        _CURSORS.clear()
+
 
 if __name__ == "__main__":
     bot_config = load_config()
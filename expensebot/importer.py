@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   importer.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Bulk import of expenses from CSV files (eg, bank statements)."""
+
+import csv
+import datetime
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import time
+from collections import namedtuple
+
+import expensebot.gsheet as gsheet
+from expensebot.config import data_path
+from expensebot.messages import find_dates
+from expensebot.stats import STATS
+
+
+# Expenses written per batch (one update per month worksheet)
+BATCH_SIZE = 500
+# Attempts to write a batch when rate limited
+MAX_RETRIES = 8
+MAX_BACKOFF = 120
+COLUMNS = ("concept", "value", "currency", "category", "date")
+
+ImportResult = namedtuple("ImportResult", ["rows", "written", "failed"])
+
+
+def normalize_amount(text, negate=False):
+    """Normalize an amount from an export (thousands separators, decimal comma)."""
+    text = re.sub(r"[\s'’]", "", text)
+    if "," in text and "." in text:
+        # The last separator is the decimal one
+        if text.rindex(",") > text.rindex("."):
+            text = text.replace(".", "").replace(",", ".")
+        else:
+            text = text.replace(",", "")
+    else:
+        text = text.replace(",", ".")
+    value = float(text)
+    if negate:
+        value = -value
+    return "{:.2f}".format(value).rstrip("0").rstrip(".")
+
+
+class ImportCheckpoint:
+    """Progress of an import, to resume it after an interruption.
+
+    Stores the number of data rows fully processed, plus the rows beyond
+    them that were already written, for the given source file. A checkpoint of
+    a different (or modified) source is ignored.
+
+    """
+
+    def __init__(self, path, source):
+        self.path = path
+        stat = os.stat(source)
+        self.source = {
+            "path": os.path.abspath(source),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+        }
+        self.rows = 0
+        self.done = set()
+        self.load()
+
+    def load(self):
+        """Load the checkpoint, if it matches the source."""
+        try:
+            with open(self.path, "r", encoding="utf8") as input_file:
+                data = json.load(input_file)
+        except FileNotFoundError:
+            return
+        if data.get("source") != self.source:
+            logging.warning("Ignoring checkpoint %s of a different source", self.path)
+            return
+        self.rows = data["rows"]
+        self.done = set(data["done"])
+        logging.info("Resuming import after row %s", self.rows)
+
+    def save(self):
+        """Store the checkpoint."""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf8") as output_file:
+            json.dump(
+                {"source": self.source, "rows": self.rows, "done": sorted(self.done)},
+                output_file,
+            )
+        os.replace(tmp_path, self.path)
+
+    def skip(self, row_num):
+        """Check if a row was already processed."""
+        return row_num <= self.rows or row_num in self.done
+
+    def remove(self):
+        """Delete the checkpoint (eg, when the import is finished)."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def default_checkpoint_path(config, source):
+    """Checkpoint file of a source in the data directory."""
+    digest = hashlib.sha1(os.path.abspath(source).encode("utf8")).hexdigest()[:12]
+    return data_path(config, "import-{}.json".format(digest))
+
+
+class CsvImporter:
+    """Stream expenses from a CSV file into the month worksheets.
+
+    Rows are read lazily, turned into expenses and written in batches of
+    `batch_size` through `ExpenseBot.write_expenses`, which makes one update
+    per month worksheet (creating missing ones), so memory use is bounded by
+    the batch size. Rate limited writes are retried with exponential backoff.
+
+    Rows are either parsed like bot messages (all cells joined), or built from
+    the given columns, which can be header names or 0-based indices.
+
+    Arguments:
+        bot (ExpenseBot): Bot used to build and write the expenses.
+        columns (dict): Column of each field in `COLUMNS`. Concept and value are
+            needed; without them, rows are parsed as messages.
+        delimiter (str): CSV delimiter.
+        encoding (str): File encoding.
+        header (bool): Whether the first row holds the column names.
+        date_format (str): `strptime` format of the date column. If not given,
+            dates are found like in messages.
+        negate (bool): Flip the sign of the values (eg, for bank statements
+            where expenses are negative).
+
+    """
+
+    def __init__(
+        self,
+        bot,
+        columns=None,
+        delimiter=",",
+        encoding="utf-8",
+        header=True,
+        date_format=None,
+        negate=False,
+        batch_size=BATCH_SIZE,
+        spreadsheet_id=None,
+        max_retries=MAX_RETRIES,
+    ):
+        self.bot = bot
+        self.columns = {
+            field: column for field, column in (columns or {}).items() if column is not None
+        }
+        unknown = set(self.columns) - set(COLUMNS)
+        if unknown:
+            raise ValueError("Unknown import fields -> {}".format(", ".join(unknown)))
+        if self.columns and not {"concept", "value"} <= set(self.columns):
+            raise ValueError("Importing by column needs the concept and value columns")
+        self.delimiter = delimiter
+        self.encoding = encoding
+        self.header = header
+        self.date_format = date_format
+        self.negate = negate
+        self.batch_size = batch_size
+        self.spreadsheet_id = spreadsheet_id
+        self.max_retries = max_retries
+
+    def rows(self, path):
+        """Iterate over the data rows of the file.
+
+        Yield:
+            tuple: Row number (1-based, header excluded) and the row as a dict of
+                field -> cell, or as a list of cells if no columns are given.
+
+        """
+        with open(path, "r", encoding=self.encoding, newline="") as input_file:
+            reader = csv.reader(input_file, delimiter=self.delimiter)
+            names = next(reader, []) if self.header else []
+            indices = {
+                field: self._column_index(column, names)
+                for field, column in self.columns.items()
+            }
+            for row_num, row in enumerate(reader, 1):
+                if not any(cell.strip() for cell in row):
+                    continue
+                if indices:
+                    row = {
+                        field: row[index].strip() if index < len(row) else ""
+                        for field, index in indices.items()
+                    }
+                yield row_num, row
+
+    @staticmethod
+    def _column_index(column, names):
+        if isinstance(column, int) or str(column).isdigit():
+            return int(column)
+        try:
+            return names.index(column)
+        except ValueError:
+            raise ValueError("Column not found in the header -> {}".format(column))
+
+    def to_expense(self, row):
+        """Build the expense of a row.
+
+        Raise:
+            ValueError: If the row cannot be interpreted.
+
+        """
+        if not self.columns:
+            return self.bot.parse_expense(" ".join(cell.strip() for cell in row if cell.strip()))
+        try:
+            value = normalize_amount(row["value"], self.negate)
+        except ValueError:
+            raise ValueError("Cannot read value -> {}".format(row["value"]))
+        date = None
+        if row.get("date"):
+            if self.date_format:
+                date = datetime.datetime.strptime(row["date"], self.date_format)
+            else:
+                found_dates = find_dates(row["date"])
+                if not found_dates:
+                    raise ValueError("Cannot read date -> {}".format(row["date"]))
+                date = found_dates[0][0]
+        return self.bot.build_expense(
+            row["concept"],
+            value,
+            currency=row.get("currency") or None,
+            category_text=row.get("category"),
+            date=date,
+        )
+
+    def write(self, expenses):
+        """Write expenses, retrying the rate limited ones.
+
+        Return:
+            list: For each expense, the error that prevented writing it, or None.
+
+        """
+        errors = [None] * len(expenses)
+        pending = list(range(len(expenses)))
+        for attempt in range(self.max_retries + 1):
+            batch_errors = self.bot.write_expenses(
+                [expenses[index] for index in pending], self.spreadsheet_id
+            )
+            retry = []
+            for index, error in zip(pending, batch_errors):
+                errors[index] = error
+                if error is not None and gsheet.is_retryable(error):
+                    retry.append(index)
+            if not retry or attempt == self.max_retries:
+                break
+            pending = retry
+            STATS.incr("sheets.retries")
+            backoff = min(MAX_BACKOFF, 2 ** (attempt + 1)) * random.uniform(0.5, 1)
+            logging.warning(
+                "%s expenses rate limited, retrying in %.1f s", len(retry), backoff
+            )
+            time.sleep(backoff)
+        return errors
+
+    def run(self, path, checkpoint=None, dry_run=False):
+        """Import a file.
+
+        Arguments:
+            path (str): CSV file to import.
+            checkpoint (ImportCheckpoint): Progress to resume from and update.
+            dry_run (bool): Only build the expenses, without writing them.
+
+        Raise:
+            Exception: The last error if writing a batch is still rate limited
+                after all retries. The checkpoint allows resuming later.
+
+        Return:
+            ImportResult: Number of rows read, expenses written and failed rows.
+
+        """
+        rows = written = 0
+        batch = []
+        start = time.monotonic()
+        last_row = 0
+        for row_num, row in self.rows(path):
+            last_row = row_num
+            if checkpoint and checkpoint.skip(row_num):
+                continue
+            rows += 1
+            try:
+                batch.append((row_num, self.to_expense(row)))
+            except ValueError as error:
+                logging.warning("Skipping row %s -> %s", row_num, error)
+            if len(batch) >= self.batch_size:
+                written += self._flush(batch, row_num, checkpoint, dry_run)
+                batch = []
+                logging.info(
+                    "Imported %s rows (%.0f rows/s)", rows, rows / (time.monotonic() - start)
+                )
+        if batch or checkpoint:
+            written += self._flush(batch, last_row, checkpoint, dry_run)
+        return ImportResult(rows, written, rows - written)
+
+    def _flush(self, batch, last_row, checkpoint, dry_run):
+        """Write a batch and update the checkpoint, return the number of written expenses."""
+        if dry_run:
+            return len(batch)
+        errors = self.write([expense for _, expense in batch]) if batch else []
+        retry_error = None
+        for (row_num, _), error in zip(batch, errors):
+            if error is None:
+                if checkpoint:
+                    checkpoint.done.add(row_num)
+            elif gsheet.is_retryable(error):
+                retry_error = error
+            else:
+                logging.warning("Cannot write row %s -> %s", row_num, error)
+        if checkpoint:
+            if retry_error is None:
+                # Everything up to here was processed, written or not
+                checkpoint.rows = last_row
+                checkpoint.done = {row for row in checkpoint.done if row > last_row}
+            checkpoint.save()
+        if retry_error is not None:
+            raise retry_error
+        return sum(1 for error in errors if error is None)
+
+
+# EOF
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   journal.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Write-behind journal of expenses pending to be written to GSheets."""
+
+import datetime
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import expensebot.gsheet as gsheet
+from expensebot.stats import STATS
+
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+# Entries failing this many times with a non-retryable error are given up on
+MAX_ATTEMPTS = 3
+# Seconds before retrying an entry after its first failure, doubled after each one
+RETRY_BACKOFF = 30
+BATCH_SIZE = 50
+FLUSH_INTERVAL = 5
+MAX_BACKOFF = 300
+# Spreadsheets written at the same time while flushing
+FLUSH_WORKERS = 4
+
+
+class ExpenseJournal:
+    """Append-only SQLite journal of parsed expenses.
+
+    Entries are only removed once they have been written, so a crash or restart
+    never loses an acknowledged expense (although one written just before a
+    crash may be written again on replay). Entries failing with non-retryable
+    errors are retried with exponential backoff, and after `MAX_ATTEMPTS`
+    attempts they are kept as failed instead of being deleted.
+
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "spreadsheet_id TEXT NOT NULL, "
+                "payload TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "tenant TEXT)"
+            )
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(entries)")]
+            # Columns missing in journals of older versions
+            for column, definition in (
+                ("tenant", "TEXT"),
+                ("chat_id", "INTEGER"),
+                ("next_attempt", "REAL NOT NULL DEFAULT 0"),
+                ("failed", "INTEGER NOT NULL DEFAULT 0"),
+                ("error", "TEXT"),
+                ("user_id", "INTEGER"),
+            ):
+                if column not in columns:
+                    self._db.execute(
+                        "ALTER TABLE entries ADD COLUMN {} {}".format(column, definition)
+                    )
+
+    def append(
+        self, spreadsheet_id, expense, tenant=None, chat_id=None, user_id=None
+    ):
+        """Add an expense to the journal.
+
+        Arguments:
+            spreadsheet_id (str): Spreadsheet to write the expense to.
+            expense (tuple): The expense.
+            tenant (str): User the expense belongs to, None for the global configuration.
+            chat_id (int): Chat to tell if the expense cannot be written.
+            user_id (int): Telegram user who sent the expense.
+
+        """
+        concept, value, currency, category, date = expense
+        payload = json.dumps(
+            [concept, value, currency, category, date.strftime(DATE_FORMAT)]
+        )
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                "INSERT INTO entries "
+                "(spreadsheet_id, payload, tenant, chat_id, user_id) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (spreadsheet_id, payload, tenant, chat_id, user_id),
+            )
+        return cursor.lastrowid
+
+    def pending(self, limit):
+        """Get the oldest pending entries of each user and spreadsheet.
+
+        At most `limit` entries are taken from each, so a user with a large
+        backlog doesn't hold back the others. Entries waiting for a retry or
+        given up on are skipped.
+
+        Return:
+            list: (id, spreadsheet id, tenant, user id, expense) tuples.
+
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, spreadsheet_id, tenant, user_id, payload FROM ("
+                "SELECT *, ROW_NUMBER() OVER "
+                "(PARTITION BY tenant, spreadsheet_id ORDER BY id) AS position "
+                "FROM entries WHERE NOT failed AND next_attempt <= ?) "
+                "WHERE position <= ? ORDER BY id",
+                (time.time(), limit),
+            ).fetchall()
+        return [
+            (entry_id, spreadsheet_id, tenant, user_id, load_expense(payload))
+            for entry_id, spreadsheet_id, tenant, user_id, payload in rows
+        ]
+
+    def failed(self):
+        """Get the entries given up on.
+
+        Return:
+            list: (id, spreadsheet id, tenant, chat id, expense, error) tuples.
+
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, spreadsheet_id, tenant, chat_id, payload, error "
+                "FROM entries WHERE failed ORDER BY id"
+            ).fetchall()
+        return [
+            (entry_id, spreadsheet_id, tenant, chat_id, load_expense(payload), error)
+            for entry_id, spreadsheet_id, tenant, chat_id, payload, error in rows
+        ]
+
+    def remove(self, entry_ids):
+        """Remove written entries."""
+        with self._lock, self._db:
+            self._db.executemany(
+                "DELETE FROM entries WHERE id = ?",
+                [(entry_id,) for entry_id in entry_ids],
+            )
+
+    def fail(self, failures):
+        """Record failed writes.
+
+        Entries are retried with exponential backoff, and kept as failed (see
+        `failed`) once they failed `MAX_ATTEMPTS` times.
+
+        Arguments:
+            failures (list): (entry id, error) pairs.
+
+        Return:
+            list: (id, spreadsheet id, tenant, chat id, expense, error) tuples of
+                the entries given up on.
+
+        """
+        now = time.time()
+        given_up = []
+        with self._lock, self._db:
+            for entry_id, error in failures:
+                row = self._db.execute(
+                    "SELECT attempts, spreadsheet_id, tenant, chat_id, payload "
+                    "FROM entries WHERE id = ?",
+                    (entry_id,),
+                ).fetchone()
+                if row is None:
+                    continue
+                attempts, spreadsheet_id, tenant, chat_id, payload = row
+                attempts += 1
+                failed = attempts >= MAX_ATTEMPTS
+                self._db.execute(
+                    "UPDATE entries SET attempts = ?, failed = ?, next_attempt = ?, "
+                    "error = ? WHERE id = ?",
+                    (
+                        attempts,
+                        failed,
+                        now + min(MAX_BACKOFF, RETRY_BACKOFF * 2 ** (attempts - 1)),
+                        str(error),
+                        entry_id,
+                    ),
+                )
+                if failed:
+                    logging.error(
+                        "Giving up on expense after %s attempts -> %s (%s)",
+                        attempts,
+                        payload,
+                        error,
+                    )
+                    given_up.append(
+                        (
+                            entry_id,
+                            spreadsheet_id,
+                            tenant,
+                            chat_id,
+                            load_expense(payload),
+                            str(error),
+                        )
+                    )
+        return given_up
+
+    def __len__(self):
+        """Number of entries waiting to be written (failed ones excluded)."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM entries WHERE NOT failed"
+            ).fetchone()[0]
+
+
+def load_expense(payload):
+    """Expense stored in a journal entry."""
+    *fields, date = json.loads(payload)
+    return (*fields, datetime.datetime.strptime(date, DATE_FORMAT))
+
+
+class JournalFlusher(threading.Thread):
+    """Background worker draining the journal to GSheets.
+
+    Pending entries are written in batches, grouped by user and spreadsheet,
+    through `write_func(spreadsheet_id, expenses, tenant, user_id)`, which
+    returns the error of each expense (None if written). Groups are written in
+    parallel, so a slow spreadsheet doesn't delay the writes to the others. Rate limits and
+    server errors are retried with jittered exponential backoff; other errors
+    count as a failed attempt for the entries involved, and the entries given
+    up on are passed to `on_failure(entries)` (see `ExpenseJournal.fail`).
+
+    """
+
+    def __init__(
+        self,
+        journal,
+        write_func,
+        batch_size=BATCH_SIZE,
+        interval=FLUSH_INTERVAL,
+        max_backoff=MAX_BACKOFF,
+        workers=FLUSH_WORKERS,
+        on_failure=None,
+    ):
+        super().__init__(name="journal-flusher", daemon=True)
+        self.journal = journal
+        self._on_failure = on_failure
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self._write = write_func
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="journal-writer"
+        )
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        # Replay whatever was left from a previous run as soon as we start
+        self._wakeup.set()
+
+    def wake(self):
+        """Flush as soon as possible."""
+        self._wakeup.set()
+
+    def stop(self):
+        """Stop the worker."""
+        self._stopped.set()
+        self._wakeup.set()
+
+    def run(self):
+        failures = 0
+        while not self._stopped.is_set():
+            timeout = self.interval
+            if failures:
+                timeout = min(self.max_backoff, 2**failures) * random.uniform(0.5, 1)
+            self._wakeup.wait(timeout=timeout)
+            self._wakeup.clear()
+            try:
+                while self.flush() >= self.batch_size:
+                    pass
+                failures = 0
+            except Exception as error:  # pylint: disable=broad-except
+                if not gsheet.is_retryable(error):
+                    logging.exception("Error flushing journal")
+                    continue
+                failures += 1
+                STATS.incr("sheets.retries")
+                logging.warning(
+                    "Flushing journal failed, retrying (%s) -> %s", failures, error
+                )
+
+    def flush(self):
+        """Write one batch of pending entries.
+
+        Return:
+            int: Number of entries of the largest group processed.
+
+        Raise:
+            Exception: If a write failed with a retryable error.
+
+        """
+        entries = self.journal.pending(self.batch_size)
+        groups = {}
+        for entry_id, spreadsheet_id, tenant, user_id, expense in entries:
+            groups.setdefault((spreadsheet_id, tenant, user_id), []).append(
+                (entry_id, expense)
+            )
+        outcomes = self._pool.map(
+            lambda item: self._write(
+                item[0][0], [expense for _, expense in item[1]], *item[0][1:]
+            ),
+            groups.items(),
+        )
+        retry_error = None
+        for ((spreadsheet_id, *_), group), errors in zip(groups.items(), outcomes):
+            written, failed = [], []
+            for (entry_id, _), error in zip(group, errors):
+                if error is None:
+                    written.append(entry_id)
+                elif gsheet.is_retryable(error):
+                    retry_error = error
+                else:
+                    failed.append((entry_id, error))
+            self.journal.remove(written)
+            given_up = self.journal.fail(failed)
+            if given_up and self._on_failure:
+                self._on_failure(given_up)
+            logging.debug("Flushed %s expenses to %s", len(written), spreadsheet_id)
+        if retry_error:
+            raise retry_error
+        return max((len(group) for group in groups.values()), default=0)
+
+
+# EOF
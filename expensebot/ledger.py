@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   ledger.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Local ledger of the rows written to GSheets."""
+
+import datetime
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from expensebot.messages import normalize_concept
+
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+# Seconds during which an expense identical to a recent one is ignored
+DUPLICATE_WINDOW = 120
+
+LedgerEntry = namedtuple(
+    "LedgerEntry", ["id", "spreadsheet_id", "worksheet", "row", "kind", "fields", "created"]
+)
+
+
+def expense_digest(concept, value, currency, date):
+    """Hash identifying an expense: concept, amount, currency and day."""
+    key = "\x1f".join(
+        (
+            normalize_concept(concept),
+            value.replace(",", "."),
+            currency.upper(),
+            date.strftime("%Y-%m-%d"),
+        )
+    )
+    return hashlib.sha1(key.encode("utf8")).hexdigest()
+
+
+class ExpenseLedger:
+    """SQLite ledger of the expense and investment rows written by the bot.
+
+    Each entry keeps the worksheet and row it was written to, so the latest
+    entries of a Telegram user are found with an index lookup and can be
+    undone without reading the sheet. Users without their own configuration
+    share the global spreadsheets, so entries are kept by user id rather than
+    by tenant. Expenses also keep a digest (see `expense_digest`) to spot
+    re-sent messages.
+
+    Arguments:
+        path (str): SQLite database file.
+        window (float): Seconds during which an expense identical to a recent
+            one is a duplicate (0 to allow them).
+
+    """
+
+    def __init__(self, path, window=DUPLICATE_WINDOW):
+        self.window = window
+        self._lock = threading.Lock()
+        # (tenant, digest) -> time of the expenses accepted but maybe not written yet
+        self._accepted = {}
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS rows ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "tenant TEXT, "
+                "spreadsheet_id TEXT NOT NULL, "
+                "worksheet TEXT NOT NULL, "
+                "row INTEGER NOT NULL, "
+                "kind TEXT NOT NULL, "
+                "digest TEXT, "
+                "payload TEXT NOT NULL, "
+                "created REAL NOT NULL, "
+                "user_id INTEGER)"
+            )
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(rows)")]
+            if "user_id" not in columns:
+                # Ledgers of older versions kept rows by tenant, which is the
+                # user id of configured users
+                self._db.execute("ALTER TABLE rows ADD COLUMN user_id INTEGER")
+                self._db.execute(
+                    "UPDATE rows SET user_id = CAST(tenant AS INTEGER) "
+                    "WHERE tenant IS NOT NULL"
+                )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS rows_tenant ON rows (tenant, id)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS rows_user ON rows (user_id, id)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS rows_digest ON rows (digest, created)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS rows_position "
+                "ON rows (spreadsheet_id, worksheet, row)"
+            )
+
+    def record(self, tenant, user_id, spreadsheet_id, worksheet, entries):
+        """Add written rows to the ledger.
+
+        Arguments:
+            tenant (str): User the rows belong to, None for the global configuration.
+            user_id (int): Telegram user who sent them, None if not sent through
+                Telegram.
+            spreadsheet_id (str): Spreadsheet the rows were written to.
+            worksheet (str): Worksheet the rows were written to.
+            entries (list): (row, kind, fields) tuples, with `fields` a dict of
+                JSON serializable values and datetimes. Fields of expenses are
+                the ones of `Expense`.
+
+        """
+        now = time.time()
+        rows = [
+            (
+                tenant,
+                spreadsheet_id,
+                worksheet,
+                row,
+                kind,
+                expense_digest(
+                    fields["concept"], fields["value"], fields["currency"], fields["date"]
+                )
+                if kind == "expense"
+                else None,
+                json.dumps(
+                    {
+                        name: value.strftime(DATE_FORMAT)
+                        if isinstance(value, datetime.datetime)
+                        else value
+                        for name, value in fields.items()
+                    },
+                    ensure_ascii=False,
+                ),
+                now,
+                user_id,
+            )
+            for row, kind, fields in entries
+        ]
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT INTO rows (tenant, spreadsheet_id, worksheet, row, kind, "
+                "digest, payload, created, user_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def last(self, user_id, count=1):
+        """Get the latest entries of a Telegram user, newest first."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, spreadsheet_id, worksheet, row, kind, payload, created "
+                "FROM rows WHERE user_id IS ? ORDER BY id DESC LIMIT ?",
+                (user_id, count),
+            ).fetchall()
+        entries = []
+        for entry_id, spreadsheet_id, worksheet, row, kind, payload, created in rows:
+            fields = json.loads(payload)
+            if "date" in fields:
+                fields["date"] = datetime.datetime.strptime(fields["date"], DATE_FORMAT)
+            entries.append(
+                LedgerEntry(
+                    entry_id, spreadsheet_id, worksheet, row, kind, fields, created
+                )
+            )
+        return entries
+
+    def remove(self, entry):
+        """Forget an entry whose row was deleted from its worksheet.
+
+        The rows below it moved one up, so the entries pointing to them are
+        updated too.
+
+        """
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM rows WHERE id = ?", (entry.id,))
+            self._db.execute(
+                "UPDATE rows SET row = row - 1 "
+                "WHERE spreadsheet_id = ? AND worksheet = ? AND row > ?",
+                (entry.spreadsheet_id, entry.worksheet, entry.row),
+            )
+
+    def accept(self, tenant, expenses):
+        """Check for duplicates of recent expenses and remember the new ones.
+
+        Expenses are compared with the ones written or accepted in the last
+        `window` seconds, but not among themselves, so the same expense can
+        be repeated on purpose within a message.
+
+        Arguments:
+            tenant (str): User the expenses belong to, None for the global configuration.
+            expenses (list): (concept, value, currency, category, date) tuples.
+
+        Return:
+            list: For each expense, the time of the recent expense it duplicates,
+                or None if it's new.
+
+        """
+        digests = [
+            expense_digest(concept, value, currency, date)
+            for concept, value, currency, _, date in expenses
+        ]
+        now = time.time()
+        since = now - self.window
+        with self._lock:
+            self._accepted = {
+                key: accepted
+                for key, accepted in self._accepted.items()
+                if accepted >= since
+            }
+            duplicates = []
+            for digest in digests:
+                accepted = self._accepted.get((tenant, digest))
+                if accepted is None:
+                    row = self._db.execute(
+                        "SELECT MAX(created) FROM rows "
+                        "WHERE digest = ? AND tenant IS ? AND created >= ?",
+                        (digest, tenant, since),
+                    ).fetchone()
+                    accepted = row[0]
+                duplicates.append(accepted)
+            for digest, duplicate in zip(digests, duplicates):
+                if duplicate is None:
+                    self._accepted[(tenant, digest)] = now
+        return duplicates
+
+    def release(self, tenant, expenses):
+        """Forget accepted expenses that could not be written, so they can be sent again.
+
+        Written expenses are still found in the ledger, so only the ones
+        never recorded stop being duplicates.
+
+        Arguments:
+            tenant (str): User the expenses belong to, None for the global configuration.
+            expenses (list): (concept, value, currency, category, date) tuples.
+
+        """
+        with self._lock:
+            for concept, value, currency, _, date in expenses:
+                self._accepted.pop(
+                    (tenant, expense_digest(concept, value, currency, date)), None
+                )
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM rows").fetchone()[0]
+
+
+# EOF
@@ -8,39 +8,103 @@
 """Message parsing."""
 
 import re
+import os
+import json
 import logging
+import threading
+import time
+import datetime
+from collections import Counter, namedtuple
+from functools import lru_cache, partial
 from pathlib import Path
-import yaml
 
-import importlib_resources as resources
-from fuzzywuzzy import fuzz, process
-import datefinder
+# fuzzywuzzy, datefinder, yaml and importlib_resources are slow to import and
+# are only imported when first needed
+
+from expensebot.stats import STATS
+
+
+# Without any of these (digits, month or weekday names) datefinder cannot find a date
+DATE_HINT_REGEX = re.compile(r'\d|jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec'
+                             r'|mon|tue|wed|thu|fri|sat|sun', re.IGNORECASE)
+DATE_CACHE_SIZE = 1024
+CURRENCIES = ('CHF', 'EUR')
+MONTHS = ('january', 'february', 'march', 'april', 'may', 'june', 'july', 'august',
+          'september', 'october', 'november', 'december')
+MONTH_NUMBERS = dict({month: num for num, month in enumerate(MONTHS, 1)},
+                     **{month[:3]: num for num, month in enumerate(MONTHS, 1)})
+NUMERIC_DATE_REGEX = re.compile(r'^(\d{1,2})([/.])(\d{1,2})\2(\d{4})$')
+ISO_DATE_REGEX = re.compile(r'^(\d{4})-(\d{1,2})-(\d{1,2})$')
+NAMED_DATE_REGEX = re.compile(r'^(?:([a-z]+)\s+(\d{1,2})|(\d{1,2})\s+([a-z]+))$', re.IGNORECASE)
+
+
+def preload():
+    """Import the parsing dependencies, so the first message doesn't wait for them."""
+    # pylint: disable=import-outside-toplevel,unused-import
+    import datefinder  # noqa: F401
+    from fuzzywuzzy import fuzz  # noqa: F401
 
 
 class ParseError(Exception):
     """Parsing error."""
 
 
+def find_dates(text):
+    """Find dates in text.
+
+    Equivalent to `datefinder.find_dates(text, source=True)`, but text that
+    cannot hold a date skips datefinder altogether, and results are cached
+    per text and day (relative dates depend on the current day).
+
+    Return:
+        tuple: (date, source text) pairs.
+
+    """
+    if not DATE_HINT_REGEX.search(text):
+        return ()
+    return _find_dates_cached(text, datetime.date.today())
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def _find_dates_cached(text, _today):
+    import datefinder  # pylint: disable=import-outside-toplevel
+    return tuple(datefinder.find_dates(text, source=True))
+
+
 class MessageParser:
     """Message parser."""
 
     def __init__(self, categories, matcher_classes):
+        self._category_matchers = []
+        # Categories can be replaced from other threads while parsing
+        self._categories_lock = threading.RLock()
         self.set_categories(categories)
         self._category_matchers = [matcher_class(self.categories)
                                    for matcher_class in matcher_classes]
 
     def set_categories(self, categories):
-        """Set internal category list."""
-        self.categories = {cat.lower(): cat for cat in categories}
+        """Set internal category list and propagate it to the matchers.
+
+        The parser and all its matchers switch to the new list at once.
+
+        """
+        categories = {cat.lower(): cat for cat in categories}
+        with self._categories_lock:
+            self.categories = categories
+            for matcher in self._category_matchers:
+                matcher.set_categories(self.categories)
 
     def get_category(self, concept, category):
         matched_cat = None
-        for matcher in self._category_matchers:
-            matched_cat = matcher.match(concept, category)
-            if matched_cat:
-                logging.debug("Matched category by %s -> %s", matcher, matched_cat)
-                break
-        return self.categories.get(matched_cat, None)
+        with self._categories_lock:
+            for matcher in self._category_matchers:
+                with STATS.timer('parse.match.' + type(matcher).__name__):
+                    matched_cat = matcher.match(concept, category)
+                if matched_cat:
+                    STATS.incr('parse.matched.' + type(matcher).__name__)
+                    logging.debug("Matched category by %s -> %s", matcher, matched_cat)
+                    break
+            return self.categories.get(matched_cat, None)
 
     def parse(self, message):
         """Parse the message.
@@ -52,20 +116,160 @@ class MessageParser:
         raise NotImplementedError
 
 
+def currency_regex(currencies):
+    """Build the regex matching an expense value with an optional currency."""
+    # Longest first, so that currencies prefixing others don't shadow them
+    currencies = sorted(currencies, key=len, reverse=True)
+    return re.compile(r'(-?\d+(?:[.,]\d{{1,2}})?)\s?({})?'.format('|'.join(map(re.escape, currencies))),
+                      re.IGNORECASE)
+
+
+def token_regex(currencies):
+    """Build the regex splitting an expense line into date, value and word tokens.
+
+    Tokens end at a space or at trailing punctuation (like in "30 CHF, super"),
+    the same characters `TOKEN_REGEX` strips from concepts.
+
+    """
+    currencies = sorted(currencies, key=len, reverse=True)
+    months = '|'.join(sorted(MONTH_NUMBERS, key=len, reverse=True))
+    return re.compile(r'(?:(?P<date>\d{{4}}-\d{{1,2}}-\d{{1,2}}'
+                      r'|\d{{1,2}}(?P<sep>[/.])\d{{1,2}}(?P=sep)\d{{2,4}}|\d{{1,2}}/\d{{1,2}}'
+                      r'|(?:{months})\s+\d{{1,2}})|(?P<day_month>\d{{1,2}}\s+(?:{months}))'
+                      r'|(?P<value>-?\d+(?:[.,]\d{{1,2}})?)(?:\s?(?P<currency>{currencies}))?'
+                      r'|(?P<word>\S+))(?=[\s,;:.)]|$)'.format(months=months,
+                                                              currencies='|'.join(map(re.escape, currencies))),
+                      re.IGNORECASE)
+
+
+ExpenseTokens = namedtuple('ExpenseTokens', ['concept', 'value', 'currency', 'category', 'dates', 'span'])
+
+
+class ExpenseTokenizer:
+    """Single pass tokenizer of expense lines.
+
+    Splits a line into whitespace separated tokens with one scan of a
+    precompiled regex. The value is the first standalone number, with an
+    optional currency, so numbers within words ("7eleven") and dates are not
+    taken as the value. Lines where a day and month name pair comes before
+    the value, which cannot be told apart from a value followed by a month
+    name, are left to the value regex.
+
+    """
+
+    def __init__(self, currencies=CURRENCIES):
+        self.regex = token_regex(currencies)
+
+    def tokenize(self, line):
+        """Split a line around the expense value.
+
+        Return:
+            ExpenseTokens: Text before the value, value, currency, text after the
+                value, date texts and (start, end) span of the value, or None if
+                there is no standalone value.
+
+        """
+        value = None
+        dates = []
+        for match in self.regex.finditer(line):
+            kind = match.lastgroup
+            if kind == 'word':
+                continue
+            if kind == 'day_month' and value is None:
+                return None
+            if kind in ('date', 'day_month'):
+                dates.append(match.group())
+            elif value is None:
+                value = match
+        if value is None:
+            return None
+        start, end = value.span()
+        return ExpenseTokens(line[:start].strip(), value.group('value'), value.group('currency'),
+                             line[end:].strip(), dates, (start, end))
+
+
+def parse_date_token(text):
+    """Read a date token the way datefinder does, if it's unambiguous.
+
+    Handles numeric dates with a four digit year (the day goes first only if it
+    cannot be the month, like in dateutil), ISO dates, and day and month name
+    pairs in the current year.
+
+    Return:
+        datetime.datetime: The date, or None if it has to be left to datefinder.
+
+    """
+    try:
+        match = NUMERIC_DATE_REGEX.match(text)
+        if match:
+            first, _, second, year = match.groups()
+            first, second = int(first), int(second)
+            if first > 31:
+                return None
+            month, day = (second, first) if first > 12 else (first, second)
+            return datetime.datetime(int(year), month, day)
+        match = ISO_DATE_REGEX.match(text)
+        if match:
+            return datetime.datetime(*map(int, match.groups()))
+        match = NAMED_DATE_REGEX.match(text)
+        if match:
+            month, day, day_first, month_last = match.groups()
+            if day_first:
+                day, month = day_first, month_last
+            if month.lower() not in MONTHS:
+                return None
+            return datetime.datetime(datetime.date.today().year, MONTH_NUMBERS[month.lower()], int(day))
+    except ValueError:
+        pass
+    return None
+
+
 class RegexParser(MessageParser):
     """Parser based on regexes."""
 
-    CURRENCY_REGEX = re.compile(r'(-?\d+(?:[.,]\d{1,2})?)\s?(CHF|EUR)?', re.IGNORECASE)
+    CURRENCY_REGEX = currency_regex(CURRENCIES)
+
+    def __init__(self, categories, matcher_classes, currencies=None):
+        super().__init__(categories, matcher_classes)
+        if currencies:
+            self.CURRENCY_REGEX = currency_regex(currencies)
 
     def parse(self, message):
+        with STATS.timer('parse'):
+            with STATS.timer('parse.regex'):
+                value, currency, concept, cat = self.split_value(message)
+            # First let's check dates
+            with STATS.timer('parse.dates'):
+                date, concept, cat = self.extract_date(concept, cat)
+            # Now match categories
+            logging.debug("Found category -> %s", cat)
+            category = self.get_category(concept, cat)
+        return concept, value, currency, category, date
+
+    def split_value(self, message):
+        """Split the message around the expense value.
+
+        Return:
+            tuple: Value, currency, text before the value, text after the value.
+
+        """
         match = self.CURRENCY_REGEX.search(message)
         if not match:
             raise ParseError("Cannot find expense value/currency")
         value, currency = match.groups()
         concept = message[:match.start()].strip()
         cat = message[match.end():].strip()
-        # First let's check dates
-        found_dates = list(datefinder.find_dates(concept + cat, source=True))
+        return value, currency, concept, cat
+
+    @staticmethod
+    def extract_date(concept, cat):
+        """Find the expense date and remove it from the concept and category texts.
+
+        Return:
+            tuple: Date (None if not found), concept, category text.
+
+        """
+        found_dates = find_dates(concept + cat)
         if len(found_dates) > 1:
             logging.error("Found too many dates in text, setting as None -> %s", found_dates)
             date = None
@@ -76,22 +280,100 @@ class RegexParser(MessageParser):
             logging.debug("Found date -> %s", date)
         else:
             date = None
-        # Now match categories
-        logging.debug("Found category -> %s", cat)
-        category = self.get_category(concept, cat)
+        return date, concept, cat
+
+
+class TokenParser(RegexParser):
+    """Parser splitting messages with a single pass tokenizer.
+
+    Same output as `RegexParser`, but lines without date hints skip the date
+    search, and a single unambiguous date token is read directly instead of
+    going through datefinder. Anything else falls back to `RegexParser`.
+
+    """
+
+    def __init__(self, categories, matcher_classes, currencies=None):
+        super().__init__(categories, matcher_classes, currencies)
+        self.tokenizer = ExpenseTokenizer(currencies or CURRENCIES)
+
+    def parse(self, message):
+        with STATS.timer('parse'):
+            with STATS.timer('parse.tokenize'):
+                tokens = self.tokenizer.tokenize(message)
+            with STATS.timer('parse.dates'):
+                if tokens is None:
+                    # No standalone value, let the value regex look within words
+                    value, currency, concept, cat = self.split_value(message)
+                    date, concept, cat = self.extract_date(concept, cat)
+                else:
+                    value, currency = tokens.value, tokens.currency
+                    date, concept, cat = self.tokens_date(tokens)
+            logging.debug("Found category -> %s", cat)
+            category = self.get_category(concept, cat)
         return concept, value, currency, category, date
 
+    def tokens_date(self, tokens):
+        """Find the expense date in the tokens and remove it from the texts.
+
+        Return:
+            tuple: Date (None if not found), concept, category text.
+
+        """
+        concept, cat = tokens.concept, tokens.category
+        if not tokens.dates:
+            if DATE_HINT_REGEX.search(concept) or DATE_HINT_REGEX.search(cat):
+                return self.extract_date(concept, cat)
+            return None, concept, cat
+        if len(tokens.dates) == 1:
+            source_date = tokens.dates[0]
+            date = parse_date_token(source_date)
+            if date and not DATE_HINT_REGEX.search((concept + cat).replace(source_date, '')):
+                STATS.incr('parse.dates.token')
+                return date, concept.replace(source_date, ''), cat.replace(source_date, '')
+        return self.extract_date(concept, cat)
+
 
 class FuzzyMatcherMixin:
-    """Add fuzzy category matching."""
+    """Add fuzzy category matching.
+
+    Scores are the same as `process.extractOne` with `fuzz.partial_ratio`, but
+    candidates are preprocessed once per category list and results are memoized
+    by the normalized category text.
+
+    """
+
+    CACHE_SIZE = 1024
 
     def __init__(self, categories):
+        self.set_categories(categories)
+
+    def set_categories(self, categories):
+        """Precompute the match candidates and reset the match cache."""
+        from fuzzywuzzy import utils  # pylint: disable=import-outside-toplevel
         self.categories = categories
+        # Same preprocessing that process.extractOne applies to each choice
+        candidates = [(utils.full_process(cat), cat) for cat in categories]
+        self._best_match = lru_cache(maxsize=self.CACHE_SIZE)(
+            lambda query: self._extract_one(query, candidates))
+
+    @staticmethod
+    def _extract_one(query, candidates):
+        from fuzzywuzzy import fuzz  # pylint: disable=import-outside-toplevel
+        best_cat, best_score = None, -1
+        for processed, cat in candidates:
+            score = fuzz.partial_ratio(query, processed)
+            # Keep the first best match, like max() does in process.extractOne
+            if score > best_score:
+                best_cat, best_score = cat, score
+                if score == 100:
+                    break
+        return best_cat, best_score
 
     def match(self, _, category):
-        if not category:
+        if not category or not self.categories:
             return None
-        matched_cat, score = process.extractOne(category.lower(), list(self.categories.keys()), scorer=fuzz.partial_ratio)
+        from fuzzywuzzy import utils  # pylint: disable=import-outside-toplevel
+        matched_cat, score = self._best_match(utils.full_process(category.lower()))
         logging.debug("Fuzzywuzzy match -> %s with score %s", matched_cat, score)
         if score < 75:
             matched_cat = None
@@ -100,33 +382,239 @@ class FuzzyMatcherMixin:
         return matched_cat
 
 
+def normalize_concept(concept):
+    """Normalize a concept for lookups: lower case, single spaces."""
+    return ' '.join(concept.lower().split())
+
+
+class ConceptMemory:
+    """Persistent concept -> category frequency index.
+
+    Counts how many times each (normalized) concept has been written with each
+    category, and stores them as JSON.
+
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        # Serializes writers of the file, which share the temporary path
+        self._save_lock = threading.Lock()
+        self._counts = {}
+        if path:
+            self.load()
+
+    def __len__(self):
+        return len(self._counts)
+
+    def load(self):
+        """Load the index from disk."""
+        try:
+            with open(self.path, 'rt', encoding='utf8') as input_file:
+                counts = json.load(input_file)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logging.warning("Ignoring corrupt concept memory %s", self.path)
+            return
+        with self._lock:
+            self._counts = {concept: Counter(categories) for concept, categories in counts.items()}
+
+    def save(self):
+        """Store the index on disk."""
+        if not self.path:
+            return
+        with self._lock:
+            data = json.dumps(self._counts, ensure_ascii=False)
+        tmp_path = self.path + '.tmp'
+        with self._save_lock:
+            with open(tmp_path, 'wt', encoding='utf8') as output_file:
+                output_file.write(data)
+            os.replace(tmp_path, self.path)
+
+    def learn(self, expenses):
+        """Count (concept, category) pairs."""
+        with self._lock:
+            for concept, category in expenses:
+                concept = normalize_concept(concept)
+                if concept and category:
+                    self._counts.setdefault(concept, Counter())[category] += 1
+
+    def best(self, concept):
+        """Most frequent category of a concept.
+
+        Return:
+            tuple: Category, its count and the total count of the concept (None, 0, 0 if unknown).
+
+        """
+        with self._lock:
+            counts = self._counts.get(normalize_concept(concept))
+            if not counts:
+                return None, 0, 0
+            category, count = counts.most_common(1)[0]
+            return category, count, sum(counts.values())
+
+
 class RepetitionMatcherMixin:
-    """Add category matching through repetition."""
+    """Add category matching through repetition.
+
+    Concepts seen at least `THRESHOLD_APPEARENCES` times, mostly with the same
+    category, get that category. If a category text is given, it must be the
+    start of the learned category, so an explicit different category is left
+    to the other matchers.
+
+    """
 
     THRESHOLD_APPEARENCES = 10
 
-    def __init__(self, categories):
-        pass
+    def __init__(self, categories, memory=None, threshold=None):
+        self.memory = memory
+        if threshold is not None:
+            self.THRESHOLD_APPEARENCES = threshold
+        self.set_categories(categories)
+
+    def set_categories(self, categories):
+        self.categories = categories
+
+    def match(self, concept, category):
+        if self.memory is None or not concept:
+            return None
+        learned, count, total = self.memory.best(concept)
+        if count < self.THRESHOLD_APPEARENCES or 2 * count <= total:
+            return None
+        learned = learned.lower()
+        if learned not in self.categories:
+            return None
+        if category and not learned.startswith(normalize_concept(category)):
+            return None
+        logging.debug("Repetition match -> %s (%s out of %s)", learned, count, total)
+        return learned
+
+
+TOKEN_REGEX = re.compile(r"[^\s,;:.()]+")
+
+
+class FixedCategoryTable:
+    """Compiled fixed concept -> category table.
+
+    Besides exact concepts, every fixed concept is indexed by its first token,
+    so that it also matches when it appears as a sequence of tokens within a
+    concept ("Migros Zurich" -> "migros"). Earlier and longer sequences win.
+    The file is reloaded when its modification time changes, checked at most
+    every `CHECK_INTERVAL` seconds.
+
+    """
+
+    CHECK_INTERVAL = 5
+
+    def __init__(self, path):
+        self.path = Path(str(path))
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked = 0
+        self.exact = {}
+        self.tokens = {}
+        self.reload()
+
+    def reload(self):
+        """Load and compile the table if the file changed."""
+        mtime = self.path.stat().st_mtime
+        if mtime == self._mtime:
+            return
+        import yaml  # pylint: disable=import-outside-toplevel
+        with open(self.path, 'rt', encoding='utf8') as input_file:
+            # The C loader is much faster, if available
+            loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+            fixed_categories = yaml.load(input_file, Loader=loader) or {}
+        exact = {str(concept).lower(): category for concept, category in fixed_categories.items()}
+        tokens = {}
+        for concept, category in exact.items():
+            concept_tokens = tuple(TOKEN_REGEX.findall(concept))
+            if concept_tokens:
+                tokens.setdefault(concept_tokens[0], []).append((concept_tokens, category))
+        for candidates in tokens.values():
+            candidates.sort(key=lambda candidate: len(candidate[0]), reverse=True)
+        # Swap both at once, lookups can run concurrently
+        self.exact, self.tokens = exact, tokens
+        self._mtime = mtime
+        logging.debug("Loaded %s fixed categories from %s", len(exact), self.path)
+
+    def _check(self):
+        now = time.monotonic()
+        if now - self._checked < self.CHECK_INTERVAL:
+            return
+        with self._lock:
+            if now - self._checked < self.CHECK_INTERVAL:
+                return
+            self._checked = now
+            import yaml  # pylint: disable=import-outside-toplevel
+            try:
+                self.reload()
+            except (OSError, yaml.YAMLError):
+                logging.exception("Cannot reload fixed categories, keeping the loaded ones")
+
+    def lookup(self, concept):
+        """Get the fixed category of a concept (None if there is none)."""
+        self._check()
+        exact, index = self.exact, self.tokens
+        concept = concept.lower()
+        category = exact.get(concept)
+        if category:
+            return category
+        concept_tokens = TOKEN_REGEX.findall(concept)
+        for position, token in enumerate(concept_tokens):
+            for candidate_tokens, category in index.get(token, ()):
+                if tuple(concept_tokens[position:position + len(candidate_tokens)]) == candidate_tokens:
+                    return category
+        return None
+
+
+_FIXED_TABLES = {}
+_FIXED_TABLES_LOCK = threading.Lock()
+
+
+def fixed_table(path):
+    """Get the shared fixed category table of a file, loading it the first time."""
+    with _FIXED_TABLES_LOCK:
+        table = _FIXED_TABLES.get(str(path))
+        if table is None:
+            table = _FIXED_TABLES[str(path)] = FixedCategoryTable(path)
+        return table
 
 
 class FixedMatcherMixin:
     """Add fixed category mixin."""
 
-    INPUT_CATEGORIES = resources.files("expensebot") / "data" / "fixed_cats.yaml"
+    # Defaults to data/fixed_cats.yaml of the package
+    INPUT_CATEGORIES = None
 
     def __init__(self, categories):
-        with open(self.INPUT_CATEGORIES, 'rt', encoding='utf8') as input_file:
-            self.fixed_categories = yaml.safe_load(input_file)
+        input_categories = self.INPUT_CATEGORIES
+        if input_categories is None:
+            import importlib_resources as resources  # pylint: disable=import-outside-toplevel
+            input_categories = resources.files("expensebot") / "data" / "fixed_cats.yaml"
+        self.fixed_table = fixed_table(input_categories)
+        self.categories = categories
+
+    @property
+    def fixed_categories(self):
+        """Exact concept -> category mapping."""
+        return self.fixed_table.exact
+
+    def set_categories(self, categories):
         self.categories = categories
 
     def match(self, concept, _):
-        return self.fixed_categories.get(concept.lower(), None)
+        return self.fixed_table.lookup(concept)
 
 
-class ExpenseParser(RegexParser):
+class ExpenseParser(TokenParser):
     """Full expense parser."""
 
-    def __init__(self, categories):
-        super().__init__(categories, [FuzzyMatcherMixin, FixedMatcherMixin])
+    def __init__(self, categories, currencies=None, memory=None, threshold=None):
+        super().__init__(categories,
+                         [partial(RepetitionMatcherMixin, memory=memory, threshold=threshold),
+                          FuzzyMatcherMixin, FixedMatcherMixin],
+                         currencies)
 
 # EOF
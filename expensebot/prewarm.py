@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   prewarm.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Background preparation of the worksheets and categories of coming months."""
+
+import datetime
+import logging
+import threading
+
+
+# Days before the end of a month when the next one is prepared
+LEAD_DAYS = 2
+# Seconds between checks
+PREWARM_INTERVAL = 3600
+
+
+def next_month(date):
+    """First day of the month after the given date."""
+    year, month = divmod(date.year * 12 + date.month, 12)
+    return datetime.datetime(year, month + 1, 1)
+
+
+class Prewarmer(threading.Thread):
+    """Background worker preparing what the next messages will need.
+
+    Runs `prewarm_func(date)` every `interval` seconds for the current day and,
+    when less than `lead_days` days are left in the month, for the first day
+    of the next one, so that the first expense of a month (or year) doesn't
+    wait for its worksheet to be created or its categories to be fetched. It
+    also wakes up when a month starts, so the new month is picked up right
+    away.
+
+    """
+
+    def __init__(self, prewarm_func, lead_days=LEAD_DAYS, interval=PREWARM_INTERVAL):
+        super().__init__(name="prewarmer", daemon=True)
+        self.lead = datetime.timedelta(days=lead_days)
+        self.interval = interval
+        self._prewarm = prewarm_func
+        self._stopped = threading.Event()
+
+    def stop(self):
+        """Stop the worker."""
+        self._stopped.set()
+
+    def targets(self, now=None):
+        """Dates to prepare at the given time (now by default)."""
+        now = now or datetime.datetime.today()
+        targets = [now]
+        if next_month(now) - now <= self.lead:
+            targets.append(next_month(now))
+        return targets
+
+    def run(self):
+        while not self._stopped.is_set():
+            for date in self.targets():
+                try:
+                    self._prewarm(date)
+                except Exception:  # pylint: disable=broad-except
+                    logging.exception("Error preparing %s", date.strftime("%m/%Y"))
+            now = datetime.datetime.today()
+            timeout = min(self.interval, (next_month(now) - now).total_seconds() + 1)
+            self._stopped.wait(timeout=timeout)
+
+
+# EOF
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   rates.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Local index of the daily exchange rate worksheets."""
+
+import datetime
+import logging
+import threading
+import time
+
+import expensebot.gsheet as gsheet
+from expensebot.stats import STATS
+
+
+# Reload a rate worksheet missing the requested date after this many seconds
+RATES_TTL = 600
+# Day zero of GSheets date serial numbers
+SERIAL_EPOCH = datetime.date(1899, 12, 30)
+
+
+def rate_sheet_name(year, currency, ref_currency):
+    """Name of the worksheet holding the daily rates of a year."""
+    return "{} {}{}".format(year, currency, ref_currency).upper()
+
+
+def sheet_ref(sheet_name, cell):
+    """Reference to a cell of another worksheet."""
+    return "'{}'!{}".format(sheet_name.replace("'", "''"), cell)
+
+
+def day_key(date):
+    """Index of a date in the rate tables."""
+    return date.month, date.day
+
+
+class RateTable:
+    """Daily rates of one '<year> <CUR><REF>' worksheet.
+
+    Column A holds the dates and column B the rates. Rows are indexed by
+    (month, day), like the formulas written to the expense worksheets.
+
+    Arguments:
+        sheet_name (str): Name of the rate worksheet.
+        values (list): Unformatted values of columns A and B, with dates as
+            serial numbers.
+
+    """
+
+    def __init__(self, sheet_name, values=()):
+        self.sheet_name = sheet_name
+        self.loaded = time.monotonic()
+        self.rows = {}
+        self.rates = {}
+        for row_num, row in enumerate(values, 1):
+            if len(row) < 2 or not isinstance(row[0], (int, float)):
+                continue
+            date = SERIAL_EPOCH + datetime.timedelta(days=int(row[0]))
+            self.rows[day_key(date)] = row_num
+            if isinstance(row[1], (int, float)):
+                self.rates[day_key(date)] = row[1]
+
+    def __contains__(self, date):
+        return day_key(date) in self.rows
+
+    def rate(self, date):
+        """Rate of the given day, or of the day before if missing (None if neither is known)."""
+        rate = self.rates.get(day_key(date))
+        if rate is None:
+            rate = self.rates.get(day_key(date - datetime.timedelta(days=1)))
+        return rate
+
+    def formula(self, date, date_cell):
+        """Formula giving the rate of the expense date.
+
+        The rate cell is referenced directly when the date is in the table. If
+        only the previous day is, the following row is checked for the date
+        (rates are usually filled in later in the day), and the previous day is
+        used otherwise. If neither is known, falls back to searching the whole
+        rate worksheet.
+
+        Arguments:
+            date (datetime.datetime): Expense date.
+            date_cell (str): Cell holding the expense date.
+
+        """
+        row = self.rows.get(day_key(date))
+        if row:
+            return sheet_ref(self.sheet_name, "B{}".format(row))
+        row = self.rows.get(day_key(date - datetime.timedelta(days=1)))
+        if row:
+            next_date = sheet_ref(self.sheet_name, "A{}".format(row + 1))
+            return (
+                "IF(AND(ISNUMBER({0}), MONTH({0}) = MONTH({1}), DAY({0}) = DAY({1})), {2}, {3})"
+            ).format(
+                next_date,
+                date_cell,
+                sheet_ref(self.sheet_name, "B{}".format(row + 1)),
+                sheet_ref(self.sheet_name, "B{}".format(row)),
+            )
+        return filter_formula(self.sheet_name, date_cell)
+
+
+def filter_formula(sheet_name, date_cell):
+    """Formula searching the rate of the expense date (or the day before) in a rate worksheet."""
+    dates = sheet_ref(sheet_name, "A:A")
+    rates = sheet_ref(sheet_name, "B:B")
+    return (
+        "IFNA("
+        "FILTER({1}, MONTH({0}) = MONTH({2}), DAY({0}) = DAY({2})), "
+        "FILTER({1}, MONTH({0}) = MONTH({2}), DAY({0}) = MINUS(DAY({2}), 1))"
+        ")"
+    ).format(dates, rates, date_cell)
+
+
+class RateCache:
+    """Rate tables of the spreadsheets, loaded once and reloaded when stale.
+
+    A table is only reloaded when asked for a date it does not hold and it is
+    older than `ttl` seconds, so the rates of the current day are picked up
+    without reading the worksheet on every expense. Rate worksheets are looked
+    up in the given `WorksheetIndex`, or in the shared one.
+
+    """
+
+    def __init__(self, ttl=RATES_TTL, worksheets=None):
+        self.ttl = ttl
+        self.worksheets = worksheets
+        self._lock = threading.Lock()
+        self._tables = {}
+
+    def get(self, spreadsheet, date, currency, ref_currency):
+        """Get the rate table covering the given date.
+
+        Return:
+            RateTable: The table, empty if the rate worksheet does not exist.
+
+        """
+        sheet_name = rate_sheet_name(date.year, currency, ref_currency)
+        key = (spreadsheet.id, sheet_name)
+        with self._lock:
+            table = self._tables.get(key)
+            if table is None or (
+                date not in table and time.monotonic() - table.loaded > self.ttl
+            ):
+                STATS.incr("cache.rates.miss")
+                table = self._load(spreadsheet, sheet_name)
+                self._tables[key] = table
+            else:
+                STATS.incr("cache.rates.hit")
+        return table
+
+    def _load(self, spreadsheet, sheet_name):
+        worksheet = gsheet.get_worksheet(
+            spreadsheet, sheet_name, False, index=self.worksheets
+        )
+        if not worksheet:
+            logging.warning("No rate worksheet %s", sheet_name)
+            return RateTable(sheet_name)
+        values = gsheet.api_call(
+            "get",
+            worksheet.get,
+            "A:B",
+            value_render_option="UNFORMATTED_VALUE",
+            date_time_render_option="SERIAL_NUMBER",
+        )
+        logging.debug("Loaded %s rows of %s", len(values), sheet_name)
+        return RateTable(sheet_name, values)
+
+    def clear(self):
+        """Forget all the tables."""
+        with self._lock:
+            self._tables.clear()
+
+
+# EOF
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   runtime.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Asyncio runtime for bot handlers."""
+
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+MAX_CONCURRENCY = 8
+
+
+class AsyncRuntime:
+    """Run bot handlers on an asyncio event loop.
+
+    Handlers are submitted from the dispatcher thread and scheduled as tasks on
+    an event loop running in its own thread, so the dispatcher is free as soon
+    as an update is submitted. Coroutine handlers run on the loop; blocking ones
+    (eg, GSheets I/O) are offloaded to a bounded executor. Updates of the same
+    chat are handled in order, and at most `max_concurrency` handlers run at a
+    time; the rest wait as pending tasks, not as threads.
+
+    """
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, workers=None):
+        self.max_concurrency = max_concurrency
+        self._loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers or max_concurrency, thread_name_prefix="handler"
+        )
+        self._thread = threading.Thread(
+            target=self._run, name="async-runtime", daemon=True
+        )
+        self._ready = threading.Event()
+        self._semaphore = None
+        # chat id -> [lock, number of pending updates]
+        self._chats = {}
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        # Created here so they are bound to the runtime loop
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._loop.call_soon(self._ready.set)
+        self._loop.run_forever()
+
+    def start(self):
+        """Start the event loop thread."""
+        self._thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        """Stop the event loop and the executor."""
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+
+    def submit(self, chat_id, handler, *args, **kwargs):
+        """Schedule a handler for an update of the given chat.
+
+        Can be called from any thread.
+
+        Return:
+            concurrent.futures.Future: Result of the handler.
+
+        """
+        return asyncio.run_coroutine_threadsafe(
+            self._handle(chat_id, handler, args, kwargs), self._loop
+        )
+
+    @property
+    def pending(self):
+        """Number of submitted updates not yet handled."""
+        return sum(count for _, count in self._chats.values())
+
+    async def _handle(self, chat_id, handler, args, kwargs):
+        chat = self._chats.setdefault(chat_id, [asyncio.Lock(), 0])
+        chat[1] += 1
+        try:
+            # Tasks reach the lock in submission order, and asyncio locks are fair
+            async with chat[0]:
+                async with self._semaphore:
+                    if asyncio.iscoroutinefunction(handler):
+                        return await handler(*args, **kwargs)
+                    return await self._loop.run_in_executor(
+                        self._executor, functools.partial(handler, *args, **kwargs)
+                    )
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("Error handling update of chat %s", chat_id)
+        finally:
+            chat[1] -= 1
+            if not chat[1]:
+                del self._chats[chat_id]
+        return None
+
+
+# EOF
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   scheduler.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Rate limited scheduling of GSheets requests."""
+
+import logging
+import random
+import threading
+import time
+
+from expensebot.stats import STATS
+
+
+# Default GSheets quota of requests per minute and user
+QUOTA_PER_MINUTE = 60
+# Requests that can be made at once after being idle
+BURST = 10
+MAX_RETRIES = 5
+BACKOFF = 1
+MAX_BACKOFF = 32
+
+
+class TokenBucket:
+    """Token bucket allowing `rate` requests per second, with bursts of `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting for it if needed.
+
+        Return:
+            float: Seconds waited.
+
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+class _PendingUpdate:
+    """Values update waiting to be sent in a batch."""
+
+    def __init__(self, range_name, values):
+        self.range_name = range_name
+        self.values = values
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class RequestScheduler:
+    """Central scheduler of GSheets requests.
+
+    Requests wait for a token of a per-minute quota before being sent, and
+    requests failing with a retryable error (see `retryable`) are retried with
+    jittered exponential backoff. Values updates of the same spreadsheet sent
+    while another one is waiting for its turn are coalesced into a single batch
+    update. If the batch fails with a non-retryable error (eg, one bad range),
+    its updates are sent again one by one, so they only fail on their own
+    errors.
+
+    Arguments:
+        retryable (callable): Tells if an exception is worth retrying.
+        quota_per_minute (int): Requests allowed per minute (None for no limit).
+        burst (int): Requests that can be made at once after being idle.
+        max_retries (int): Retries of a failed request.
+        backoff (float): Seconds to wait before the first retry.
+        max_backoff (float): Maximum seconds to wait between retries.
+
+    """
+
+    def __init__(
+        self,
+        retryable,
+        quota_per_minute=QUOTA_PER_MINUTE,
+        burst=BURST,
+        max_retries=MAX_RETRIES,
+        backoff=BACKOFF,
+        max_backoff=MAX_BACKOFF,
+    ):
+        self.retryable = retryable
+        self._lock = threading.Lock()
+        self._pending = {}
+        self.configure(quota_per_minute, burst, max_retries, backoff, max_backoff)
+
+    def configure(
+        self,
+        quota_per_minute=QUOTA_PER_MINUTE,
+        burst=BURST,
+        max_retries=MAX_RETRIES,
+        backoff=BACKOFF,
+        max_backoff=MAX_BACKOFF,
+    ):
+        """Change the quota and retry settings."""
+        self.bucket = (
+            TokenBucket(quota_per_minute / 60.0, min(burst, quota_per_minute))
+            if quota_per_minute
+            else None
+        )
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def _throttle(self):
+        if self.bucket:
+            waited = self.bucket.acquire()
+            if waited:
+                STATS.observe("sheets.throttled", waited)
+
+    def call(self, name, func, *args, **kwargs):
+        """Make a request, counting, timing and retrying it.
+
+        Arguments:
+            name (str): Name of the request in the stats.
+            func (callable): Function making the request.
+
+        """
+        return self._call(name, func, args, kwargs, throttled=False)
+
+    def call_once(self, name, func, *args, **kwargs):
+        """Make a request that is not safe to repeat, counting and timing it.
+
+        The request is not retried, since a timeout or server error doesn't
+        tell if it was carried out (eg, deleting a row twice deletes two rows).
+
+        """
+        return self._call(name, func, args, kwargs, throttled=False, retries=0)
+
+    def _call(self, name, func, args, kwargs, throttled, retries=None):
+        max_retries = self.max_retries if retries is None else retries
+        for attempt in range(max_retries + 1):
+            if not throttled:
+                self._throttle()
+            throttled = False
+            STATS.incr("sheets.calls")
+            try:
+                with STATS.timer("sheets." + name):
+                    return func(*args, **kwargs)
+            except Exception as error:
+                STATS.incr("sheets.errors")
+                if attempt == max_retries or not self.retryable(error):
+                    raise
+                wait = min(self.max_backoff, self.backoff * 2 ** attempt)
+                wait *= random.uniform(0.5, 1)
+                STATS.incr("sheets.retries")
+                logging.warning(
+                    "GSheets %s failed, retrying in %.1f s -> %s", name, wait, error
+                )
+                time.sleep(wait)
+        return None
+
+    def update(self, spreadsheet, range_name, values):
+        """Write values entered as if typed by the user, coalescing concurrent writes.
+
+        Arguments:
+            spreadsheet (Spreadsheet): Spreadsheet to write to.
+            range_name (str): Range, including the worksheet name.
+            values (list): Rows of values.
+
+        """
+        request = _PendingUpdate(range_name, values)
+        with self._lock:
+            pending = self._pending.setdefault(spreadsheet.id, [])
+            pending.append(request)
+            leader = len(pending) == 1
+        if not leader:
+            request.done.wait()
+        else:
+            # Others can join the batch while we wait for our turn
+            self._throttle()
+            with self._lock:
+                batch = self._pending.pop(spreadsheet.id)
+            try:
+                self._send(spreadsheet, batch)
+            except Exception as error:  # pylint: disable=broad-except
+                if len(batch) > 1 and not self.retryable(error):
+                    STATS.incr("sheets.split")
+                    logging.warning(
+                        "GSheets batch update of %s failed, sending its %s updates "
+                        "one by one -> %s",
+                        spreadsheet.id,
+                        len(batch),
+                        error,
+                    )
+                    for batched in batch:
+                        try:
+                            self._send(spreadsheet, [batched], throttled=False)
+                        except Exception as single_error:  # pylint: disable=broad-except
+                            batched.error = single_error
+                else:
+                    for batched in batch:
+                        batched.error = error
+            finally:
+                for batched in batch:
+                    batched.done.set()
+        if request.error:
+            raise request.error
+        return request.result
+
+    def _send(self, spreadsheet, batch, throttled=True):
+        if len(batch) == 1:
+            result = self._call(
+                "update",
+                spreadsheet.values_update,
+                (batch[0].range_name,),
+                {
+                    "params": {"valueInputOption": "USER_ENTERED"},
+                    "body": {"values": batch[0].values},
+                },
+                throttled=throttled,
+            )
+        else:
+            STATS.incr("sheets.coalesced", len(batch) - 1)
+            result = self._call(
+                "batch_update",
+                spreadsheet.values_batch_update,
+                (),
+                {
+                    "body": {
+                        "valueInputOption": "USER_ENTERED",
+                        "data": [
+                            {"range": request.range_name, "values": request.values}
+                            for request in batch
+                        ],
+                    }
+                },
+                throttled=True,
+            )
+        for request in batch:
+            request.result = result
+
+
+# EOF
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   stats.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Timing histograms and counters of the bot hot paths."""
+
+import collections
+import contextlib
+import logging
+import re
+import threading
+import time
+
+
+# Number of recent samples kept per histogram to compute the percentiles
+WINDOW = 1000
+QUANTILES = (0.5, 0.95, 0.99)
+METRIC_PREFIX = "expensebot_"
+
+
+class Histogram:
+    """Timing samples: all-time count and sum, percentiles of the recent ones."""
+
+    def __init__(self, window=WINDOW):
+        self.samples = collections.deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        """Add a sample."""
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def percentiles(self, quantiles=QUANTILES):
+        """Nearest-rank percentiles of the recent samples."""
+        samples = sorted(self.samples)
+        if not samples:
+            return [0.0] * len(quantiles)
+        return [
+            samples[min(len(samples) - 1, int(quantile * len(samples)))]
+            for quantile in quantiles
+        ]
+
+
+class Stats:
+    """Registry of timing histograms and counters.
+
+    Names are dotted paths, like "parse.dates" or "sheets.update".
+
+    """
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = collections.Counter()
+
+    def observe(self, name, seconds):
+        """Record a duration."""
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(self.window)
+            histogram.observe(seconds)
+
+    def incr(self, name, count=1):
+        """Increase a counter."""
+        with self._lock:
+            self._counters[name] += count
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Time the enclosed block, failed or not."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        """Copy of the current values.
+
+        Return:
+            tuple: Dict of name -> (count, sum, percentiles) and dict of counters.
+
+        """
+        with self._lock:
+            histograms = {
+                name: (histogram.count, histogram.total, histogram.percentiles())
+                for name, histogram in self._histograms.items()
+            }
+            counters = dict(self._counters)
+        return histograms, counters
+
+    def reset(self):
+        """Forget all the values."""
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def report(self):
+        """Human readable summary."""
+        histograms, counters = self.snapshot()
+        lines = ["{:<38}{:>7}{:>9}{:>9}{:>9}".format("timer (ms)", "n", "p50", "p95", "p99")]
+        for name in sorted(histograms):
+            count, _, percentiles = histograms[name]
+            lines.append(
+                "{:<38}{:>7}{:>9.1f}{:>9.1f}{:>9.1f}".format(
+                    name, count, *(1e3 * value for value in percentiles)
+                )
+            )
+        if counters:
+            lines.append("")
+            lines.append("{:<38}{:>7}".format("counter", "n"))
+            for name in sorted(counters):
+                lines.append("{:<38}{:>7}".format(name, counters[name]))
+        return "\n".join(lines)
+
+    def prometheus(self):
+        """Values in the Prometheus text exposition format."""
+        histograms, counters = self.snapshot()
+        lines = []
+        for name in sorted(histograms):
+            count, total, percentiles = histograms[name]
+            metric = metric_name(name) + "_seconds"
+            lines.append("# TYPE {} summary".format(metric))
+            for quantile, value in zip(QUANTILES, percentiles):
+                lines.append('{}{{quantile="{}"}} {}'.format(metric, quantile, value))
+            lines.append("{}_sum {}".format(metric, total))
+            lines.append("{}_count {}".format(metric, count))
+        for name in sorted(counters):
+            metric = metric_name(name) + "_total"
+            lines.append("# TYPE {} counter".format(metric))
+            lines.append("{} {}".format(metric, counters[name]))
+        return "\n".join(lines) + "\n"
+
+
+def metric_name(name):
+    """Prometheus metric name of a stat."""
+    return METRIC_PREFIX + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+STATS = Stats()
+
+
+class MetricsServer:
+    """Local HTTP endpoint serving the stats in the Prometheus text format."""
+
+    def __init__(self, stats=STATS, listen="127.0.0.1", port=9100):
+        from http.server import ThreadingHTTPServer  # pylint: disable=import-outside-toplevel
+
+        self.stats = stats
+        self._httpd = ThreadingHTTPServer((listen, port), self._make_handler())
+        self._thread = threading.Thread(
+            target=self._httpd.serve_forever, name="metrics-server", daemon=True
+        )
+
+    @property
+    def address(self):
+        """Address and port the server is bound to."""
+        return self._httpd.server_address
+
+    def start(self):
+        """Start serving."""
+        logging.info("Serving metrics on %s:%s/metrics", *self.address)
+        self._thread.start()
+
+    def stop(self):
+        """Stop serving."""
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def _make_handler(self):
+        from http.server import BaseHTTPRequestHandler  # pylint: disable=import-outside-toplevel
+
+        server = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            """Request handler."""
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """Serve the metrics."""
+                if self.path.rstrip("/") != "/metrics":
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = server.stats.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                logging.debug("Metrics: " + format, *args)
+
+        return MetricsHandler
+
+
+# EOF
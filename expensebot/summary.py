@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   summary.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Local aggregate of the monthly expenses."""
+
+import calendar
+import datetime
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+
+# Reconcile a month with its worksheet when its totals are older than this, in seconds
+SUMMARY_TTL = 3600
+MONTH_FORMAT = "%m/%Y"
+NUMERIC_MONTH_REGEX = re.compile(r"^(\d{1,2})(?:[/.-](\d{2}|\d{4}))?$")
+ISO_MONTH_REGEX = re.compile(r"^(\d{4})-(\d{1,2})$")
+MONTH_ABBRS = {abbr.lower(): num for num, abbr in enumerate(calendar.month_abbr) if abbr}
+
+
+def parse_month(text, today=None):
+    """Get the worksheet name (%m/%Y) of a month given as text.
+
+    Accepts "10/2026", "10", "2026-10" and English month names ("oct",
+    "october 2026"). Without a year, the last such month up to today is used.
+
+    Raise:
+        ValueError: If the month cannot be understood.
+
+    """
+    today = today or datetime.date.today()
+    text = text.strip().lower()
+    if not text:
+        return today.strftime(MONTH_FORMAT)
+    year = None
+    match = NUMERIC_MONTH_REGEX.match(text)
+    if match:
+        month, year = int(match.group(1)), match.group(2)
+    else:
+        match = ISO_MONTH_REGEX.match(text)
+        if match:
+            year, month = match.group(1), int(match.group(2))
+        else:
+            name, *rest = text.split()
+            month = MONTH_ABBRS.get(name[:3])
+            if month is None or len(rest) > 1:
+                raise ValueError("I don't understand the month -> {}".format(text))
+            year = rest[0] if rest else None
+    if not 1 <= month <= 12:
+        raise ValueError("I don't understand the month -> {}".format(text))
+    if year is None:
+        year = today.year if month <= today.month else today.year - 1
+    elif len(str(year)) == 2:
+        year = 2000 + int(year)
+    return "{:02d}/{}".format(month, int(year))
+
+
+def parse_amount(value):
+    """Numeric value of an amount as written by the user or read from a sheet."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    return float(str(value).replace(",", "."))
+
+
+class ExpenseSummary:
+    """Per month, category and currency expense totals.
+
+    Totals are updated as expenses are written and stored as JSON. They can be
+    rebuilt for a month from the rows of its worksheet (see `reconcile`), which
+    takes care of manual edits of the sheet. Rows read before an expense was
+    added or removed are not used, so that the change is not lost.
+
+    """
+
+    def __init__(self, path=None, ttl=SUMMARY_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # Serializes writers of the file, which share the temporary path
+        self._save_lock = threading.Lock()
+        # month -> {"totals": {category: {currency: total}}, "count": n, "reconciled": timestamp}
+        self._months = {}
+        # month -> number of changes, to spot reads of the worksheet made before one
+        self._versions = {}
+        # Months with a reconcile scheduled and not finished yet
+        self._scheduled = set()
+        if path:
+            self.load()
+
+    def load(self):
+        """Load the totals from disk."""
+        try:
+            with open(self.path, "r", encoding="utf8") as input_file:
+                self._months = json.load(input_file)
+        except FileNotFoundError:
+            self._months = {}
+        except ValueError:
+            logging.warning("Ignoring corrupt expense summary %s", self.path)
+            self._months = {}
+
+    def save(self):
+        """Store the totals on disk."""
+        if not self.path:
+            return
+        with self._lock:
+            data = json.dumps(self._months, ensure_ascii=False)
+        tmp_path = self.path + ".tmp"
+        with self._save_lock:
+            with open(tmp_path, "w", encoding="utf8") as output_file:
+                output_file.write(data)
+            os.replace(tmp_path, self.path)
+
+    def add(self, month, category, currency, amount):
+        """Add an expense to the totals of a month."""
+        with self._lock:
+            entry = self._months.setdefault(
+                month, {"totals": {}, "count": 0, "reconciled": 0}
+            )
+            totals = entry["totals"].setdefault(category, {})
+            totals[currency] = totals.get(currency, 0.0) + amount
+            entry["count"] += 1
+            self._versions[month] = self._versions.get(month, 0) + 1
+
+    def remove(self, month, category, currency, amount):
+        """Take an undone expense out of the totals of a month."""
+        with self._lock:
+            entry = self._months.get(month)
+            if entry is None:
+                return
+            totals = entry["totals"].get(category, {})
+            totals[currency] = totals.get(currency, 0.0) - amount
+            if abs(totals[currency]) < 0.005:
+                del totals[currency]
+            if not totals:
+                entry["totals"].pop(category, None)
+            entry["count"] = max(0, entry["count"] - 1)
+            self._versions[month] = self._versions.get(month, 0) + 1
+
+    def version(self, month):
+        """Number of changes of a month, for `reconcile` with the rows read after it."""
+        with self._lock:
+            return self._versions.get(month, 0)
+
+    def reconcile(self, month, rows, currency_cols, version=None):
+        """Rebuild the totals of a month from the rows of its worksheet.
+
+        Arguments:
+            month (str): Worksheet name (%m/%Y).
+            rows (list): Unformatted values of the rows below the header.
+            currency_cols (dict): Currency -> column number of the expense worksheets.
+            version (int): Result of `version` before reading the rows. If the
+                month changed since, the rows may miss the change and are not used.
+
+        Return:
+            bool: Whether the totals were rebuilt.
+
+        """
+        totals = {}
+        count = 0
+        for row in rows:
+            counted = False
+            category = row[5] if len(row) > 5 and row[5] else "Undefined"
+            for currency, col in currency_cols.items():
+                if len(row) < col or row[col - 1] in ("", None):
+                    continue
+                try:
+                    amount = parse_amount(row[col - 1])
+                except ValueError:
+                    continue
+                category_totals = totals.setdefault(category, {})
+                category_totals[currency] = category_totals.get(currency, 0.0) + amount
+                counted = True
+            count += counted
+        with self._lock:
+            if version is not None and self._versions.get(month, 0) != version:
+                logging.debug("Not reconciling %s, it changed while being read", month)
+                return False
+            self._months[month] = {
+                "totals": totals,
+                "count": count,
+                "reconciled": time.time(),
+            }
+        return True
+
+    def schedule_reconcile(self, executor, month, reconcile_func):
+        """Run `reconcile_func(month)` on an executor.
+
+        Nothing is done if a reconcile of the month scheduled before hasn't
+        finished yet.
+
+        """
+        with self._lock:
+            if month in self._scheduled:
+                return
+            self._scheduled.add(month)
+
+        def run():
+            try:
+                reconcile_func(month)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Error reconciling the summary of %s", month)
+            finally:
+                with self._lock:
+                    self._scheduled.discard(month)
+
+        executor.submit(run)
+
+    def needs_reconcile(self, month):
+        """Check if the totals of a month are unknown or too old."""
+        with self._lock:
+            entry = self._months.get(month)
+        return not entry or time.time() - entry["reconciled"] > self.ttl
+
+    def known(self, month):
+        """Check if the totals of a month were read from its worksheet at least once.
+
+        Totals only built from the expenses added by the bot miss the rows
+        written before (or by hand), so they are not known yet.
+
+        """
+        with self._lock:
+            entry = self._months.get(month)
+        return bool(entry and entry["reconciled"])
+
+    def report(self, month):
+        """Text summary of a month, largest categories first."""
+        with self._lock:
+            entry = self._months.get(month)
+            if not entry or not entry["count"]:
+                return "No expenses in {}".format(month)
+            totals = {
+                category: dict(currencies)
+                for category, currencies in entry["totals"].items()
+            }
+            count = entry["count"]
+        grand_total = {}
+        for currencies in totals.values():
+            for currency, amount in currencies.items():
+                grand_total[currency] = grand_total.get(currency, 0.0) + amount
+        lines = ["Summary of {} ({} expenses)".format(month, count)]
+        for category in sorted(totals, key=lambda cat: -sum(totals[cat].values())):
+            lines.append("{}: {}".format(category, format_amounts(totals[category])))
+        lines.append("Total: {}".format(format_amounts(grand_total)))
+        return "\n".join(lines)
+
+
+def format_amounts(amounts):
+    """Format currency -> amount totals."""
+    return ", ".join(
+        "{:.2f} {}".format(amount, currency) for currency, amount in sorted(amounts.items())
+    )
+
+
+# EOF
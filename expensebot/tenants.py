@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   tenants.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Per-user settings and caches of the bot."""
+
+import collections
+import json
+import logging
+import os
+import threading
+import weakref
+
+import expensebot.gsheet as gsheet
+from expensebot.categories import CategoryCache, CATEGORIES_TTL
+from expensebot.config import data_path
+from expensebot.messages import ConceptMemory, ExpenseParser
+from expensebot.rates import RateCache, RATES_TTL
+from expensebot.summary import ExpenseSummary, SUMMARY_TTL
+
+
+# Columns of the expense worksheets holding the value in each currency
+CURRENCY_COLS = {"CHF": 3, "EUR": 4}
+# Users whose state is kept in memory at the same time
+MAX_TENANTS = 64
+
+
+class Tenant:
+    """Settings, parser and caches of a user (or of all users in single-user mode).
+
+    Arguments:
+        key (int): Telegram user id, None for the global configuration.
+        config (dict): Configuration of the user (see `config.user_config`).
+        fetch_categories (callable): Called as `fetch_categories(tenant, year)`
+            to get the expense categories of a year from GSheets.
+
+    Raise:
+        ValueError: If the currency configuration is wrong.
+
+    """
+
+    def __init__(self, key, config, fetch_categories):
+        self.key = key
+        self.config = config
+        currency_config = config.get("currency", {})
+        self.ref_currency = currency_config.get("reference", "CHF").upper()
+        self.default_currency = currency_config.get("default", "CHF")
+        self.currencies = [
+            currency.upper()
+            for currency in currency_config.get("supported", list(CURRENCY_COLS))
+        ]
+        if self.ref_currency not in CURRENCY_COLS:
+            raise ValueError(
+                "Reference currency must be one of {}".format(", ".join(CURRENCY_COLS))
+            )
+        self.worksheets = gsheet.WorksheetIndex()
+        self.rates = RateCache(
+            ttl=currency_config.get("rates-ttl", RATES_TTL), worksheets=self.worksheets
+        )
+        self.categories = CategoryCache(
+            data_path(config, "categories.json"),
+            lambda year: fetch_categories(self, year),
+            on_update=lambda categories: self.parser.set_categories(categories),
+            ttl=config.get("categories", {}).get("ttl", CATEGORIES_TTL),
+        )
+        self.memory = self.create_category_memory()
+        self.parser = ExpenseParser(
+            self.categories.get(),
+            currencies=self.currencies,
+            memory=self.memory,
+            threshold=config.get("category-memory", {}).get("threshold"),
+        )
+        self.summary = ExpenseSummary(
+            data_path(config, "summary.json"),
+            ttl=config.get("summary", {}).get("ttl", SUMMARY_TTL),
+        )
+
+    def create_category_memory(self):
+        """Create the learned concept -> category index, if enabled in the config."""
+        if not self.config.get("category-memory", {}).get("enabled", True):
+            return None
+        memory = ConceptMemory(data_path(self.config, "concepts.json"))
+        logging.info("Loaded category memory with %s concepts", len(memory))
+        return memory
+
+    def spreadsheet_ids(self):
+        """Ids of the spreadsheets of the user."""
+        return {
+            self.config[name]
+            for name in ("expenses-sheet", "investment-sheet", "nw-sheet")
+            if self.config.get(name)
+        }
+
+
+class UserPreferences:
+    """Settings a Telegram user changes through the bot (eg, with /setCurrency).
+
+    They belong to the user, not to the spreadsheets (several users may share
+    them), and are stored as JSON in the data directory of the user.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r", encoding="utf8") as input_file:
+                self._values = json.load(input_file)
+        except FileNotFoundError:
+            self._values = {}
+        except ValueError:
+            logging.warning("Ignoring corrupt user preferences %s", path)
+            self._values = {}
+
+    def get(self, name, default=None):
+        """Get a setting."""
+        with self._lock:
+            return self._values.get(name, default)
+
+    def set(self, name, value):
+        """Change a setting and store it on disk."""
+        with self._lock:
+            self._values[name] = value
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf8") as output_file:
+                json.dump(self._values, output_file, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+
+
+class TenantCache:
+    """Bounded LRU of the tenants (or other per-user state) in memory.
+
+    Tenants are created on first use with `factory(key)`, and the least
+    recently used one is dropped when there are more than `max_size`. Its
+    state is kept on disk, so it is rebuilt cheaply the next time it is used.
+    A dropped tenant still in use (eg, by a message being answered) is taken
+    back instead of being rebuilt, so there is never more than one instance
+    saving the state of a user.
+
+    """
+
+    def __init__(self, factory, max_size=MAX_TENANTS, on_evict=None):
+        self.max_size = max_size
+        self._factory = factory
+        self._on_evict = on_evict
+        self._lock = threading.Lock()
+        self._tenants = collections.OrderedDict()
+        self._evicted = weakref.WeakValueDictionary()
+
+    def get(self, key):
+        """Get the tenant of a key, creating it if needed."""
+        evicted = []
+        with self._lock:
+            tenant = self._tenants.get(key)
+            if tenant is not None:
+                self._tenants.move_to_end(key)
+                return tenant
+            tenant = self._evicted.pop(key, None)
+            if tenant is None:
+                tenant = self._factory(key)
+            self._tenants[key] = tenant
+            while len(self._tenants) > self.max_size:
+                old_key, old_tenant = self._tenants.popitem(last=False)
+                self._evicted[old_key] = old_tenant
+                evicted.append((old_key, old_tenant))
+        for old_key, old_tenant in evicted:
+            logging.debug("Dropping state of user %s", old_key)
+            if self._on_evict:
+                self._on_evict(old_tenant)
+        return tenant
+
+    def tenants(self):
+        """Tenants currently in memory."""
+        with self._lock:
+            return list(self._tenants.values())
+
+    def __len__(self):
+        with self._lock:
+            return len(self._tenants)
+
+
+# EOF
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   webhook.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   17.10.2026
+# =============================================================================
+"""Webhook ingestion of Telegram updates."""
+
+import hmac
+import json
+import logging
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import telegram
+
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+QUEUE_SIZE = 100
+MAX_BODY_SIZE = 1024 * 1024
+# Seconds Telegram is asked to wait before retrying when we are busy
+RETRY_AFTER = 5
+
+
+class WebhookServer:
+    """Local HTTP endpoint feeding Telegram updates to a dispatcher.
+
+    Requests are validated (path, secret token, content type and size, JSON
+    body) and put in a bounded queue, which worker threads drain into the
+    dispatcher. When handlers fall behind (for example, because GSheets is
+    slow) and the queue is full, requests are answered with 503 so Telegram
+    retries them later instead of piling them up in memory.
+
+    Arguments:
+        dispatcher (telegram.ext.Dispatcher): Dispatcher handling the updates.
+        listen (str): Address to listen on.
+        port (int): Port to listen on.
+        url_path (str): Path updates are posted to.
+        secret_token (str): Expected value of the secret token header, if any.
+        queue_size (int): Maximum number of updates waiting to be handled.
+        workers (int): Number of threads handling updates. Use 1 to keep the
+            order of updates.
+
+    """
+
+    def __init__(
+        self,
+        dispatcher,
+        listen="127.0.0.1",
+        port=8443,
+        url_path="/",
+        secret_token=None,
+        queue_size=QUEUE_SIZE,
+        workers=1,
+    ):
+        self.dispatcher = dispatcher
+        self.url_path = "/" + url_path.strip("/")
+        self.secret_token = secret_token
+        self.updates = queue.Queue(maxsize=queue_size)
+        self._httpd = ThreadingHTTPServer((listen, port), self._make_handler())
+        self._threads = [
+            threading.Thread(target=self._httpd.serve_forever, name="webhook-server")
+        ]
+        self._threads += [
+            threading.Thread(target=self._work, name="webhook-worker", daemon=True)
+            for _ in range(workers)
+        ]
+
+    @property
+    def address(self):
+        """Address and port the server is bound to."""
+        return self._httpd.server_address
+
+    def start(self):
+        """Start serving."""
+        logging.info("Listening for updates on %s:%s%s", *self.address, self.url_path)
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Stop serving."""
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def _work(self):
+        while True:
+            update = self.updates.get()
+            try:
+                self.dispatcher.process_update(update)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Error processing update %s", update.update_id)
+            finally:
+                self.updates.task_done()
+
+    def validate(self, path, headers, body):
+        """Validate a request and build the update it holds.
+
+        Return:
+            tuple: HTTP status and the update (None if the request is invalid).
+
+        """
+        if urlparse(path).path.rstrip("/") != self.url_path.rstrip("/"):
+            return 404, None
+        if self.secret_token and not hmac.compare_digest(
+            headers.get(SECRET_HEADER, ""), self.secret_token
+        ):
+            return 403, None
+        if not headers.get("Content-Type", "").startswith("application/json"):
+            return 415, None
+        try:
+            data = json.loads(body.decode("utf-8"))
+        except (UnicodeDecodeError, ValueError):
+            return 400, None
+        if not isinstance(data, dict) or not isinstance(data.get("update_id"), int):
+            return 400, None
+        return 200, telegram.Update.de_json(data, self.dispatcher.bot)
+
+    def _make_handler(self):
+        server = self
+
+        class WebhookHandler(BaseHTTPRequestHandler):
+            """Request handler."""
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                """Receive an update."""
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                except ValueError:
+                    length = -1
+                if not 0 < length <= MAX_BODY_SIZE:
+                    self.reply(413 if length > 0 else 411)
+                    return
+                status, update = server.validate(
+                    self.path, self.headers, self.rfile.read(length)
+                )
+                if update is None:
+                    logging.warning("Rejected webhook request (%s)", status)
+                    self.reply(status)
+                    return
+                try:
+                    server.updates.put_nowait(update)
+                except queue.Full:
+                    logging.warning("Update queue is full, asking Telegram to retry")
+                    self.reply(503, {"Retry-After": str(RETRY_AFTER)})
+                    return
+                self.reply(200)
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """Reject anything but updates."""
+                self.reply(405)
+
+            def reply(self, status, headers=None):
+                """Send an empty response."""
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                logging.debug("Webhook: " + format, *args)
+
+        return WebhookHandler
+
+
+# EOF